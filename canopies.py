@@ -26,7 +26,8 @@ class CanopiesBlocker(object):
   """
   Class to do blocking using canopies.
   """
-  def __init__(self, records, cheapDistanceMetric,ermethod,t1,t2,scoreType, randomize=True):
+  def __init__(self, records, cheapDistanceMetric,ermethod,t1,t2,scoreType, randomize=True,
+      neighbors=None):
     """
     Constructor
 
@@ -36,10 +37,15 @@ class CanopiesBlocker(object):
     :param t1: First threshold for canopies
     :param t2: Second threshold for canopies
     :param randomize: If true, randomize the order the records are considered in.
+    :param neighbors: Optionally, precomputed cheap scores: a dictionary from
+      each record to a dictionary from the records within t1 of it to their
+      cheap scores against it. Only these are considered for each canopy
+      center, and the cheap metric is not called.
     """
     self.records = records
     self.cheapMetric = cheapDistanceMetric
-    if not callable(self.cheapMetric):
+    self.neighbors = neighbors
+    if neighbors is None and not callable(self.cheapMetric):
       raise ValueError("Cheap distance metric must be callable function.")
     self.method = ermethod
     self.t1 = t1
@@ -67,6 +73,11 @@ class CanopiesBlocker(object):
     :param center: Center to measure distances from.
     :returns: Dictionary of distances.
     """
+    if self.neighbors is not None:
+      # Everything else is known not to be within t1.
+      #
+      centerNeighbors = self.neighbors[center]
+      return dict((pnt, centerNeighbors[pnt]) for pnt in centerNeighbors if pnt in lst)
     distances = {}
     for pnt in lst:
       # Assume it is symmetric so we don't care the order.
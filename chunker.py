@@ -1,9 +1,7 @@
 # Noun phrase chunker
 # Author : Tim Destan
 
-from nltk import pos_tag
-from nltk.tokenize import wordpunct_tokenize
-from nltk.chunk import RegexpParser, ne_chunk
+# NLTK is imported where it is used, since importing it is slow.
 
 from collections import defaultdict
 
@@ -16,8 +14,17 @@ logger = logging.getLogger("Chunker")
 simple_grammar = 'NP:{<DT|PP\$>?<JJ.*>*<NN.*>+}'
 prep_phrase_grammar = 'NP:{<DT|PP\$>?<JJ.*>*<NN.*>+(<IN><DT|PP\$>?<JJ.*>*<NN.*>+)*}'
 
-simple_chunker = RegexpParser(simple_grammar)
-prep_phrase_chunker = RegexpParser(prep_phrase_grammar)
+# Chunkers for each grammar, built the first time they are needed.
+_chunkers = {}
+
+def get_chunker(grammar):
+  """
+  Returns a chunker for the given grammar.
+  """
+  if grammar not in _chunkers:
+    from nltk.chunk import RegexpParser
+    _chunkers[grammar] = RegexpParser(grammar)
+  return _chunkers[grammar]
 
 ENTITY_TYPES = ['PERSON','ORGANIZATION']
 
@@ -43,9 +50,11 @@ def get_np_chunks(sentence):
   """
   Get noun phrase chunks.
   """
+  from nltk import pos_tag
+  from nltk.tokenize import wordpunct_tokenize
   tokens = wordpunct_tokenize(sentence)
   posTaggedTokens = pos_tag(tokens)
-  tree = simple_chunker.parse(posTaggedTokens)
+  tree = get_chunker(simple_grammar).parse(posTaggedTokens)
   return [x.leaves() for x in tree.subtrees() if x.node == "NP"]
 
 def dropFirst(enumerable):
@@ -60,6 +69,9 @@ def get_named_entities(sentence):
   """
   Get named entities from a sentence.
   """
+  from nltk import pos_tag
+  from nltk.chunk import ne_chunk
+  from nltk.tokenize import wordpunct_tokenize
   tokens = wordpunct_tokenize(sentence)
   posTaggedTokens = pos_tag(tokens)
   tree = ne_chunk(posTaggedTokens)
@@ -2,6 +2,7 @@
 # Feature based clusterer
 
 from collections import defaultdict
+from heapq import heapify, heappush, heappop
 from qbcommon import all_pairs_symmetric
 from featurespace import *
 
@@ -12,6 +13,44 @@ class ScoreTypes(object):
   DISTANCE = "DISTANCE"
   SIMILARITY = "SIMILARITY"
 
+class ClusterEngines(object):
+  """
+  Strategies for finding the next pair of clusters to merge.
+
+  SCAN recomputes the best pair over all cluster pairs on every merge.
+  HEAP keeps candidate pairs in a priority queue and only pushes the pairs
+  involving the newly merged cluster, discarding entries for retired
+  clusters as they are popped. Both merge the same pairs in the same order.
+  When scores tie, both pick the pair with the lowest cluster ids: the
+  lowest first id, then the lowest second one. Before these engines, ties
+  went to whichever pair came first in the clusters dictionary's iteration
+  order.
+
+  NNCHAIN builds the hierarchy with the nearest-neighbor chain algorithm,
+  which finds the same merges for reducible linkages (all of the ones in
+  this file) but finds them out of order. The merges are then replayed
+  best first so that onMerge sees them in the usual order. Distances are
+  cached and updated as for HEAP, but without a queue of pairs alongside
+  them, and the clusters of a retired chain are evicted from the cache.
+  This is not the O(n) memory version of the algorithm: the cache keeps
+  a row of distances for every active cluster, so it takes O(n^2) memory
+  like HEAP, only without the queue. Distances missing from either
+  parent's row are recomputed from base records. The hierarchy is only
+  unique when no scores tie. With ties, the chain can merge a different
+  one of the tied pairs than SCAN and HEAP do, and end up with different
+  clusters.
+
+  MST only applies to single linkage. Cutting single linkage at a threshold
+  gives the connected components of a minimum (for distances) or maximum
+  (for similarities) spanning forest, so the tree is built with Prim's
+  algorithm in O(n^2) time and O(n) memory and its edges are replayed best
+  first, stopping at the threshold.
+  """
+  SCAN = "SCAN"
+  HEAP = "HEAP"
+  NNCHAIN = "NNCHAIN"
+  MST = "MST"
+
 class GuidGenerator(object):
   """
   Generates globally unique identifiers.
@@ -26,14 +65,99 @@ class GuidGenerator(object):
     self.next += 1
     return self.next
 
+class ClusterDistanceCache(object):
+  """
+  Cache of the distances between pairs of clusters, keyed by (c1,c2) with
+  c1 < c2 like the base distance caches.
+
+  Entries are indexed by both cluster ids so that everything involving a
+  cluster can be evicted once it has been merged away, keeping the cache
+  proportional to the number of live cluster pairs. Counts hits, misses
+  and evictions for reporting.
+  """
+  def __init__(self):
+    """Constructor"""
+    self.rows = {}
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None):
+    c1, c2 = key
+    row = self.rows.get(c1, None)
+    if row is not None and c2 in row:
+      self.hits += 1
+      return row[c2]
+    self.misses += 1
+    return default
+
+  def __setitem__(self, key, distance):
+    c1, c2 = key
+    row = self.rows.setdefault(c1, {})
+    if c2 not in row:
+      self.size += 1
+    row[c2] = distance
+    self.rows.setdefault(c2, {})[c1] = distance
+
+  def __len__(self):
+    return self.size
+
+  def row(self, c):
+    """
+    Returns the cached distances from a cluster to other clusters, as a
+    dictionary from cluster ids to distances. Does not count as a lookup.
+
+    :param c: a cluster identifier
+    """
+    return self.rows.get(c, {})
+
+  def evict(self, c):
+    """
+    Removes every entry involving the given cluster.
+
+    :param c: a cluster identifier
+    """
+    row = self.rows.pop(c, None)
+    if row is None:
+      return
+    for other in row:
+      del self.rows[other][c]
+    self.size -= len(row)
+    self.evictions += len(row)
+
+  def clear(self):
+    """Removes every entry."""
+    self.evictions += self.size
+    self.rows.clear()
+    self.size = 0
+
+  def stats(self):
+    """
+    Returns a dictionary of statistics about the cache.
+    """
+    lookups = self.hits + self.misses
+    hitRate = 0.0
+    if lookups > 0:
+      hitRate = float(self.hits) / lookups
+    return {"size": self.size, "hits": self.hits, "misses": self.misses,
+      "evictions": self.evictions, "hit rate": hitRate}
+
 class AgglomerativeCluster(object):
   """
   Agglomerative clusterer based on a feature distance function that takes
   features as vectors from names to values.
   """
+  # The score type under which this linkage keeps the best pair between two
+  # clusters, i.e. behaves as single linkage. None if it never does.
+  #
+  singleLinkageScoreType = None
+
   def __init__(self, compositeRecords, featureSets, scoreFunction,
-      threshold=None, scoreType=ScoreTypes.DISTANCE, baseDistanceCache={},
-      guidGenerator=GuidGenerator(), globalClusters={}):
+      threshold=None, scoreType=ScoreTypes.DISTANCE, baseDistanceCache=None,
+      guidGenerator=GuidGenerator(), globalClusters={},
+      engine=ClusterEngines.HEAP, linkageUpdates=False,
+      candidateNeighbors=None, nonCandidateScore=None, batchScoreFunction=None):
     """
     Constructor
 
@@ -43,22 +167,69 @@ class AgglomerativeCluster(object):
     :param threshold: Optional distance threshold for when to stop merging clusters.
     :param scoreFunction: A distance function to compute the distance between two
       feature vectors. Should be a distance metric.
-    :param baseDistanceCache: A cache of distances between base records.
+    :param baseDistanceCache: A cache of distances between base records. Any
+      object with the dictionary interface keyed by (b1,b2), such as a
+      CondensedSimilarityMatrix, can be shared between clusterers.
+    :param engine: One of ClusterEngines, selecting how the nearest pair of
+      clusters is found.
+    :param linkageUpdates: If true, distances to a newly merged cluster are
+      computed from its parents' cached distances rather than from scratch.
+      Off by default: averages updated this way round differently from
+      ones recomputed from base records, so pairs that tie one way may not
+      tie the other, and the clusters can differ.
+    :param candidateNeighbors: Optional dictionary from each base record to
+      the set of base records worth scoring against it. Other pairs are
+      given nonCandidateScore without calling the score function.
+    :param nonCandidateScore: Score for pairs that are not candidates.
+      Defaults to a zero FeatureComparisonResult.
+    :param batchScoreFunction: Optional function scoring one feature vector
+      against a list of others, returning a list of scores. If given, the
+      base distance cache is filled with it before clustering.
     """
     self.baseFeatureArray = featureSets
     self.scoreFunction = scoreFunction
+    self.batchScoreFunction = batchScoreFunction
+
+    self.candidateNeighbors = candidateNeighbors
+    if nonCandidateScore is None:
+      nonCandidateScore = FeatureComparisonResult()
+    self.nonCandidateScore = nonCandidateScore
 
     self.onMerge = lambda slf, thresh: ()
+    # The most recent merge, as a tuple (c1, c2, cNew).
+    self.lastMerge = None
 
     self.informative_features = defaultdict(float)
 
     if scoreType == ScoreTypes.DISTANCE:
       self.scoreIsBetter = lambda score, best: score < best
+      self._heapKey = lambda score: score.total()
     elif scoreType == ScoreTypes.SIMILARITY:
       self.scoreIsBetter = lambda score, best: score > best
+      self._heapKey = lambda score: -score.total()
     else:
       raise ValueError("Unknown Score type: %s" % repr(scoreType))
 
+    if engine == ClusterEngines.SCAN:
+      self._findNearestClusters = self._scanNearestClusters
+    elif engine in (ClusterEngines.HEAP, ClusterEngines.NNCHAIN, ClusterEngines.MST):
+      # The chain and spanning tree algorithms only run from cluster(),
+      # single merges still go through the priority queue.
+      #
+      self._findNearestClusters = self._popNearestClusters
+    else:
+      raise ValueError("Unknown cluster engine: %s" % repr(engine))
+    if engine == ClusterEngines.MST and scoreType != self.singleLinkageScoreType:
+      raise ValueError("The %s engine needs single linkage, which %s does not give with %s scores." % \
+        (engine, self.__class__.__name__, scoreType))
+    self.engine = engine
+    self.linkageUpdates = linkageUpdates
+
+    # Priority queue of (key, c1, c2) entries for the HEAP engine. Built on
+    # the first merge so that subclasses are fully set up by then.
+    #
+    self._heap = None
+
     if threshold is None:
       logger.warn("Threshold should probably be specified.. Defaulting to infinity..")
       self.threshold = InfiniteFeatureComparisonResult()
@@ -85,11 +256,18 @@ class AgglomerativeCluster(object):
 
     # Cache distances between two clusters and between base recs.
     #
-    if baseDistanceCache:
+    if baseDistanceCache is not None:
       self.baseDistanceCache = baseDistanceCache
     else:
       self.baseDistanceCache = {}
-    self.clusterDistanceCache = {}
+    self.clusterDistanceCache = ClusterDistanceCache()
+
+  def cacheStats(self):
+    """
+    Returns statistics (size, hits, misses, evictions, hit rate) for the
+    cache of distances between clusters.
+    """
+    return self.clusterDistanceCache.stats()
 
   def _newClusterId(self):
     """Gets a new cluster ID unique to this object"""
@@ -104,6 +282,8 @@ class AgglomerativeCluster(object):
     """
     if b1 > b2:
       b1, b2 = b2, b1
+    if self.candidateNeighbors is not None and b2 not in self.candidateNeighbors[b1]:
+      return self.nonCandidateScore
     distance = self.baseDistanceCache.get((b1,b2), None)
     if distance is None:
       distance = self.scoreFunction(\
@@ -111,6 +291,27 @@ class AgglomerativeCluster(object):
       self.baseDistanceCache[(b1,b2)] = distance
     return distance
 
+  def _fillBaseDistances(self):
+    """
+    Scores every pair of base records missing from the base distance cache
+    (only the candidate pairs, if there are candidates), one base record
+    against all the later ones at a time.
+    """
+    records = sorted(self.b2c)
+    filled = 0
+    for ii, b1 in enumerate(records):
+      others = [b2 for b2 in records[ii + 1:] if (b1,b2) not in self.baseDistanceCache]
+      if self.candidateNeighbors is not None:
+        others = [b2 for b2 in others if b2 in self.candidateNeighbors[b1]]
+      if not others:
+        continue
+      scores = self.batchScoreFunction(self.baseFeatureArray[b1],
+        [self.baseFeatureArray[b2] for b2 in others])
+      for b2, score in zip(others, scores):
+        self.baseDistanceCache[(b1,b2)] = score
+      filled += len(others)
+    logger.debug("Scored %d pairs of base records in batches." % filled)
+
   def distance(self, c1, c2):
     """
     Computes the difference between the clusters with the given identifiers.
@@ -118,18 +319,82 @@ class AgglomerativeCluster(object):
     :param c1: a cluster identifier
     :param c2: another cluster identifier
 
+    :returns: The distance between the two identified clusters.
+    """
+    if c1 > c2:
+      c1, c2 = c2, c1
+    clusterDistance = self.clusterDistanceCache.get((c1,c2), None)
+    if clusterDistance is None:
+      clusterDistance = self._computeDistance(c1, c2)
+      self.clusterDistanceCache[(c1,c2)] = clusterDistance
+    return clusterDistance
+
+  def _computeDistance(self, c1, c2):
+    """
+    Computes the distance between two clusters from their base records.
+
+    :param c1: a cluster identifier
+    :param c2: another cluster identifier
+
     :returns: The distance between the two identified clusters.
     """
     # Concrete class should provide implementation.
     #
     raise NotImplemented
 
+  def _combineDistances(self, d1, size1, d2, size2):
+    """
+    Computes the distance from a merged cluster to some other cluster given
+    only the distances from the two merged clusters to that cluster (the
+    Lance-Williams update for this linkage).
+
+    :param d1: distance from the first merged cluster to the other cluster.
+    :param size1: number of base records in the first merged cluster.
+    :param d2: distance from the second merged cluster to the other cluster.
+    :param size2: number of base records in the second merged cluster.
+
+    :returns: The distance from the merged cluster to the other cluster.
+    """
+    # Concrete class should provide implementation.
+    #
+    raise NotImplemented
+
   def mergeClusters(self,c1,c2):
     """
-    Merges the two argument clusters.
+    Merges the two argument clusters. With linkage updates enabled, the
+    distances from the merged cluster to every other cluster are derived
+    from the cached distances of the two parents, where both are known.
+    Cached distances involving the two parents are then evicted.
+
+    :param c1: A cluster identifier
+    :param c2: Another cluster identifier.
+
+    :returns: The identifier of the merged cluster.
+    """
+    updatedDistances = {}
+    if self.linkageUpdates:
+      size1, size2 = len(self.c2b[c1]), len(self.c2b[c2])
+      row1 = self.clusterDistanceCache.row(c1)
+      row2 = self.clusterDistanceCache.row(c2)
+      for c in row1:
+        if c != c2 and c in row2:
+          updatedDistances[c] = self._combineDistances(row1[c], size1, row2[c], size2)
+    self.clusterDistanceCache.evict(c1)
+    self.clusterDistanceCache.evict(c2)
+    cNew = self._joinClusters(c1, c2)
+    for c in updatedDistances:
+      self.clusterDistanceCache[(c,cNew)] = updatedDistances[c]
+    return cNew
+
+  def _joinClusters(self, c1, c2):
+    """
+    Replaces the two argument clusters with their union, without touching
+    any cached distances.
 
     :param c1: A cluster identifier
     :param c2: Another cluster identifier.
+
+    :returns: The identifier of the merged cluster.
     """
     combinedBaseRecords = (self.c2b[c1] | self.c2b[c2])
     # Remove these two clusters.
@@ -139,6 +404,75 @@ class AgglomerativeCluster(object):
     self.c2b[cNew] = combinedBaseRecords
     for baseRecord in combinedBaseRecords:
       self.b2c[baseRecord] = cNew
+    self.lastMerge = (c1, c2, cNew)
+    return cNew
+
+  def _scanNearestClusters(self):
+    """
+    Finds the best pair of clusters by comparing every pair of clusters.
+
+    Ties go to the pair with the lowest cluster identifiers, comparing the
+    first identifiers and then the second ones, as the pairs are scanned
+    in sorted order.
+
+    :returns: A tuple (score, c1, c2) for the best pair.
+    """
+    bestDistance = None
+    cbest1, cbest2 = None, None
+
+    for c1,c2 in all_pairs_symmetric(sorted(self.c2b.keys())):
+      distance = self.distance(c1,c2)
+      if (not bestDistance) or self.scoreIsBetter(distance, bestDistance):
+        bestDistance = distance
+        cbest1, cbest2 = c1, c2
+
+    return bestDistance, cbest1, cbest2
+
+  def _pushPair(self, c1, c2):
+    """
+    Pushes the pair of clusters onto the priority queue.
+
+    :param c1: a cluster identifier
+    :param c2: another cluster identifier
+    """
+    if c1 > c2:
+      c1, c2 = c2, c1
+    heappush(self._heap, (self._heapKey(self.distance(c1,c2)), c1, c2))
+
+  def _popNearestClusters(self):
+    """
+    Finds the best pair of clusters using the priority queue, building it
+    on the first call. Entries that refer to clusters which have since been
+    merged away are discarded as they come off the queue.
+
+    Ties go to the pair with the lowest cluster identifiers, as with the
+    SCAN engine.
+
+    :returns: A tuple (score, c1, c2) for the best pair.
+    """
+    if self._heap is None:
+      self._heap = []
+      for c1,c2 in all_pairs_symmetric(sorted(self.c2b.keys())):
+        self._heap.append((self._heapKey(self.distance(c1,c2)), c1, c2))
+      heapify(self._heap)
+
+    while self._heap:
+      _, c1, c2 = self._heap[0]
+      if c1 in self.c2b and c2 in self.c2b:
+        return self.distance(c1,c2), c1, c2
+      heappop(self._heap)
+    return None, None, None
+
+  def _onClustersMerged(self, cNew):
+    """
+    Updates the engine state after a merge produced the cluster cNew.
+
+    :param cNew: identifier of the newly created cluster.
+    """
+    if self._heap is not None:
+      for c in self.c2b:
+        if c != cNew:
+          self._pushPair(c, cNew)
 
   def mergeNearestClusters(self):
     """
@@ -152,14 +486,7 @@ class AgglomerativeCluster(object):
       logger.debug("Only one cluster left, terminating clustering.")
       return False
 
-    bestDistance = None
-    cbest1, cbest2 = None, None
-
-    for c1,c2 in all_pairs_symmetric(self.c2b.keys()):
-      distance = self.distance(c1,c2)
-      if (not bestDistance) or self.scoreIsBetter(distance, bestDistance):
-        bestDistance = distance
-        cbest1, cbest2 = c1, c2
+    bestDistance, cbest1, cbest2 = self._findNearestClusters()
 
     #assert(cbest1 is not None and cbest2 is not None)
 
@@ -167,26 +494,166 @@ class AgglomerativeCluster(object):
       logger.debug("Best score %g passed score threshold %g, terminating clustering." % \
         (bestDistance.total(), self.threshold.total()))
       return False
-    contrib = bestDistance.feature_contributions()
-    for feat in contrib:
-      self.informative_features[feat] += contrib[feat]
     # This line is just too much output, makes debug level unusuable. Occasionally
     # uncommented when something in this class needs to be carefully debugged.
     #
     #logger.debug("Merging " + repr(self.c2b[cbest1]) + " and " + repr(self.c2b[cbest2]) + \
     #  " with score " + repr(bestDistance.total()) + ".")
-    self.mergeClusters(cbest1, cbest2)
-    self.onMerge(self, bestDistance)
+    cNew = self.mergeClusters(cbest1, cbest2)
+    self._onClustersMerged(cNew)
+    self._recordMerge(bestDistance)
     return True
 
+  def _recordMerge(self, bestDistance):
+    """
+    Accounts for a merge that was just made with the given score.
+
+    :param bestDistance: The score of the merged pair of clusters.
+    """
+    contrib = bestDistance.feature_contributions()
+    for feat in contrib:
+      self.informative_features[feat] += contrib[feat]
+    self.onMerge(self, bestDistance)
+
+  def _nearestNeighborChain(self):
+    """
+    Clusters with the nearest-neighbor chain algorithm.
+
+    Follows nearest neighbors from some cluster until it reaches two
+    clusters that are each other's nearest neighbors, and merges those.
+    When the end of the chain has no neighbor within the threshold, nothing
+    on the chain ever will, so the whole chain is retired.
+
+    The merges are recorded and replayed afterwards from the initial
+    clusters in order of score, so informative features and onMerge see
+    the same sequence as the other engines.
+
+    Retired clusters never come up again, so their cached distances are
+    evicted with the chain. The rows of active clusters are kept, which
+    takes O(n^2) memory. With linkage updates on, a merged cluster's
+    distances are derived from its parents' rows where both have the other
+    cluster. Any other distances are recomputed from base records.
+    """
+    initialC2b = dict(self.c2b)
+    initialB2c = dict(self.b2c)
+
+    merges = []
+    active = set(self.c2b)
+    chain = []
+    cNew = None
+    heapKey = self._heapKey
+    while active:
+      if not chain:
+        chain.append(cNew if cNew in active else min(active))
+      a = chain[-1]
+      # Prefer the previous cluster on the chain when scores tie, otherwise
+      # the chain can cycle. This loop is most of the work, so scores are
+      # compared by their heap keys and cached distances read from the row.
+      #
+      prev, best, bestKey = None, None, None
+      if len(chain) > 1:
+        prev = best = chain[-2]
+        bestKey = heapKey(self.distance(a, prev))
+      row = self.clusterDistanceCache.row(a)
+      for c in active:
+        if c == a or c == prev:
+          continue
+        distance = row.get(c, None)
+        if distance is None:
+          distance = self.distance(a, c)
+        key = heapKey(distance)
+        if best is None or key < bestKey:
+          best, bestKey = c, key
+      bestDistance = None
+      if best is not None:
+        bestDistance = self.distance(a, best)
+
+      if best is None or self.scoreIsBetter(self.threshold, bestDistance):
+        active.difference_update(chain)
+        for c in chain:
+          self.clusterDistanceCache.evict(c)
+        chain = []
+      elif best == prev:
+        chain.pop()
+        chain.pop()
+        active.remove(a)
+        active.remove(prev)
+        merges.append((self._heapKey(bestDistance), len(merges), bestDistance,
+          next(iter(self.c2b[prev])), next(iter(self.c2b[a]))))
+        cNew = self.mergeClusters(prev, a)
+        active.add(cNew)
+      else:
+        chain.append(best)
+
+    # Replay the merges, best first, from the initial clusters.
+    #
+    self.c2b = initialC2b
+    self.b2c = initialB2c
+    self.clusterDistanceCache.clear()
+    merges.sort()
+    for _, _, bestDistance, b1, b2 in merges:
+      self._joinClusters(self.b2c[b1], self.b2c[b2])
+      self._recordMerge(bestDistance)
+
+  def _spanningTree(self):
+    """
+    Clusters by building a spanning tree over the initial clusters with
+    Prim's algorithm and replaying its edges best first until one fails the
+    threshold. Only valid for single linkage.
+
+    Cluster distances are computed directly rather than cached, since each
+    pair is only looked at once.
+    """
+    clusters = sorted(self.c2b)
+    representatives = dict((c, next(iter(self.c2b[c]))) for c in clusters)
+
+    edges = []
+    # Best known link from each cluster outside the tree into the tree, as a
+    # pair (distance, cluster in the tree).
+    #
+    bestLinks = {}
+    remaining = clusters[1:]
+    current = clusters[0] if clusters else None
+    while remaining:
+      nextCluster, nextDistance = None, None
+      for c in remaining:
+        distance = self._computeDistance(current, c)
+        link = bestLinks.get(c, None)
+        if link is None or self.scoreIsBetter(distance, link[0]):
+          link = bestLinks[c] = (distance, current)
+        if nextCluster is None or self.scoreIsBetter(link[0], nextDistance):
+          nextCluster, nextDistance = c, link[0]
+      remaining.remove(nextCluster)
+      distance, parent = bestLinks.pop(nextCluster)
+      edges.append((self._heapKey(distance), len(edges), distance,
+        representatives[parent], representatives[nextCluster]))
+      current = nextCluster
+
+    edges.sort()
+    for _, _, bestDistance, b1, b2 in edges:
+      if self.scoreIsBetter(self.threshold, bestDistance):
+        logger.debug("Best score %g passed score threshold %g, terminating clustering." % \
+          (bestDistance.total(), self.threshold.total()))
+        break
+      self._joinClusters(self.b2c[b1], self.b2c[b2])
+      self._recordMerge(bestDistance)
+
   def cluster(self):
     """Clusters the records and returns the resulting clusters"""
     logger.debug("Beginning feature based clustering on %d clusters." % len(self.c2b))
-    # Merge the two nearest clusters until we can't.
-    #
-    while self.mergeNearestClusters():
-      pass
+    if self.batchScoreFunction is not None:
+      self._fillBaseDistances()
+    if self.engine == ClusterEngines.NNCHAIN:
+      self._nearestNeighborChain()
+    elif self.engine == ClusterEngines.MST:
+      self._spanningTree()
+    else:
+      # Merge the two nearest clusters until we can't.
+      #
+      while self.mergeNearestClusters():
+        pass
     logger.debug("After clustering, there are now %d clusters remaining." % len(self.c2b))
+    logger.debug("Cluster distance cache: %s" % repr(self.cacheStats()))
     return self.c2b.values()
 
 class MinDistanceAgglomerativeCluster(AgglomerativeCluster):
@@ -194,7 +661,9 @@ class MinDistanceAgglomerativeCluster(AgglomerativeCluster):
   Agglomerative clusterer that compares two clusters by the distance between
   their closest two points.
   """
-  def distance(self, c1, c2):
+  singleLinkageScoreType = ScoreTypes.DISTANCE
+
+  def _computeDistance(self, c1, c2):
     """
     Computes the difference between the clusters with the given identifiers.
 
@@ -203,28 +672,33 @@ class MinDistanceAgglomerativeCluster(AgglomerativeCluster):
 
     :returns: The distance between the two identified clusters.
     """
-    if c1 > c2:
-      c1, c2 = c2, c1
-    clusterDistance = self.clusterDistanceCache.get((c1,c2), None)
-    if clusterDistance is None:
-      # Find the minimum distance between any two pairs in the clusters.
-      #
-      minDistance = InfiniteFeatureComparisonResult()
-      for b1 in self.c2b[c1]:
-        for b2 in self.c2b[c2]:
-          baseDistance = self._baseDistance(b1, b2)
-          if baseDistance < minDistance:
-            minDistance = baseDistance
-      clusterDistance = minDistance
-      self.clusterDistanceCache[(c1,c2)] = clusterDistance
-    return clusterDistance
+    # Find the minimum distance between any two pairs in the clusters.
+    #
+    minDistance = InfiniteFeatureComparisonResult()
+    for b1 in self.c2b[c1]:
+      for b2 in self.c2b[c2]:
+        baseDistance = self._baseDistance(b1, b2)
+        if baseDistance < minDistance:
+          minDistance = baseDistance
+    return minDistance
+
+  def _combineDistances(self, d1, size1, d2, size2):
+    """The closest pair is the closer of the two parents' closest pairs."""
+    if d2 < d1:
+      return d2
+    return d1
 
 class MaxDistanceAgglomerativeCluster(AgglomerativeCluster):
   """
   Agglomerative clusterer that compares two clusters by the distance between
   their farthest two points.
+
+  With similarity scores the farthest two points are the most similar pair,
+  so this is single linkage.
   """
-  def distance(self, c1, c2):
+  singleLinkageScoreType = ScoreTypes.SIMILARITY
+
+  def _computeDistance(self, c1, c2):
     """
     Computes the difference between the clusters with the given identifiers.
 
@@ -233,28 +707,28 @@ class MaxDistanceAgglomerativeCluster(AgglomerativeCluster):
 
     :returns: The distance between the two identified clusters.
     """
-    if c1 > c2:
-      c1, c2 = c2, c1
-    clusterDistance = self.clusterDistanceCache.get((c1,c2), None)
-    if clusterDistance is None:
-      # Find the maximum distance between any two pairs in the clusters.
-      #
-      maxDistance = ConstantValueFeatureComparisonResult(0.0)
-      for b1 in self.c2b[c1]:
-        for b2 in self.c2b[c2]:
-          baseDistance = self._baseDistance(b1, b2)
-          if baseDistance > maxDistance:
-            maxDistance = baseDistance
-      clusterDistance = maxDistance
-      self.clusterDistanceCache[(c1,c2)] = clusterDistance
-    return clusterDistance
+    # Find the maximum distance between any two pairs in the clusters.
+    #
+    maxDistance = ConstantValueFeatureComparisonResult(0.0)
+    for b1 in self.c2b[c1]:
+      for b2 in self.c2b[c2]:
+        baseDistance = self._baseDistance(b1, b2)
+        if baseDistance > maxDistance:
+          maxDistance = baseDistance
+    return maxDistance
+
+  def _combineDistances(self, d1, size1, d2, size2):
+    """The farthest pair is the farther of the two parents' farthest pairs."""
+    if d2 > d1:
+      return d2
+    return d1
 
 class AverageDistanceAgglomerativeCluster(AgglomerativeCluster):
   """
   Agglomerative clusterer that compares two clusters by the average distance
   between the points in those clusters.
   """
-  def distance(self, c1, c2):
+  def _computeDistance(self, c1, c2):
     """
     Computes the difference between the clusters with the given identifiers.
 
@@ -263,19 +737,19 @@ class AverageDistanceAgglomerativeCluster(AgglomerativeCluster):
 
     :returns: The distance between the two identified clusters.
     """
-    if c1 > c2:
-      c1, c2 = c2, c1
-    clusterDistance = self.clusterDistanceCache.get((c1,c2), None)
-    if clusterDistance is None:
-      totalDistance = FeatureComparisonResult() # 0.0
-      count = 0
-      for b1 in self.c2b[c1]:
-        for b2 in self.c2b[c2]:
-          totalDistance = totalDistance.add(self._baseDistance(b1, b2))
-          count += 1
-      if count == 0:
-        clusterDistance = FeatureComparisonResult() # 0.0
-      else:
-        clusterDistance = totalDistance.normalize(count)
-      self.clusterDistanceCache[(c1,c2)] = clusterDistance
-    return clusterDistance
\ No newline at end of file
+    totalDistance = FeatureComparisonResult() # 0.0
+    count = 0
+    for b1 in self.c2b[c1]:
+      for b2 in self.c2b[c2]:
+        totalDistance = totalDistance.add(self._baseDistance(b1, b2))
+        count += 1
+    if count == 0:
+      return FeatureComparisonResult() # 0.0
+    return totalDistance.normalize(count)
+
+  def _combineDistances(self, d1, size1, d2, size2):
+    """
+    The average over the merged cluster is the average of the parents'
+    averages, weighted by the parents' sizes.
+    """
+    return d1.scale(size1).add(d2.scale(size2)).normalize(size1 + size2)
@@ -3,11 +3,11 @@
 
 from math import log
 from collections import defaultdict
+from itertools import product
 import logging
 logger = logging.getLogger("Evaluation")
 
 from qbcommon import all_pairs_symmetric
-from nltk.util import ngrams
 from settings import getRelevantOptions, getRelevantOptionNames
 
 def cluster_by_label(labeled_featuresets):
@@ -104,6 +104,87 @@ def pairwise_f1(baserecords, experimental, golden):
     f1 = 2.0 * (precision * recall) / (precision + recall)
   return f1,precision,recall
 
+class IncrementalPairwiseF1(object):
+  """
+  Keeps track of the pairwise F1 of a clustering as its clusters are
+  merged, without enumerating all the pairs after every merge.
+
+  Each cluster keeps a histogram of the gold standard labels of its base
+  records. Merging two clusters adds one pair per pair of their base
+  records, and one correct pair per pair sharing a label, so the counts
+  can be updated from the two histograms alone.
+  """
+  def __init__(self, golden):
+    """
+    Constructor
+
+    :param golden: The gold standard clustering.
+    """
+    self.goldenHash = makebase2idhash(golden)
+    self.goldenPairs = sum(len(cluster) * (len(cluster) - 1) / 2 for cluster in golden)
+    self.reset({})
+
+  def reset(self, clusters):
+    """
+    Starts tracking a new clustering.
+
+    :param clusters: A dictionary from cluster identifiers to sets of base
+      records, such as the c2b of a clusterer.
+    """
+    self.histograms = {}
+    self.sizes = {}
+    self.correctPairs = 0
+    self.experimentalPairs = 0
+    for clusterId, cluster in clusters.iteritems():
+      histogram = defaultdict(int)
+      for baseRecord in cluster:
+        histogram[self.goldenHash[baseRecord]] += 1
+      for count in histogram.itervalues():
+        self.correctPairs += count * (count - 1) / 2
+      self.histograms[clusterId] = histogram
+      self.sizes[clusterId] = len(cluster)
+      self.experimentalPairs += len(cluster) * (len(cluster) - 1) / 2
+
+  def merge(self, c1, c2, cNew):
+    """
+    Accounts for merging two clusters into a new one.
+
+    :param c1: Identifier of a merged cluster.
+    :param c2: Identifier of the other merged cluster.
+    :param cNew: Identifier of the resulting cluster.
+    """
+    h1 = self.histograms.pop(c1)
+    h2 = self.histograms.pop(c2)
+    size1 = self.sizes.pop(c1)
+    size2 = self.sizes.pop(c2)
+    # Fold the smaller histogram into the larger one.
+    #
+    if len(h1) < len(h2):
+      h1, h2 = h2, h1
+    for label, count in h2.iteritems():
+      self.correctPairs += count * h1.get(label, 0)
+      h1[label] += count
+    self.experimentalPairs += size1 * size2
+    self.histograms[cNew] = h1
+    self.sizes[cNew] = size1 + size2
+
+  def scores(self):
+    """
+    :returns: pairwise F1, precision, and recall of the current clustering,
+      as for pairwise_f1.
+    """
+    num = float(self.correctPairs)
+    precision = 0.0
+    if self.experimentalPairs > 0:
+      precision = num / self.experimentalPairs
+    recall = 0.0
+    if self.goldenPairs > 0:
+      recall = num / self.goldenPairs
+    f1 = 0.0
+    if (precision + recall) > 0:
+      f1 = 2.0 * (precision * recall) / (precision + recall)
+    return f1,precision,recall
+
 def cluster_report(clustering):
   for cluster in clustering:
     print "\t%s" % repr(cluster)
@@ -180,9 +261,14 @@ def write_csv_column_names():
   print ",".join([str(x) for x in ["pairwise f1", "pairwise precision", "pairwise recall", \
     "cluster f1", "cluster precision", "cluster recall", "VI"] + getRelevantOptionNames()])
 
-def report_feature_distances(allClues, clusters, labeledFeaturesets, distance):
+def report_feature_distances(allClues, clusters, labeledFeaturesets, distance,
+    distances=None):
   """
   Reports the feature distance between every pair of clues. Note if they share a cluster.
+
+  If distances is given, it is used to score each clue against all the
+  later ones at once: it takes a feature set and a list of others and
+  returns a list of scores.
   """
   logger.info("Writing all possible thresholds ...")
   b2id = makebase2idhash(clusters)
@@ -191,10 +277,20 @@ def report_feature_distances(allClues, clusters, labeledFeaturesets, distance):
   
   total_possible = 0.0
 
-  for x1, x2 in all_pairs_symmetric(allClues):
-    if x1 > x2:
-      x1,x2 = x2,x1
-    scores[(x1,x2)] = distance(labeledFeaturesets[x1][0], labeledFeaturesets[x2][0])
+  if distances is not None:
+    clues = sorted(allClues)
+    for ii, x1 in enumerate(clues):
+      others = clues[ii + 1:]
+      batch = distances(labeledFeaturesets[x1][0],
+        [labeledFeaturesets[x2][0] for x2 in others])
+      for x2, score in zip(others, batch):
+        scores[(x1,x2)] = score
+  else:
+    for x1, x2 in all_pairs_symmetric(allClues):
+      if x1 > x2:
+        x1,x2 = x2,x1
+      scores[(x1,x2)] = distance(labeledFeaturesets[x1][0], labeledFeaturesets[x2][0])
+  for (x1,x2) in scores:
     if b2id[x1] == b2id[x2]:
       total_possible += 1
 
@@ -212,6 +308,68 @@ def report_feature_distances(allClues, clusters, labeledFeaturesets, distance):
       f1 = 2*precision*recall / (precision + recall)
     print "%f,%f,%f,%f" % (distanceValue.total(), precision, recall, f1)
 
+def best_threshold(totals, sameCluster, total_possible):
+  """
+  Finds the similarity threshold with the best pairwise F1, when every pair
+  scoring at least the threshold is put in the same cluster.
+
+  :param totals: Total similarity of each pair.
+  :param sameCluster: For each pair, whether it shares a golden cluster.
+  :param total_possible: Number of pairs sharing a golden cluster.
+  :returns: A (threshold, precision, recall, f1) tuple.
+  """
+  best = (0.0, 0.0, 0.0, 0.0)
+  # No recall is possible if no pair shares a golden cluster.
+  #
+  if total_possible <= 0:
+    return best
+  order = sorted(xrange(len(totals)), key=totals.__getitem__, reverse=True)
+  total_right = 0
+  total_assigned = 0.0
+  for position, ii in enumerate(order):
+    total_assigned += 1.0
+    total_right += sameCluster[ii]
+    # Pairs with the same total fall on the same side of any threshold.
+    #
+    if position + 1 < len(order) and totals[order[position + 1]] == totals[ii]:
+      continue
+    precision = total_right / total_assigned
+    recall = total_right / total_possible
+    f1 = 0.0
+    if precision + recall > 0.0:
+      f1 = 2*precision*recall / (precision + recall)
+    if f1 > best[3]:
+      best = (totals[ii], precision, recall, f1)
+  return best
+
+def report_weight_grid(matrix, clusters, values):
+  """
+  Reports the best threshold and its pairwise F1 for every combination of
+  feature weights taken from the given values. Works from the unweighted
+  similarities of every pair, so nothing is compared again per weighting.
+
+  :param matrix: A CondensedSimilarityMatrix of unweighted similarities
+    holding every pair.
+  :param clusters: The golden clusters.
+  :param values: The values each weight may take.
+  """
+  logger.info("Searching %d weight values for each feature ..." % len(values))
+  b2id = makebase2idhash(clusters)
+  sameCluster = bytearray(int(b2id[b1] == b2id[b2]) for (b1, b2) in matrix.pairs())
+  total_possible = float(sum(sameCluster))
+  best = None
+  print "tf_idf_weight,category_weight,referers_weight,named_entities_weight,threshold,precision,recall,f1"
+  for weights in product(values, repeat=4):
+    if not any(weights):
+      continue
+    threshold, precision, recall, f1 = best_threshold(matrix.totals(weights),
+      sameCluster, total_possible)
+    print "%f,%f,%f,%f,%f,%f,%f,%f" % (weights + (threshold, precision, recall, f1))
+    if best is None or f1 > best[1]:
+      best = (weights, f1)
+  if best is not None:
+    logger.info("Best weights %s with pairwise F1 %f" % best)
+
 def report_accuracy(baserecords, experimental, golden, options):
   """
   Report accuracy of an already trained classifier.
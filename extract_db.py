@@ -2,7 +2,6 @@ from collections import defaultdict
 import re
 import sqlite3
 # from chunker import *
-from nltk.tokenize import wordpunct_tokenize
 import logging
 logger = logging.getLogger("Extractor")
 
@@ -8,14 +8,44 @@
 # comparison as a number, plus which features contributed most heavily
 # to the result.
 
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from itertools import izip
 import logging
-from nltk.corpus import wordnet as wn
-from nltk.corpus import wordnet_ic
 from math import exp, sqrt
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+from qbcommon import MappedArray, replacingFile
 
 logger = logging.getLogger("FeatureSpace")
 
+# WordNet and the rest of NLTK are slow to load, so they are only imported
+# when first needed. wn holds WordNet once wordnet() has loaded it.
+wn = None
+
+def wordnet():
+  """Returns NLTK's WordNet corpus reader."""
+  global wn
+  if wn is None:
+    from nltk.corpus import wordnet as wn
+  return wn
+
+# Products of norms are scaled up by this much before being used as bounds on
+# dot products, which can come out a little larger through rounding.
+NORM_BOUND_SLACK = 1.0 + 1e-9
+
+def weightedRange(low, high, weight):
+  """
+  Returns the lowest and highest values a quantity between low and high
+  can take once multiplied by the weight.
+  """
+  return min(low * weight, high * weight), max(low * weight, high * weight)
+
 def sigmoid(x):
   """Computes a sigmoid function"""
   return 1.0 / (1.0 + exp(-x))
@@ -33,6 +63,18 @@ class FeatureRepresentation(object):
     self.category = None
     self.referers = []
     self.named_entities = defaultdict(int)
+    # Row of this clue in a TfIdfMatrix, if one was built.
+    self.tfidf_row = None
+    # Ids of the referers in a RefererSimilarityTable, if one was built.
+    self.referer_ids = None
+    # Sorted ids of the named entities in a NamedEntityTable and their
+    # counts, if one was built.
+    self.entity_ids = None
+    self.entity_counts = None
+    # Euclidean norms of the tf-idf and named entity vectors, set with the
+    # arrays above. They bound the similarities (see compareWithThreshold).
+    self.tfidf_norm = None
+    self.entity_norm = None
 
   def __str__(self):
     """ Returns a string representation of this object """
@@ -102,6 +144,657 @@ def make_featuresets(questions, index, options, db=None, disambiguations={}):
 
   return labeled_featuresets
 
+class TfIdfMatrix(object):
+  """
+  The tf-idf features of a list of clues as a sparse matrix in compressed
+  sparse row form, with one row per clue and one column per term.
+
+  Term ids are assigned in order of first appearance. Within a row the
+  columns are sorted, so dot products always add up the shared terms in
+  the same order whether they are computed for one pair or for a block.
+  """
+  def __init__(self, featureSets):
+    """
+    Constructor. Also records each clue's row in its tfidf_row.
+
+    :param featureSets: Feature representations of the clues.
+    """
+    self.termIds = {}
+    self.indptr = array('l', [0])
+    self.indices = array('l')
+    self.data = array('d')
+    for row, featureRep in enumerate(featureSets):
+      entries = []
+      for term, value in featureRep.tfidf_features.iteritems():
+        if term not in self.termIds:
+          self.termIds[term] = len(self.termIds)
+        entries.append((self.termIds[term], value))
+      entries.sort()
+      self.indices.extend(termId for (termId, _) in entries)
+      self.data.extend(value for (_, value) in entries)
+      self.indptr.append(len(self.indices))
+      featureRep.tfidf_row = row
+      featureRep.tfidf_norm = sqrt(sum(value * value for (_, value) in entries))
+    logger.info("Built tf-idf matrix with %d rows, %d terms and %d entries." % \
+      (len(self.indptr) - 1, len(self.termIds), len(self.data)))
+
+  def dot(self, row1, row2):
+    """
+    Computes the dot product of two rows by merging their sorted columns.
+    """
+    ii, end1 = self.indptr[row1], self.indptr[row1 + 1]
+    jj, end2 = self.indptr[row2], self.indptr[row2 + 1]
+    indices = self.indices
+    data = self.data
+    total = 0.0
+    while ii < end1 and jj < end2:
+      if indices[ii] < indices[jj]:
+        ii += 1
+      elif indices[ii] > indices[jj]:
+        jj += 1
+      else:
+        total += data[ii] * data[jj]
+        ii += 1
+        jj += 1
+    return total
+
+  def dotBlock(self, rows, columns):
+    """
+    Computes the dot products between every row in one list and every row
+    in another, as the sparse product of the two sets of rows. The columns
+    are turned into postings lists once, and each row then only touches the
+    entries of columns sharing one of its terms.
+
+    :param rows: Rows of the matrix.
+    :param columns: Other rows of the matrix.
+    :returns: A list holding, for each of the rows, an array of its dot
+      products with each of the columns.
+    """
+    postings = defaultdict(list)
+    for position, column in enumerate(columns):
+      for kk in xrange(self.indptr[column], self.indptr[column + 1]):
+        postings[self.indices[kk]].append((position, self.data[kk]))
+    products = []
+    for row in rows:
+      rowProducts = array('d', [0.0]) * len(columns)
+      for kk in xrange(self.indptr[row], self.indptr[row + 1]):
+        value = self.data[kk]
+        for position, otherValue in postings.get(self.indices[kk], ()):
+          rowProducts[position] += value * otherValue
+      products.append(rowProducts)
+    return products
+
+class NamedEntityTable(object):
+  """
+  Interns the named entities of the clues as integer ids, shared by all
+  clues. Each clue gets its entities as a sorted array of ids and an array
+  of their counts, which can be compared without touching any dictionary.
+  """
+  def __init__(self, featureSets):
+    """
+    Constructor. Also records each clue's entities in its entity_ids and
+    entity_counts.
+
+    :param featureSets: Feature representations of the clues.
+    """
+    self.ids = {}
+    for featureRep in featureSets:
+      entries = []
+      for entity, count in featureRep.named_entities.iteritems():
+        if count == 0:
+          continue
+        if entity not in self.ids:
+          self.ids[entity] = len(self.ids)
+        entries.append((self.ids[entity], count))
+      entries.sort()
+      featureRep.entity_ids = array('l', (entityId for (entityId, _) in entries))
+      featureRep.entity_counts = array('l', (count for (_, count) in entries))
+      featureRep.entity_norm = sqrt(sum(count * count for (_, count) in entries))
+    logger.info("Interned %d named entities." % len(self.ids))
+
+  def __len__(self):
+    return len(self.ids)
+
+def mergeDot(ids1, values1, ids2, values2):
+  """
+  Computes the dot product of two sparse vectors, each given as a sorted
+  array of ids and an array of the matching values.
+  """
+  ii = 0
+  jj = 0
+  end1 = len(ids1)
+  end2 = len(ids2)
+  total = 0.0
+  while ii < end1 and jj < end2:
+    if ids1[ii] < ids2[jj]:
+      ii += 1
+    elif ids1[ii] > ids2[jj]:
+      jj += 1
+    else:
+      total += values1[ii] * values2[jj]
+      ii += 1
+      jj += 1
+  return total
+
+def synsetName(synset):
+  """Returns the name of a synset, such as 'poet.n.01'."""
+  name = synset.name
+  # Newer versions of NLTK made the name a method.
+  #
+  if callable(name):
+    name = name()
+  return name
+
+# What NLTK's similarity measures return for infinite similarity.
+JCN_INFINITY = 1e300
+
+class JcnEngine(object):
+  """
+  Computes the same JCN similarities as NLTK's jcn_similarity, but from
+  information content values and ancestor sets worked out once per synset
+  instead of on every call.
+
+  Each synset's ancestors (itself and everything up its hypernym and
+  instance hypernym paths, as NLTK's common_hypernyms uses) are kept as a
+  set of integer ids and as a tuple sorted by decreasing information
+  content. The lowest common subsumer's information content is then the
+  first ancestor of one synset that is also an ancestor of the other.
+
+  For comparing one synset with many, each ancestor also keeps the set of
+  indexed synsets below it. Walking down the first synset's ancestors, the
+  others below each one are found with one set intersection, so the lowest
+  common subsumers of the whole batch take a handful of set operations.
+  """
+  def __init__(self, ic, informationContent=None):
+    """
+    Constructor
+
+    :param ic: Information content, as loaded by wordnet_ic.
+    :param informationContent: Function giving a synset's information
+      content from ic. NLTK's information_content by default.
+    """
+    self.ic = ic
+    self.informationContent = informationContent
+    self.indexes = {}
+    self.infoContents = array('d')
+    self.ancestors = []
+    self.ancestorSets = []
+    self.nodeIds = {}
+    self.nodeInfoContents = array('d')
+    self.descendants = []
+    # Indexes of synsets with no information content, i.e. roots.
+    self.roots = set()
+
+  def index(self, synset):
+    """
+    Returns the engine's index for a synset, working out its information
+    content and ancestors the first time it is seen.
+    """
+    name = synsetName(synset)
+    if name not in self.indexes:
+      ancestors = [self._nodeId(ancestor) for ancestor in synset.common_hypernyms(synset)]
+      ancestors.sort(key=self.nodeInfoContents.__getitem__, reverse=True)
+      self.indexes[name] = len(self.ancestors)
+      for ancestor in ancestors:
+        self.descendants[ancestor].add(len(self.ancestors))
+      self.infoContents.append(self._informationContent(synset))
+      if self.infoContents[-1] == 0:
+        self.roots.add(len(self.ancestors))
+      self.ancestors.append(tuple(ancestors))
+      self.ancestorSets.append(frozenset(ancestors))
+    return self.indexes[name]
+
+  def _nodeId(self, synset):
+    """Returns the id of a synset appearing as an ancestor."""
+    name = synsetName(synset)
+    if name not in self.nodeIds:
+      self.nodeIds[name] = len(self.nodeInfoContents)
+      self.nodeInfoContents.append(self._informationContent(synset))
+      self.descendants.append(set())
+    return self.nodeIds[name]
+
+  def _informationContent(self, synset):
+    """Returns the information content of a synset."""
+    if self.informationContent is None:
+      from nltk.corpus.reader.wordnet import information_content
+      self.informationContent = information_content
+    return self.informationContent(synset, self.ic)
+
+  def similarity(self, s1, s2):
+    """Computes the JCN similarity between two synsets."""
+    return self.similarityByIndex(self.index(s1), self.index(s2))
+
+  def similarities(self, s1, synsets):
+    """
+    Computes the JCN similarities between a synset and each of a list of
+    others.
+    """
+    return self.similaritiesByIndex(self.index(s1),
+      [self.index(s2) for s2 in synsets])
+
+  def similaritiesByIndex(self, ii, others):
+    """
+    Computes the JCN similarities between an indexed synset and each of a
+    list of others, giving the same values as similarityByIndex.
+    """
+    otherSet = set(others)
+    return self._similaritiesByIndex(ii, others, otherSet,
+      self.roots.intersection(otherSet))
+
+  def _similaritiesByIndex(self, ii, others, otherSet, otherRoots):
+    """
+    similaritiesByIndex, given the set of others and the roots among them.
+    """
+    ic1 = self.infoContents[ii]
+    if ic1 == 0:
+      return [JCN_INFINITY if jj == ii else 0 for jj in others]
+    # Find twice the information content of each lowest common subsumer,
+    # walking down the ancestors of ii until every other synset is below one.
+    # Subsumers with no information content are left out, as they count
+    # for nothing.
+    #
+    subsumers = {}
+    remaining = otherSet.copy()
+    special = set(otherRoots)
+    if ii in remaining:
+      special.add(ii)
+    nodeInfoContents = self.nodeInfoContents
+    descendants = self.descendants
+    for ancestor in self.ancestors[ii]:
+      subsumerInfoContent = nodeInfoContents[ancestor]
+      if not remaining or not subsumerInfoContent:
+        break
+      below = remaining.intersection(descendants[ancestor])
+      if below:
+        subsumers.update(dict.fromkeys(below, 2 * subsumerInfoContent))
+        remaining -= below
+    # The synset itself and roots are rare, so they are left out here and
+    # patched in afterwards. Other differences are hardly ever zero.
+    #
+    for jj in special:
+      subsumers.pop(jj, None)
+    infoContents = self.infoContents
+    subsumer = subsumers.get
+    try:
+      scores = [1 / (ic1 + infoContents[jj] - subsumer(jj, 0)) for jj in others]
+    except ZeroDivisionError:
+      scores = [1 / difference if difference else JCN_INFINITY for difference in
+        [ic1 + infoContents[jj] - subsumer(jj, 0) for jj in others]]
+    for jj in special:
+      score = JCN_INFINITY if jj == ii else 0
+      position = others.index(jj)
+      while True:
+        scores[position] = score
+        try:
+          position = others.index(jj, position + 1)
+        except ValueError:
+          break
+    return scores
+
+  def bestSimilarity(self, ss1, ss2):
+    """
+    Finds the highest JCN similarity between any synset in ss1 and any
+    synset in ss2, or 0.0 if there are none.
+    """
+    others = [self.index(s2) for s2 in ss2]
+    bestScore = 0.0
+    for s1 in ss1:
+      for score in self.similaritiesByIndex(self.index(s1), others):
+        if score > bestScore:
+          bestScore = score
+    return bestScore
+
+  def bestSimilarities(self, ss1, lists):
+    """
+    Finds the bestSimilarity of ss1 with each of a list of lists of
+    synsets. Each synset in ss1 is compared with all of the lists at once.
+    """
+    return self.bestSimilaritiesByIndex([self.index(s1) for s1 in ss1],
+      [[self.index(s2) for s2 in ss2] for ss2 in lists])
+
+  def bestSimilaritiesByIndex(self, ids1, lists):
+    """
+    The same as bestSimilarities, for synsets given by their indexes.
+    """
+    others = []
+    ends = []
+    for ids2 in lists:
+      others.extend(ids2)
+      ends.append(len(others))
+    # Only the best score in each list is kept for each synset in ids1. Empty
+    # lists score zero.
+    #
+    bounds = zip([0] + ends[:-1], ends)
+    bestScores = [0.0] * len(lists)
+    otherSet = set(others)
+    otherRoots = self.roots.intersection(otherSet)
+    for ii in ids1:
+      scores = self._similaritiesByIndex(ii, others, otherSet, otherRoots)
+      bestScores = map(max, bestScores,
+        [max(scores[start:end]) if end > start else 0.0 for start, end in bounds])
+    return bestScores
+
+  def similarityByIndex(self, ii, jj):
+    """Computes the JCN similarity between two indexed synsets."""
+    if ii == jj:
+      return JCN_INFINITY
+    ic1 = self.infoContents[ii]
+    ic2 = self.infoContents[jj]
+    # Root synsets and synsets that never occurred have no similarity.
+    #
+    if ic1 == 0 or ic2 == 0:
+      return 0
+    subsumerInfoContent = 0
+    others = self.ancestorSets[jj]
+    for ancestor in self.ancestors[ii]:
+      if ancestor in others:
+        subsumerInfoContent = self.nodeInfoContents[ancestor]
+        break
+    difference = ic1 + ic2 - 2 * subsumerInfoContent
+    if difference == 0:
+      return JCN_INFINITY
+    return 1 / difference
+
+# Fingerprints of the information content files seen so far, by file name.
+_informationContentFingerprints = {}
+
+def informationContentFingerprint(information_content_filename):
+  """
+  Computes a fingerprint of an information content file: its name and, if
+  NLTK can find it, its contents. Similarities kept across runs are only
+  reused with the same fingerprint, so replacing the file invalidates them.
+
+  :param information_content_filename: The file name, as given to
+    wordnet_ic.ic.
+  :returns: A hex digest.
+  """
+  if information_content_filename not in _informationContentFingerprints:
+    digest = hashlib.sha1(information_content_filename)
+    try:
+      import nltk.data
+      path = nltk.data.find("corpora/wordnet_ic/%s" % information_content_filename)
+    except (ImportError, LookupError):
+      path = None
+    if path is not None:
+      f = path.open()
+      try:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+          digest.update(chunk)
+      finally:
+        f.close()
+    _informationContentFingerprints[information_content_filename] = \
+      digest.hexdigest()
+  return _informationContentFingerprints[information_content_filename]
+
+class SynsetSimilarityCache(object):
+  """
+  JCN similarities between pairs of synsets, kept in a file across runs and
+  processes.
+
+  The file holds a sorted array of keys (a 64 bit hash of the two synset
+  names) and an array of similarities, behind a header recording the
+  information content file used (see informationContentFingerprint). It is
+  memory mapped, so lookups only read in the pages they touch and processes
+  share them. Similarities computed since the file was opened are kept in
+  memory until flush merges them into a new file. A file made with another
+  information content file, or another version of it, is ignored and
+  replaced on the next flush.
+  """
+  MAGIC = "QBJCN001"
+  HEADER = struct.Struct("=8s40sq")
+
+  def __init__(self, filename, information_content_filename):
+    """
+    Constructor
+
+    :param filename: Path to the cache file. Need not exist yet.
+    :param information_content_filename: The information content file the
+      similarities are computed with.
+    """
+    self.filename = filename
+    self.fingerprint = informationContentFingerprint(information_content_filename)
+    self.added = {}
+    self.hits = 0
+    self.misses = 0
+    self._open()
+
+  def _open(self):
+    """Maps the existing file, if it is usable."""
+    self.file = None
+    self.buf = None
+    self.keys = []
+    self.values = []
+    if not os.path.exists(self.filename) or \
+        os.path.getsize(self.filename) < self.HEADER.size:
+      return
+    self.file = open(self.filename, "rb")
+    self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, fingerprint, count = self.HEADER.unpack_from(self.buf, 0)
+    if magic != self.MAGIC or fingerprint != self.fingerprint or \
+        len(self.buf) != self.HEADER.size + count * 16:
+      logger.info("Ignoring synset similarity cache %s." % self.filename)
+      self._close()
+      return
+    self.keys = MappedArray(self.buf, self.HEADER.size, count, 'Q')
+    self.values = MappedArray(self.buf, self.HEADER.size + count * 8, count, 'd')
+    logger.info("Mapped %d synset similarities from %s." % (count, self.filename))
+
+  def _close(self):
+    if self.buf is not None:
+      self.buf.close()
+      self.file.close()
+    self.file = None
+    self.buf = None
+    self.keys = []
+    self.values = []
+
+  def key(self, name1, name2):
+    """Returns the key for a pair of synset names, in either order."""
+    if name2 < name1:
+      name1, name2 = name2, name1
+    return struct.unpack("=Q", hashlib.sha1(name1 + " " + name2).digest()[:8])[0]
+
+  def get(self, name1, name2):
+    """
+    :returns: The stored similarity of two synsets, or None.
+    """
+    key = self.key(name1, name2)
+    value = self.added.get(key)
+    if value is None:
+      position = bisect_left(self.keys, key)
+      if position < len(self.keys) and self.keys[position] == key:
+        value = self.values[position]
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return value
+
+  def __setitem__(self, names, value):
+    self.added[self.key(*names)] = value
+
+  def __len__(self):
+    return len(self.keys) + len(self.added)
+
+  def stats(self):
+    """
+    Returns a dictionary describing how well the cache did.
+    """
+    lookups = self.hits + self.misses
+    return {"size": len(self), "hits": self.hits, "misses": self.misses,
+      "hit rate": (float(self.hits) / lookups) if lookups else 0.0}
+
+  def flush(self):
+    """
+    Writes the similarities computed so far into the file, together with
+    the ones already there, including any other processes saved since this
+    one mapped it.
+    """
+    logger.info("Synset similarity cache stats: %s" % self.stats())
+    if not self.added:
+      return
+    # Other processes may have saved their own similarities since the file
+    # was mapped, so merge with the file as it is now, and hold a lock
+    # until the new one is in place so that none are lost.
+    #
+    with open(self.filename + ".lock", "a") as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      self._close()
+      self._open()
+      merged = dict(izip(self.keys, self.values))
+      merged.update(self.added)
+      keys = sorted(merged)
+      logger.info("Saving %d synset similarities to %s." % (len(keys), self.filename))
+      with replacingFile(self.filename) as f:
+        f.write(self.HEADER.pack(self.MAGIC, self.fingerprint, len(keys)))
+        for start in xrange(0, len(keys), 4096):
+          block = keys[start:start + 4096]
+          f.write(struct.pack("=%dQ" % len(block), *block))
+        for start in xrange(0, len(keys), 4096):
+          block = [merged[key] for key in keys[start:start + 4096]]
+          f.write(struct.pack("=%dd" % len(block), *block))
+      self._close()
+    self.added = {}
+    self._open()
+
+  def close(self):
+    """Flushes the cache and unmaps the file."""
+    self.flush()
+    self._close()
+
+class RefererSimilarityTable(object):
+  """
+  Dense table of the similarities between every two distinct referer
+  strings: the sigmoid of the best JCN similarity between their noun
+  synsets. There are far fewer distinct referers than pairs of clues, so
+  comparing two clues' referers becomes a few lookups in this table.
+
+  Tables can be saved and loaded again, and grow as new referers come up.
+  """
+  def __init__(self, information_content_filename):
+    """
+    Constructor
+
+    :param information_content_filename: The information content file the
+      JCN similarities are computed with.
+    """
+    self.information_content_filename = information_content_filename
+    self.fingerprint = informationContentFingerprint(information_content_filename)
+    self.referers = []
+    self.ids = {}
+    self.values = array('d')
+
+  def build(self, featureSets, comparer):
+    """
+    Adds any referers of the given clues that are not in the table yet, and
+    records each clue's referer ids in its referer_ids. Each referer is only
+    looked up in WordNet (once) when there are new similarities to compute.
+
+    :param featureSets: Feature representations of the clues.
+    :param comparer: FeatureComparer to compute new similarities with.
+    """
+    oldSize = len(self.referers)
+    for featureRep in featureSets:
+      for referer in featureRep.referers:
+        if referer not in self.ids:
+          self.ids[referer] = len(self.referers)
+          self.referers.append(referer)
+      featureRep.referer_ids = array('l', sorted(set(
+        self.ids[referer] for referer in featureRep.referers)))
+    size = len(self.referers)
+    if size == oldSize:
+      return
+    logger.info("Computing similarities for %d new referers (%d in total)." % \
+      (size - oldSize, size))
+    synsets = [comparer.getSynsets([referer]) for referer in self.referers]
+    values = array('d', [0.0]) * (size * size)
+    for ii in xrange(oldSize):
+      values[ii * size:ii * size + oldSize] = \
+        self.values[ii * oldSize:(ii + 1) * oldSize]
+    rows = comparer.findBestSynsetDistanceRows(synsets, oldSize)
+    for ii, scores in enumerate(rows):
+      for jj, score in enumerate(scores, max(ii, oldSize)):
+        score = sigmoid(score)
+        values[ii * size + jj] = score
+        values[jj * size + ii] = score
+    self.values = values
+
+  def compare(self, ids1, ids2):
+    """
+    Compare two clues' referers given as referer ids. Gives the same result
+    as FeatureComparer.compareReferers on the referer strings.
+    """
+    size = len(self.referers)
+    values = self.values
+    bestScore = sigmoid(0.0)
+    for id1 in ids1:
+      row = id1 * size
+      for id2 in ids2:
+        if values[row + id2] > bestScore:
+          bestScore = values[row + id2]
+    return bestScore
+
+  def relatedNeighbors(self, featureSets, docIds, floor=None):
+    """
+    Finds, for each clue, the other clues with a pair of related referers:
+    ones whose similarity is above sigmoid(0), the score compare gives two
+    clues with no related referers. Needs the clues' referer ids from build.
+
+    :param featureSets: Feature representations of the clues.
+    :param docIds: Indexes of the clues to find neighbors for.
+    :param floor: Optional lowest similarity for referers to count as
+      related, e.g. from FeatureComparer.relatedRefererFloor.
+    :returns: A dictionary from each clue to the set of related clues.
+    """
+    clues = defaultdict(set)
+    for docId in docIds:
+      for refererId in featureSets[docId].referer_ids:
+        clues[refererId].add(docId)
+    size = len(self.referers)
+    values = self.values
+    unrelated = sigmoid(0.0)
+    neighbors = dict((docId, set()) for docId in docIds)
+    for id1 in clues:
+      row = id1 * size
+      related = set()
+      for id2 in clues:
+        value = values[row + id2]
+        if value > unrelated and (floor is None or value >= floor):
+          related |= clues[id2]
+      if not related:
+        continue
+      for docId in clues[id1]:
+        neighbors[docId] |= related
+    for docId in neighbors:
+      neighbors[docId].discard(docId)
+    return neighbors
+
+  def save(self, filename):
+    """ Saves the table to a file """
+    logger.info("Saving similarities of %d referers to file %s" % \
+      (len(self.referers), filename))
+    with open(filename, 'wb') as f:
+      pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+  def __len__(self):
+    return len(self.referers)
+
+def loadRefererTable(filename, information_content_filename):
+  """
+  Loads a referer similarity table from a file. Returns an empty table if
+  there is no such file or its similarities came from another information
+  content file, or another version of it.
+  """
+  if os.path.exists(filename):
+    logger.info("Loading referer similarities from file %s" % filename)
+    with open(filename, 'rb') as f:
+      table = pickle.load(f)
+    if getattr(table, "fingerprint", None) == \
+        informationContentFingerprint(information_content_filename):
+      return table
+    logger.info("Ignoring referer similarities from another information content file.")
+  return RefererSimilarityTable(information_content_filename)
+
 class FeatureComparisonResultBase(object):
   """ Result of a feature comparison (base class)"""
 
@@ -132,11 +825,18 @@ class FeatureComparisonResultBase(object):
   def normalize(self, normalizer):
     raise NotImplemented
 
+  def scale(self, factor):
+    raise NotImplemented
+
   def feature_contributions(self):
     raise NotImplemented
 
 class FeatureComparisonResult(FeatureComparisonResultBase):
   """ Result of Feature Comparison """
+  # Set on results that only bound the actual similarity (see
+  # FeatureComparer.compareWithThreshold).
+  isBound = False
+
   def __init__(self):
     self.tfidf_comparison = 0.0
     self.category_comparison = 0.0
@@ -191,6 +891,15 @@ class FeatureComparisonResult(FeatureComparisonResultBase):
     result.computeTotal()
     return result
 
+  def scale(self, factor):
+    result = FeatureComparisonResult()
+    result.tfidf_comparison = self.tfidf_comparison * factor
+    result.category_comparison = self.category_comparison * factor
+    result.referers_comparison = self.referers_comparison * factor
+    result.named_entities_comparison = self.named_entities_comparison * factor
+    result.computeTotal()
+    return result
+
 class ConstantValueFeatureComparisonResult(FeatureComparisonResultBase):
   """
   Represents a feature comparison result that involves
@@ -215,14 +924,34 @@ class FeatureComparer(object):
   """
   def __init__(self, options):
     """ Constructor """
+    self.options = options
     self.tfidf_weight = options.tf_idf_weight
     self.category_weight = options.category_weight
     self.referers_weight = options.referers_weight
     self.named_entities_weight = options.named_entities_weight
     self.information_content_filename = 'ic-bnc.dat'
-    self.ic = wordnet_ic.ic(self.information_content_filename)
+    # Loaded by the ic property the first time referers are compared.
+    self._ic = None
 
     self.synsetCache = defaultdict(float)
+    self.tfidfMatrix = None
+    self.refererTable = None
+    self.synsetSimilarityCache = None
+    self.namedEntityTable = None
+    self.useJcnEngine = (options.jcn_engine == "FAST")
+    # Set when referers have no weight and unweighted similarities are not
+    # needed, to avoid comparing them at all.
+    self.skipReferers = False
+    self.jcnEngine = None
+
+  @property
+  def ic(self):
+    """The information content used for JCN similarities."""
+    if self._ic is None:
+      from nltk.corpus import wordnet_ic
+      logger.info("Loading information content from %s" % self.information_content_filename)
+      self._ic = wordnet_ic.ic(self.information_content_filename)
+    return self._ic
 
   def compare(self, fr1, fr2):
     """
@@ -232,20 +961,243 @@ class FeatureComparer(object):
     :param fr2: Another One
     :returns: A similarity score.
     """
-    result = FeatureComparisonResult()
-    result.tfidf_comparison = self.compareTfIdfDifferences(fr1.tfidf_features, fr2.tfidf_features) * self.tfidf_weight
+    return self.weighComponents(*self.compareComponents(fr1, fr2))
+
+  def compareComponents(self, fr1, fr2, tfidf=None):
+    """
+    Compare the two feature representations without applying the weights.
+
+    :param fr1: One feature representation
+    :param fr2: Another One
+    :param tfidf: The tf-idf similarity if already known.
+    :returns: A tuple of the unweighted tf-idf, category, referers and named
+      entities similarities.
+    """
+    if tfidf is None:
+      tfidf = self.compareTfIdf(fr1, fr2)
+    category = self.compareCategories(fr1, fr2)
+    named_entities = self.compareEntities(fr1, fr2)
+    referers = self.compareRecordReferers(fr1, fr2)
+    return tfidf, category, referers, named_entities
+
+  def compareMany(self, query, candidates, tfidf=None):
+    """
+    Compare one feature representation with many others without applying
+    the weights, giving the same values as compareComponents for each pair.
+    The tf-idf similarities are found with one sparse product when all the
+    records have a row in the tf-idf matrix.
+
+    :param query: One feature representation
+    :param candidates: A list of others
+    :param tfidf: The tf-idf similarities if already known, e.g. from
+      compareBlock.
+    :returns: A tuple of arrays of the unweighted tf-idf, category,
+      referers and named entities similarities, one entry per candidate.
+    """
+    if tfidf is None:
+      if self.tfidfMatrix is not None and query.tfidf_row is not None and \
+          all(fr.tfidf_row is not None for fr in candidates):
+        tfidf = self.tfidfMatrix.dotBlock([query.tfidf_row],
+          [fr.tfidf_row for fr in candidates])[0]
+      else:
+        tfidf = array('d', (self.compareTfIdf(query, fr) for fr in candidates))
+    category = array('d', (self.compareCategories(query, fr) for fr in candidates))
+    referers = array('d', (self.compareRecordReferers(query, fr) for fr in candidates))
+    named_entities = array('d', (self.compareEntities(query, fr) for fr in candidates))
+    return tfidf, category, referers, named_entities
+
+  def compareBlock(self, rows, columns, diagonal=False):
+    """
+    Compare every feature representation in one list with every one in
+    another without applying the weights. The tf-idf similarities of the
+    whole block are found with one sparse product when all the records have
+    a row in the tf-idf matrix.
+
+    :param rows: A list of feature representations
+    :param columns: Another list
+    :param diagonal: If True, rows and columns are the same list and each
+      row is only compared with the columns after it.
+    :returns: A list holding, for each of the rows, the compareMany
+      arrays for its comparisons with the columns.
+    """
+    tfidf = [None] * len(rows)
+    if self.tfidfMatrix is not None and \
+        all(fr.tfidf_row is not None for fr in rows + columns):
+      tfidf = self.tfidfMatrix.dotBlock([fr.tfidf_row for fr in rows],
+        [fr.tfidf_row for fr in columns])
+    block = []
+    for ii, fr in enumerate(rows):
+      start = ii + 1 if diagonal else 0
+      rowTfIdf = tfidf[ii]
+      if rowTfIdf is not None:
+        rowTfIdf = rowTfIdf[start:]
+      block.append(self.compareMany(fr, columns[start:], rowTfIdf))
+    return block
+
+  def weighMany(self, tfidf, category, referers, named_entities):
+    """
+    Applies the weights to arrays of unweighted similarities from
+    compareMany.
+
+    :returns: A list of weighted similarity scores.
+    """
+    return [self.weighComponents(*components) for components in
+      izip(tfidf, category, referers, named_entities)]
+
+  def compareWithThreshold(self, fr1, fr2, threshold, exactAbove=True):
+    """
+    Compare the two feature representations, given the threshold their
+    similarity will be held against. Bounds on the components are used to
+    skip the referers, the costly part, when they can't change whether the
+    similarity reaches the threshold. The tf-idf and named entity vectors'
+    norms bound their similarities, so when even that can't reach the
+    threshold nothing is compared at all.
+
+    When comparisons are skipped, the result has isBound set and the
+    skipped components set to their bounds: the highest possible values if
+    the pair falls short of the threshold, or the lowest ones if it
+    reaches it for sure.
+
+    :param fr1: One feature representation
+    :param fr2: Another One
+    :param threshold: The similarity threshold.
+    :param exactAbove: If True, pairs that reach the threshold are always
+      compared exactly (clusterers need their actual scores), so only
+      pairs falling short are bounded.
+    :returns: A similarity score, possibly a bound.
+    """
+    category = self.compareCategories(fr1, fr2)
+    referersRange = (0.0, 0.0)
+    if not self.skipReferers:
+      referersRange = weightedRange(sigmoid(0.0), 1.0, self.referers_weight)
+    if None not in (fr1.tfidf_norm, fr2.tfidf_norm, fr1.entity_norm, fr2.entity_norm):
+      result = FeatureComparisonResult()
+      result.tfidf_comparison = weightedRange(0.0,
+        fr1.tfidf_norm * fr2.tfidf_norm * NORM_BOUND_SLACK, self.tfidf_weight)[1]
+      result.category_comparison = category * self.category_weight
+      result.referers_comparison = referersRange[1]
+      result.named_entities_comparison = weightedRange(0.0,
+        fr1.entity_norm * fr2.entity_norm * NORM_BOUND_SLACK,
+        self.named_entities_weight)[1]
+      result.computeTotal()
+      if result.total() < threshold:
+        result.isBound = True
+        return result
+    result = self.weighComponents(self.compareTfIdf(fr1, fr2), category, 0.0,
+      self.compareEntities(fr1, fr2))
+    result.referers_comparison = referersRange[1]
+    result.computeTotal()
+    if result.total() < threshold:
+      result.isBound = True
+      return result
+    if not exactAbove:
+      result.referers_comparison = referersRange[0]
+      result.computeTotal()
+      if result.total() >= threshold:
+        result.isBound = True
+        return result
+    result.referers_comparison = self.compareRecordReferers(fr1, fr2) * self.referers_weight
+    result.computeTotal()
+    return result
+
+  def compareTfIdf(self, fr1, fr2):
+    """
+    Compare the tf-idf features of two feature representations, through
+    the tf-idf matrix if both have a row in it.
+    """
+    if self.tfidfMatrix is not None and fr1.tfidf_row is not None and \
+        fr2.tfidf_row is not None:
+      return self.tfidfMatrix.dot(fr1.tfidf_row, fr2.tfidf_row)
+    return self.compareTfIdfDifferences(fr1.tfidf_features, fr2.tfidf_features)
+
+  def compareCategories(self, fr1, fr2):
+    """
+    Compare the categories of two feature representations.
+    """
+    category = 0.0
     if fr1.category == fr1.category:
-      result.category_comparison = self.category_weight
-    result.named_entities_comparison = self.compareNamedEntities(fr1.named_entities, fr2.named_entities) * self.named_entities_weight
-    result.referers_comparison = self.compareReferers(fr1.referers, fr2.referers) * self.referers_weight
+      category = 1.0
+    return category
+
+  def compareEntities(self, fr1, fr2):
+    """
+    Compare the named entities of two feature representations, by their
+    interned ids if both have them.
+    """
+    if self.namedEntityTable is not None and fr1.entity_ids is not None and \
+        fr2.entity_ids is not None:
+      return mergeDot(fr1.entity_ids, fr1.entity_counts,
+        fr2.entity_ids, fr2.entity_counts)
+    return self.compareNamedEntities(fr1.named_entities, fr2.named_entities)
+
+  def compareRecordReferers(self, fr1, fr2):
+    """
+    Compare the referers of two feature representations, in the fastest
+    way both support.
+    """
+    if self.skipReferers:
+      return 0.0
+    if self.refererTable is not None and fr1.referer_ids is not None and \
+        fr2.referer_ids is not None:
+      return self.refererTable.compare(fr1.referer_ids, fr2.referer_ids)
+    return self.compareReferers(fr1.referers, fr2.referers)
+
+  def weighComponents(self, tfidf, category, referers, named_entities):
+    """
+    Applies the weights to unweighted similarities from compareComponents.
+
+    :returns: The weighted similarity score.
+    """
+    result = FeatureComparisonResult()
+    result.tfidf_comparison = tfidf * self.tfidf_weight
+    result.category_comparison = category * self.category_weight
+    result.referers_comparison = referers * self.referers_weight
+    result.named_entities_comparison = named_entities * self.named_entities_weight
+    result.computeTotal()
+    return result
+
+  def nonOverlappingResult(self):
+    """
+    Returns the result of comparing two clues that share no tf-idf feature
+    and no named entity, when none of their referers are related (which is
+    always the case if either clue has no referers).
+    """
+    result = FeatureComparisonResult()
+    result.category_comparison = self.category_weight
+    result.referers_comparison = sigmoid(0.0) * self.referers_weight
     result.computeTotal()
     return result
 
+  def relatedRefererFloor(self, threshold):
+    """
+    Finds how similar the referers of two clues that share no tf-idf feature
+    and no named entity must be for the pair to reach a threshold. Related
+    referers are the only way such a pair can score above
+    nonOverlappingResult.
+
+    :param threshold: The similarity threshold.
+    :returns: The lowest referer similarity that can reach the threshold, or
+      None if no such pair can reach it with better referers than
+      nonOverlappingResult assumes.
+    """
+    if self.skipReferers or self.referers_weight <= 0:
+      return None
+    best = FeatureComparisonResult()
+    best.category_comparison = weightedRange(0.0, 1.0, self.category_weight)[1]
+    best.referers_comparison = self.referers_weight
+    best.computeTotal()
+    if best.total() < threshold:
+      return None
+    # Scaled down a little so that rounding can only let more pairs in.
+    #
+    return (threshold - best.category_comparison) / self.referers_weight / \
+      NORM_BOUND_SLACK
+
   def getSynsets(self, referers):
     """ Get all noun synsets for referers """
     synsets = []
     for referer in referers:
-      synsets.extend(wn.synsets(referer, pos=wn.NOUN))
+      synsets.extend(wordnet().synsets(referer, pos=wordnet().NOUN))
     return synsets
 
   def getSynsetSimilarity(self, s1, s2):
@@ -257,15 +1209,58 @@ class FeatureComparer(object):
     if (s1,s2) in self.synsetCache:
       return self.synsetCache[(s1,s2)]
     else:
-      score = s1.jcn_similarity(s2, self.ic)
+      score = self.jcnSimilarity(s1, s2)
       self.synsetCache[(s1,s2)] = score
       return score
 
+  def jcnSimilarity(self, s1, s2):
+    """
+    Computes the JCN similarity between two synsets, or looks it up in the
+    synset similarity cache if there is one.
+    """
+    if self.synsetSimilarityCache is None:
+      return self.computeJcnSimilarity(s1, s2)
+    names = (synsetName(s1), synsetName(s2))
+    score = self.synsetSimilarityCache.get(*names)
+    if score is None:
+      score = self.computeJcnSimilarity(s1, s2)
+      self.synsetSimilarityCache[names] = score
+    return score
+
+  def computeJcnSimilarity(self, s1, s2):
+    """
+    Computes the JCN similarity between two synsets with the JCN engine
+    chosen in the options.
+    """
+    if self.useJcnEngine:
+      return self.getJcnEngine().similarity(s1, s2)
+    return s1.jcn_similarity(s2, self.ic)
+
+  def getJcnEngine(self):
+    """Returns the JCN engine, making it the first time."""
+    if self.jcnEngine is None:
+      self.jcnEngine = JcnEngine(self.ic)
+    return self.jcnEngine
+
+  def setSynsetSimilarityCache(self, synsetSimilarityCache):
+    """
+    Looks up and stores JCN similarities in the given cache from now on.
+
+    :param synsetSimilarityCache: A SynsetSimilarityCache.
+    """
+    self.synsetSimilarityCache = synsetSimilarityCache
+
   def findBestSynsetDistance(self, ss1, ss2):
     """
     Finds the minimum distance between any synset in ss1 and
     any synset in ss2.
     """
+    # The engine is cheap enough to skip the in-memory cache, but the
+    # similarities go through the synset similarity cache when there is one
+    # so that it fills up for later runs.
+    #
+    if self.useJcnEngine and self.synsetSimilarityCache is None:
+      return self.getJcnEngine().bestSimilarity(ss1, ss2)
     bestScore = 0.0
     for s1 in ss1:
       for s2 in ss2:
@@ -274,6 +1269,25 @@ class FeatureComparer(object):
           bestScore = score
     return bestScore
 
+  def findBestSynsetDistanceRows(self, synsets, start=0):
+    """
+    Finds the findBestSynsetDistance between every two of a list of lists of
+    synsets, one row at a time: row ii holds the distances from list ii to
+    each list from max(ii, start) on.
+
+    :param synsets: A list of lists of synsets.
+    :param start: Index of the first list whose distances are needed.
+    """
+    if self.useJcnEngine and self.synsetSimilarityCache is None:
+      engine = self.getJcnEngine()
+      ids = [[engine.index(synset) for synset in ss] for ss in synsets]
+      for ii in xrange(len(synsets)):
+        yield engine.bestSimilaritiesByIndex(ids[ii], ids[max(ii, start):])
+    else:
+      for ii in xrange(len(synsets)):
+        yield [self.findBestSynsetDistance(synsets[ii], ss2)
+          for ss2 in synsets[max(ii, start):]]
+
   def compareReferers(self, r1, r2):
     """
     Compare two referers.
@@ -285,6 +1299,15 @@ class FeatureComparer(object):
     r2synsets = self.getSynsets(r2)
     return sigmoid(self.findBestSynsetDistance(r1synsets, r2synsets))
     
+  def setRefererTable(self, refererTable):
+    """
+    Compares referers by looking them up in the given table from now on,
+    for the feature representations that have referer ids.
+
+    :param refererTable: A RefererSimilarityTable.
+    """
+    self.refererTable = refererTable
+
   def compareNamedEntities(self, ne1, ne2):
     """
     Compare two entity sets. Each is represented as a
@@ -295,9 +1318,30 @@ class FeatureComparer(object):
     """
     score = 0.0
     for k1 in ne1:
-      score += ne1[k1] * ne2[k1]
+      # Don't index ne2 directly, which would add k1 to it if it's a
+      # defaultdict.
+      #
+      score += ne1[k1] * ne2.get(k1, 0)
     return score
 
+  def setNamedEntityTable(self, namedEntityTable):
+    """
+    Compares named entities by their interned ids from now on, for the
+    feature representations that have them.
+
+    :param namedEntityTable: A NamedEntityTable.
+    """
+    self.namedEntityTable = namedEntityTable
+
+  def setTfIdfMatrix(self, tfidfMatrix):
+    """
+    Compares tf-idf features with the given matrix from now on, for the
+    feature representations that have a row in it.
+
+    :param tfidfMatrix: A TfIdfMatrix.
+    """
+    self.tfidfMatrix = tfidfMatrix
+
   def compareTfIdfDifferences(self, q1features, q2features):
     """
     A feature based similarity function between two questions
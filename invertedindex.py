@@ -2,17 +2,69 @@
 # Inverted Index Class
 
 import math
-from nltk.probability import ConditionalFreqDist, FreqDist
-from nltk.corpus import stopwords
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
-from qbcommon import expand_frequencies
+import hashlib
+import heapq
+from itertools import izip
+import mmap
+import os
+import struct
+from qbcommon import expand_frequencies, MappedArray, replacingFile, \
+  writeMappedArray
 import extract_db
 
 import logging
 logger = logging.getLogger("InvertedIndex")
 
-stopwords_EN = set(stopwords.words('english'))
-stopwords_EN = stopwords_EN.union(extract_db.QB_STOP)
+# Sums of per-term score bounds are scaled up by this much before documents
+# are pruned with them, since the real score is summed in a different order
+# and can come out a little larger through rounding.
+SCORE_BOUND_SLACK = 1.0 + 1e-9
+
+# A postings list is searched for each candidate document rather than
+# walked once it is this many times longer than the list of candidates.
+BISECT_RATIO = 8
+
+# The number of rows of the score matrix computed at a time by scoreRows.
+SCORE_CHUNK_SIZE = 1000
+
+# Stopwords, loaded from NLTK by englishStopwords the first time they are
+# needed.
+_stopwords = None
+
+def englishStopwords():
+  """
+  Returns the NLTK English stopwords plus our own quiz bowl stopwords.
+  """
+  global _stopwords
+  if _stopwords is None:
+    from nltk.corpus import stopwords
+    _stopwords = set(stopwords.words('english')).union(extract_db.QB_STOP)
+  return _stopwords
+
+# Version of the documents questionDocument makes. Change it whenever they
+# change, e.g. through tokenization or featurization, so that indexes saved
+# by cachedInvertedIndex under a questions file's fingerprint are rebuilt.
+DOCUMENT_VERSION = 1
+
+def questionDocument(question, useNamedEntities=False):
+  """
+  Gets the document to index for a question.
+
+  :param question: A question object.
+  :param useNamedEntities: If true, the document is made of the question's
+    named entities rather than its features.
+  :returns: A list of terms.
+  """
+  if useNamedEntities:
+    # Get named entities.
+    #
+    return expand_frequencies(question.named_entities)
+  # Get features.
+  #
+  return [feat for (i1,feat) in question.features()]
 
 def buildInvertedIndex(questions, useNamedEntities=False):
   """
@@ -28,44 +80,203 @@ def buildInvertedIndex(questions, useNamedEntities=False):
   index = InvertedIndex()
   i0 = 0
   for question in questions:
-    doc = None
-    if useNamedEntities:
-      # Get named entities.
-      #
-      doc = expand_frequencies(question.named_entities)
-    else:
-      # Get features.
-      #
-      doc = [feat for (i1,feat) in question.features()]
-    docId = index.addDocument(doc)
+    docId = index.addDocument(questionDocument(question, useNamedEntities))
     assert(docId == i0)
     i0 += 1
+  logger.info("Inverted index has %d documents, %d terms and %d postings in %d bytes." % \
+    (index.num_docs, index.vocab_length, len(index.docTerms), index.memoryUsage()))
+  return index
+
+def extendInvertedIndex(index, questions, useNamedEntities=False):
+  """
+  Merges a batch of new questions into an index built by
+  buildInvertedIndex, updating only the postings of the terms they use.
+
+  :param index: The inverted index.
+  :param questions: A list of new question objects.
+  :param useNamedEntities: Whether the index is over named entities.
+  :returns: The document IDs given to the questions, in order.
+  """
+  docIds = index.addDocuments([questionDocument(question, useNamedEntities)
+    for question in questions])
+  logger.info("Added %d documents to the inverted index, which now has %d." % \
+    (len(docIds), index.num_live_docs))
+  return docIds
+
+def indexFingerprint(questions, useNamedEntities=False):
+  """
+  Computes a fingerprint of the questions an inverted index is built from:
+  which questions they are and the terms of their documents.
+
+  :param questions: The questions, in order.
+  :param useNamedEntities: Whether the index is over named entities.
+  :returns: A hex digest.
+  """
+  digest = hashlib.sha1(repr(useNamedEntities))
+  for question in questions:
+    counts = defaultdict(int)
+    for term in questionDocument(question, useNamedEntities):
+      counts[term] += 1
+    digest.update(repr((question.id, sorted(counts.items()))))
+  return digest.hexdigest()
+
+def questionsFileFingerprint(questions, questionsFile, useNamedEntities=False):
+  """
+  Computes a fingerprint of the questions an inverted index is built from,
+  given the file they were loaded from: which questions they are, the
+  file's path, size and modification time, and DOCUMENT_VERSION. This is
+  much cheaper than indexFingerprint, as no document is looked at.
+
+  :param questions: The questions, in order.
+  :param questionsFile: Path to the file the questions were loaded from.
+  :param useNamedEntities: Whether the index is over named entities.
+  :returns: A hex digest, or None if the file can't be looked at.
+  """
+  try:
+    stat = os.stat(questionsFile)
+  except OSError:
+    return None
+  digest = hashlib.sha1(repr((DOCUMENT_VERSION, useNamedEntities,
+    os.path.abspath(questionsFile), stat.st_size, stat.st_mtime)))
+  for question in questions:
+    digest.update(repr(question.id))
+  return digest.hexdigest()
+
+def cachedInvertedIndex(filename, questions, useNamedEntities=False,
+    questionsFile=None):
+  """
+  Opens the inverted index saved in a file, if it was built from the same
+  questions. Otherwise builds the index and saves it there for next time.
+
+  :param filename: Path to the index file. Need not exist yet.
+  :param questions: A list of question objects.
+  :param useNamedEntities: Whether to index named entities rather than
+    features, as for buildInvertedIndex.
+  :param questionsFile: Optional path to the file the questions were loaded
+    from. If given, the saved index is checked against the file's identity
+    (see questionsFileFingerprint) instead of every question's terms.
+  :returns: An inverted index.
+  """
+  fingerprint = None
+  if questionsFile is not None:
+    fingerprint = questionsFileFingerprint(questions, questionsFile,
+      useNamedEntities)
+  if fingerprint is None:
+    fingerprint = indexFingerprint(questions, useNamedEntities)
+  if os.path.exists(filename):
+    try:
+      index = MappedInvertedIndex(filename)
+      if index.fingerprint == fingerprint:
+        return index
+      index.close()
+    except ValueError:
+      pass
+    logger.info("Ignoring out of date inverted index %s." % filename)
+  index = buildInvertedIndex(questions, useNamedEntities)
+  index.save(filename, fingerprint)
   return index
 
+def sharedTermNeighbors(indexes, docIds):
+  """
+  Finds, for each document, the other documents that share at least one
+  term with it in any of the given indexes. Pairs of documents that are
+  not neighbors have nothing in common as far as these indexes can tell.
+
+  :param indexes: A list of inverted indexes over the same documents.
+  :param docIds: IDs of the documents to find neighbors for.
+  :returns: A dictionary from document IDs to sets of neighboring IDs.
+  """
+  logger.info("Finding documents with shared terms for %d documents." % len(docIds))
+  neighbors = {}
+  numPairs = 0
+  for docId in docIds:
+    docNeighbors = set()
+    for index in indexes:
+      docNeighbors |= index.neighbors(docId)
+    neighbors[docId] = docNeighbors
+    numPairs += len(docNeighbors)
+  logger.info("Found %d pairs of documents with shared terms." % (numPairs / 2))
+  return neighbors
+
+def scoredNeighbors(index, threshold, chunkSize=SCORE_CHUNK_SIZE):
+  """
+  Finds, for each document, the documents scoring strictly above a
+  threshold against it, from one batched self-join of the index.
+
+  :param index: An inverted index.
+  :param threshold: The score to beat.
+  :param chunkSize: The number of documents scored at a time.
+  :returns: A dictionary from each document ID to a dictionary from the
+    IDs of the other documents to their scores against it. Each score is
+    the one the other document's own scores give it.
+  """
+  logger.info("Scoring all pairs of %d documents above %s." % (index.num_docs, threshold))
+  neighbors = dict((docId, {}) for docId in xrange(index.num_docs))
+  numPairs = 0
+  for first, indptr, columns, values in index.scoreRows(threshold, chunkSize):
+    for ii in xrange(len(indptr) - 1):
+      docId = first + ii
+      for position in xrange(indptr[ii], indptr[ii + 1]):
+        neighbors[columns[position]][docId] = values[position]
+    numPairs += len(columns)
+  logger.info("Found %d scores above %s." % (numPairs, threshold))
+  return neighbors
+
 class InvertedIndex(object):
   """
   A class for an inverted index that tracks both the frequency
   with which terms appear, and the frequency with which each term
   appears across all documents.
+
+  Everything is kept in flat arrays. Each document's terms are stored
+  as a forward CSR row (sorted term IDs and float32 frequencies), appended
+  as documents are added. The postings for each term (sorted document IDs
+  and float32 frequencies) form a second CSR structure that is built from
+  the forward rows in one pass, the first time a query needs it.
+
+  Documents can be added and removed after that. Only the postings of the
+  terms they contain are touched: each is copied out of the flat arrays
+  into arrays of its own the first time it changes. Document frequencies
+  are the lengths of the postings and IDFs are worked out from them when
+  needed, so both are always current. compact folds the changes back into
+  flat arrays.
   """
   def __init__(self):
     """Constructor"""
-    # The term frequencies are conditioned on the document ID.
+    # Forward rows: the terms of document d are
+    # docTerms[docIndptr[d]:docIndptr[d + 1]], with their frequencies at the
+    # same positions of docFreqs.
+    #
+    self.docIndptr = array('l', [0])
+    self.docTerms = array('i')
+    self.docFreqs = array('f')
+
+    # Postings: the documents containing term t are
+    # postingDocs[termIndptr[t]:termIndptr[t + 1]], with the term's
+    # frequencies in them at the same positions of postingFreqs. Built by
+    # _buildPostings.
+    #
+    self.termIndptr = None
+    self.postingDocs = None
+    self.postingFreqs = None
+
+    # Postings of the terms that have changed since they were built, as
+    # (documents, frequencies) pairs of arrays.
     #
-    self.termFrequencies = ConditionalFreqDist()
+    self._changedPostings = {}
 
-    # Hash structure to look up all the document IDs a term appears in.
+    # Every document ID handed out is below num_docs. IDs of removed
+    # documents aren't reused.
     #
-    self.termsToDocuments = defaultdict(set)
     self.num_docs = 0
+    self.num_live_docs = 0
+    self.removedDocs = set()
     
     # Vocab mapping words to numbers
     #
     self.vocab = {}
     self.vocab_length = 0
 
-    self._idf = None
-
   def _getTermId(self,term):
     """
     Get integer for given term
@@ -89,7 +300,7 @@ class InvertedIndex(object):
     :param term: A candidate term
     :return: True to include in the index, false to exclude
     """
-    #return term.lower() not in stopwords_EN and len(term) > 3
+    #return term.lower() not in englishStopwords() and len(term) > 3
     return True
 
   def _newDocumentId(self):
@@ -98,8 +309,88 @@ class InvertedIndex(object):
     """
     newId = self.num_docs
     self.num_docs += 1
+    self.num_live_docs += 1
     return newId
 
+  def _buildPostings(self):
+    """
+    Builds the postings arrays from the forward rows of the documents that
+    haven't been removed with a counting sort.
+    """
+    numTerms = self.vocab_length
+    counts = array('l', [0]) * (numTerms + 1)
+    for docId in xrange(self.num_docs):
+      start, end = self._documentRange(docId)
+      for termid in self.docTerms[start:end]:
+        counts[termid + 1] += 1
+    for termid in xrange(numTerms):
+      counts[termid + 1] += counts[termid]
+    self.termIndptr = counts
+    numPostings = counts[numTerms]
+    self.postingDocs = array('i', [0]) * numPostings
+    self.postingFreqs = array('f', [0.0]) * numPostings
+    self._changedPostings = {}
+    nextSlot = array('l', counts[:numTerms])
+    for docId in xrange(self.num_docs):
+      start, end = self._documentRange(docId)
+      for position in xrange(start, end):
+        termid = self.docTerms[position]
+        slot = nextSlot[termid]
+        self.postingDocs[slot] = docId
+        self.postingFreqs[slot] = self.docFreqs[position]
+        nextSlot[termid] = slot + 1
+
+  def _postings(self):
+    """
+    Makes sure the postings are up to date with the added documents.
+    """
+    if self.termIndptr is None:
+      self._buildPostings()
+
+  def _termPostings(self, termid):
+    """
+    Finds the postings of a term.
+
+    :param termid: A term ID.
+    :returns: A tuple (documents, frequencies, start, end): the term's
+      documents are documents[start:end] in increasing order, with its
+      frequencies in them at the same positions of frequencies.
+    """
+    changed = self._changedPostings.get(termid)
+    if changed is not None:
+      return changed[0], changed[1], 0, len(changed[0])
+    if termid + 1 >= len(self.termIndptr):
+      # A term that was new after the postings were built.
+      #
+      return self.postingDocs, self.postingFreqs, 0, 0
+    return self.postingDocs, self.postingFreqs, \
+      self.termIndptr[termid], self.termIndptr[termid + 1]
+
+  def _changeablePostings(self, termid):
+    """
+    Gets the postings of a term as arrays of its own, so they can be changed.
+
+    :param termid: A term ID.
+    :returns: A (documents, frequencies) pair of arrays.
+    """
+    if termid not in self._changedPostings:
+      docs, freqs, start, end = self._termPostings(termid)
+      self._changedPostings[termid] = (array('i', docs[start:end]),
+        array('f', freqs[start:end]))
+    return self._changedPostings[termid]
+
+  def _documentRange(self, docId):
+    """
+    Finds where a document's forward row lives.
+
+    :param docId: A document ID.
+    :returns: The start and end positions of the row, empty for unknown
+      or removed documents.
+    """
+    if docId < 0 or docId >= self.num_docs or docId in self.removedDocs:
+      return 0, 0
+    return self.docIndptr[docId], self.docIndptr[docId + 1]
+
   def documentFrequency(self, term):
     """
     Return the number of documents the given term appears in.
@@ -107,8 +398,12 @@ class InvertedIndex(object):
     :param term: A term.
     :returns: The number of documents this term has been seen in.
     """
-    termid = self._getTermId(term)
-    return len(self.termsToDocuments[termid])
+    termid = self.vocab.get(term)
+    if termid is None:
+      return 0
+    self._postings()
+    docs, freqs, start, end = self._termPostings(termid)
+    return end - start
 
   def termFrequency(self, term, docId):
     """
@@ -119,8 +414,14 @@ class InvertedIndex(object):
     :param docId: A document ID
     :returns: The term frequency in this document.
     """
-    termid = self._getTermId(term)
-    return self.termFrequencies[docId][termid]
+    termid = self.vocab.get(term)
+    if termid is None:
+      return 0
+    start, end = self._documentRange(docId)
+    position = bisect_left(self.docTerms, termid, start, end)
+    if position < end and self.docTerms[position] == termid:
+      return self.docFreqs[position]
+    return 0
 
   def addDocument(self, document):
     """
@@ -138,31 +439,117 @@ class InvertedIndex(object):
     #
     document = [term.lower() for term in document if self.filterTerm(term)]
     doclen = len(document)
+    frequencies = defaultdict(float)
     for term in document:
-      termid = self._getTermId(term)
-      self.termFrequencies[docId].inc(termid, 1.0/doclen)
-      self.termsToDocuments[termid].add(docId)
+      frequencies[self._getTermId(term)] += 1.0/doclen
+    for termid in sorted(frequencies):
+      self.docTerms.append(termid)
+      self.docFreqs.append(frequencies[termid])
+      if self.termIndptr is not None:
+        # The new ID is the biggest, so it goes at the end of the postings.
+        #
+        docs, freqs = self._changeablePostings(termid)
+        docs.append(docId)
+        freqs.append(self.docFreqs[-1])
+    self.docIndptr.append(len(self.docTerms))
     # Return the ID to the caller.
     #
     return docId
 
-  def _computeIdfs(self):
+  def addDocuments(self, documents):
+    """
+    Adds a batch of documents to the index.
+
+    :param documents: A list of documents, as for addDocument.
+    :returns: The IDs given to the documents, in order.
     """
-    Compute the inverse document frequency for each term.
+    return [self.addDocument(document) for document in documents]
+
+  def removeDocument(self, docId):
+    """
+    Removes a document from the index. Its ID is not reused.
+
+    :param docId: ID of the document to remove.
     """
-    self._idf = defaultdict(float)
-    for termid in self.vocab.itervalues():
-      self._idf[termid] = math.log(self.num_docs / len(self.termsToDocuments[termid]))
+    start, end = self._documentRange(docId)
+    if docId < 0 or docId >= self.num_docs or docId in self.removedDocs:
+      raise ValueError("No document with ID %s in the index." % repr(docId))
+    if self.termIndptr is not None:
+      for termid in self.docTerms[start:end]:
+        docs, freqs = self._changeablePostings(termid)
+        slot = bisect_left(docs, docId)
+        del docs[slot]
+        del freqs[slot]
+    self.removedDocs.add(docId)
+    self.num_live_docs -= 1
+
+  def compact(self):
+    """
+    Folds the changed postings back into flat arrays and drops the forward
+    rows of removed documents. This takes time in proportion to the whole
+    index, so it's best done after a lot of changes.
+    """
+    docIndptr = array('l', [0])
+    docTerms = array('i')
+    docFreqs = array('f')
+    for docId in xrange(self.num_docs):
+      start, end = self._documentRange(docId)
+      docTerms.extend(self.docTerms[start:end])
+      docFreqs.extend(self.docFreqs[start:end])
+      docIndptr.append(len(docTerms))
+    self.docIndptr = docIndptr
+    self.docTerms = docTerms
+    self.docFreqs = docFreqs
+    self._buildPostings()
+
+  def _inverseDocumentFrequency(self, termid):
+    """
+    Works out the inverse document frequency of a term from its postings.
+
+    :param termid: A term ID.
+    """
+    docs, freqs, start, end = self._termPostings(termid)
+    if start == end:
+      return 0.0
+    return math.log(self.num_live_docs / (end - start))
 
   def inverseDocumentFrequency(self,term):
     """
     Gets inverse document frequency of the given term
     """
-    if not self._idf:
-      self._computeIdfs()
-    termid = self._getTermId(term)
-    return self._idf[termid]
+    termid = self.vocab.get(term)
+    if termid is None:
+      return 0.0
+    self._postings()
+    return self._inverseDocumentFrequency(termid)
     
+  def _queryTerms(self, docId):
+    """
+    Finds what each term of a document contributes to its score against
+    any other document containing the term.
+
+    :param docId: ID of the query document.
+    :returns: A list of (term ID, contribution) pairs, biggest contribution
+      first. Scores are always added up in this order, so every way of
+      computing them gives identical results.
+    """
+    self._postings()
+    terms = []
+    start, end = self._documentRange(docId)
+    for termid, freq in izip(self.docTerms[start:end], self.docFreqs[start:end]):
+      # Find the frequency with which this term appears in other documents.
+      #
+      inverseDocumentFrequency = self._inverseDocumentFrequency(termid)
+      # Find the term frequency of the term in the other document. 
+      #
+      otherFreq = freq
+      # Score proportional to product of frequencies times the inverse of
+      # the document frequency.
+      #
+      terms.append((termid, freq * otherFreq * inverseDocumentFrequency))
+    terms.sort(key=lambda (termid, value): (-value, termid))
+    return terms
+
   def scores(self, docId):
     """
     Return the score from the given document to every other
@@ -170,31 +557,256 @@ class InvertedIndex(object):
     to have no similarity detected by shared terms.
 
     :param docId: ID of doc to compare other docs to.
-    :returns: A list of tuples of (document ID, similarity score).
+    :returns: A dictionary from document IDs to similarity scores.
       Larger scores are better.
     """
-    if not self._idf:
-      self._computeIdfs()
     # Track the scores
     #
-    docScores = FreqDist()
-    for termid, freq in self.termFrequencies[docId].iteritems():
-      # Find the frequency with which this term appears in other documents.
-      #
-      inverseDocumentFrequency = self._idf[termid]
-      for otherDocId in self.termsToDocuments[termid]:
+    docScores = {}
+    for termid, value in self._queryTerms(docId):
+      postingDocs, postingFreqs, start, end = self._termPostings(termid)
+      for otherDocId in postingDocs[start:end]:
         if otherDocId == docId:
           # Skip this document
           continue
-        # Find the term frequency of the term in the other document. 
+        docScores[otherDocId] = docScores.get(otherDocId, 0.0) + value
+
+    return docScores
+
+  def _remainingBounds(self, terms):
+    """
+    Bounds what the query terms can add to a score from each term on.
+
+    :param terms: The query terms, as returned by _queryTerms.
+    :returns: A list whose ii-th entry bounds the sum of the contributions
+      of terms ii onwards, ending with zero.
+    """
+    remaining = [0.0] * (len(terms) + 1)
+    for ii in xrange(len(terms) - 1, -1, -1):
+      remaining[ii] = remaining[ii + 1] + terms[ii][1]
+    return [bound * SCORE_BOUND_SLACK for bound in remaining]
+
+  def _maxScore(self, docId, threshold, k=None):
+    """
+    Finds the documents that may score above a threshold against the given
+    one, using MaxScore pruning.
+
+    Once the smallest contributing terms can't add up to more than the
+    threshold between them, a document containing none of the other terms
+    can never clear it. The postings lists of those "non-essential" terms
+    (typically the long ones of common terms, with low IDFs) are not walked;
+    the documents found in the essential lists are looked up in them
+    instead, and dropped as soon as they can no longer clear the threshold.
+
+    :param docId: ID of the query document.
+    :param threshold: Scores must be strictly greater than this.
+    :param k: If given, the threshold rises to the k-th best partial score
+      as the essential lists are walked, which is a lower bound on the k-th
+      best score.
+    :returns: A dictionary from the documents that may clear the threshold
+      to their scores.
+    """
+    terms = self._queryTerms(docId)
+    remaining = self._remainingBounds(terms)
+    # Once k documents have been seen this becomes the k-th best partial
+    # score. Ties with it are kept, since they may win on document ID.
+    #
+    cutoff = None
+    if k is None:
+      canClear = lambda bound: bound > threshold
+    else:
+      canClear = lambda bound: bound > threshold and \
+        (cutoff is None or bound >= cutoff)
+
+    docScores = {}
+    ii = 0
+    while ii < len(terms) and canClear(remaining[ii]):
+      # New documents can still make it, so walk the whole list.
+      #
+      termid, value = terms[ii]
+      postingDocs, postingFreqs, start, end = self._termPostings(termid)
+      for otherDocId in postingDocs[start:end]:
+        docScores[otherDocId] = docScores.get(otherDocId, 0.0) + value
+      docScores.pop(docId, None)
+      if k is not None and len(docScores) >= k:
+        cutoff = heapq.nlargest(k, docScores.itervalues())[-1]
+      ii += 1
+
+    # Only the documents seen so far can make it.
+    #
+    for ii in xrange(ii, len(terms)):
+      termid, value = terms[ii]
+      postingDocs, postingFreqs, start, end = self._termPostings(termid)
+      if end - start > BISECT_RATIO * len(docScores):
+        # Look the documents up in the list, unless they can't make it.
         #
-        otherFreq = self.termFrequencies[docId][termid]
-        # Score proportional to product of frequencies times the inverse of
-        # the document frequency.
+        for otherDocId in docScores.keys():
+          if not canClear(docScores[otherDocId] * SCORE_BOUND_SLACK + remaining[ii]):
+            del docScores[otherDocId]
+            continue
+          slot = bisect_left(postingDocs, otherDocId, start, end)
+          if slot < end and postingDocs[slot] == otherDocId:
+            docScores[otherDocId] += value
+      else:
+        for otherDocId in postingDocs[start:end]:
+          if otherDocId in docScores:
+            docScores[otherDocId] += value
+    return docScores
+
+  def scores_above(self, docId, threshold):
+    """
+    Return the scores from the given document to the other documents
+    scoring strictly above a threshold. The scores are the same as those
+    from scores, but postings that can't lift a document over the
+    threshold are skipped.
+
+    :param docId: ID of doc to compare other docs to.
+    :param threshold: The score to beat.
+    :returns: A dictionary from document IDs to similarity scores.
+    """
+    return dict((otherDocId, score) for (otherDocId, score) in
+      self._maxScore(docId, threshold).iteritems() if score > threshold)
+
+  def top_k(self, docId, k, threshold=None):
+    """
+    Return the k best scoring other documents for the given document,
+    with the same pruning as scores_above.
+
+    :param docId: ID of doc to compare other docs to.
+    :param k: How many documents to return.
+    :param threshold: If given, only documents scoring strictly above it
+      are returned.
+    :returns: A list of (document ID, similarity score) pairs, best first.
+      Equal scores are ordered by document ID.
+    """
+    if k <= 0:
+      return []
+    if threshold is None:
+      threshold = float("-inf")
+    best = [(otherDocId, score) for (otherDocId, score) in
+      self._maxScore(docId, threshold, k).iteritems() if score > threshold]
+    best.sort(key=lambda (otherDocId, score): (-score, otherDocId))
+    return best[:k]
+
+  def scoreRows(self, threshold=None, chunkSize=SCORE_CHUNK_SIZE):
+    """
+    Scores every document against every other one in a single sparse
+    self-join, giving the rows of the document by document score matrix
+    a chunk at a time so that only one chunk has to be held in memory.
+
+    Each row is accumulated straight off the postings slices, in the same
+    order as scores. With a threshold, rows with terms too small to lift a
+    new document over it go through the pruned search of scores_above.
+
+    :param threshold: If given, only scores strictly above it are kept.
+    :param chunkSize: The number of rows in each chunk.
+    :returns: A generator of (first document ID, indptr, columns, values)
+      CSR chunks. The scores of document first + ii are the values at
+      positions indptr[ii] to indptr[ii + 1], against the documents in the
+      same positions of columns (in no particular order).
+    """
+    self._postings()
+    for first in xrange(0, self.num_docs, chunkSize):
+      indptr = array('l', [0])
+      columns = array('i')
+      values = array('d')
+      for docId in xrange(first, min(first + chunkSize, self.num_docs)):
+        terms = self._queryTerms(docId)
+        # Pruning only pays once the smallest term alone can't clear the
+        # threshold.
         #
-        docScores.inc(otherDocId, freq * otherFreq * inverseDocumentFrequency)
+        if threshold is not None and terms and \
+            self._remainingBounds(terms)[-2] <= threshold:
+          docScores = self._maxScore(docId, threshold)
+        else:
+          docScores = {}
+          for termid, value in terms:
+            postingDocs, postingFreqs, start, end = self._termPostings(termid)
+            for otherDocId in postingDocs[start:end]:
+              docScores[otherDocId] = docScores.get(otherDocId, 0.0) + value
+          docScores.pop(docId, None)
+        if threshold is not None:
+          docScores = dict((otherDocId, score) for (otherDocId, score) in
+            docScores.iteritems() if score > threshold)
+        columns.extend(docScores.iterkeys())
+        values.extend(docScores.itervalues())
+        indptr.append(len(columns))
+      yield first, indptr, columns, values
 
-    return docScores
+  def neighbors(self, docId):
+    """
+    Finds the documents that share at least one term with the given one.
+
+    :param docId: ID of a document.
+    :returns: A set of the IDs of the other documents sharing a term.
+    """
+    self._postings()
+    neighbors = set()
+    start, end = self._documentRange(docId)
+    for termid in self.docTerms[start:end]:
+      postingDocs, postingFreqs, postingStart, postingEnd = self._termPostings(termid)
+      neighbors.update(postingDocs[postingStart:postingEnd])
+    neighbors.discard(docId)
+    return neighbors
+
+  def save(self, filename, fingerprint=""):
+    """
+    Writes the index to a file that MappedInvertedIndex can open. Any
+    changes are compacted first.
+
+    The file holds a header, then the forward rows, the postings, the IDs
+    of removed documents and the vocabulary, all as flat arrays. Terms are
+    stored as UTF-8 text, in term ID order, with a flag telling unicode
+    terms from byte strings.
+
+    :param filename: Path to write to.
+    :param fingerprint: Up to 40 characters recording what the index was
+      built from.
+    """
+    self._postings()
+    if self._changedPostings or self.removedDocs:
+      self.compact()
+    terms = [None] * self.vocab_length
+    for term, termid in self.vocab.iteritems():
+      terms[termid] = term
+    unicodeFlags = [int(isinstance(term, unicode)) for term in terms]
+    termBytes = [term.encode("utf-8") if flag else term
+      for (term, flag) in izip(terms, unicodeFlags)]
+    vocabOffsets = [0]
+    for term in termBytes:
+      vocabOffsets.append(vocabOffsets[-1] + len(term))
+    logger.info("Saving inverted index with %d documents and %d terms to %s." % \
+      (self.num_live_docs, self.vocab_length, filename))
+    with replacingFile(filename) as f:
+      f.write(MappedInvertedIndex.HEADER.pack(MappedInvertedIndex.MAGIC,
+        fingerprint, self.num_docs, self.num_live_docs, self.vocab_length,
+        len(self.postingDocs), len(self.removedDocs), vocabOffsets[-1]))
+      writeMappedArray(f, self.docIndptr, 'q')
+      writeMappedArray(f, self.docTerms, 'i')
+      writeMappedArray(f, self.docFreqs, 'f')
+      writeMappedArray(f, self.termIndptr, 'q')
+      writeMappedArray(f, self.postingDocs, 'i')
+      writeMappedArray(f, self.postingFreqs, 'f')
+      writeMappedArray(f, sorted(self.removedDocs), 'i')
+      writeMappedArray(f, vocabOffsets, 'q')
+      writeMappedArray(f, unicodeFlags, 'B')
+      f.write("".join(termBytes))
+
+  def memoryUsage(self):
+    """
+    Returns the number of bytes used by the index arrays in memory (the
+    vocabulary dictionary and arrays mapped from a file are not counted).
+    """
+    self._postings()
+    arrays = [self.docIndptr, self.docTerms, self.docFreqs,
+      self.termIndptr, self.postingDocs, self.postingFreqs]
+    for docs, freqs in self._changedPostings.itervalues():
+      arrays.extend([docs, freqs])
+    return sum(len(a) * a.itemsize for a in arrays if isinstance(a, array))
+
+  def close(self):
+    """Nothing to release for an index built in memory."""
+    pass
 
   def report(self):
     """
@@ -202,7 +814,95 @@ class InvertedIndex(object):
     """
     for term in self.vocab:
       print "Term %s appears in %d documents." % \
-        (term, len(self.termsToDocuments[self.vocab[term]]))
+        (term, self.documentFrequency(term))
     for docId in xrange(self.num_docs):
-      print "Doc ID %d contains %d terms." % \
-        (docId, len(self.termFrequencies[docId]))
+      start, end = self._documentRange(docId)
+      print "Doc ID %d contains %d terms." % (docId, end - start)
+
+class MappedInvertedIndex(InvertedIndex):
+  """
+  An inverted index opened from a file written by InvertedIndex.save.
+
+  The arrays are memory mapped rather than read in, so opening the file
+  only takes as long as rebuilding the vocabulary dictionary, pages are
+  read in as queries touch them, and processes mapping the same file share
+  them. Pickling the index (to send it to a worker process, say) only
+  pickles the file name, and the worker maps the file itself.
+
+  The index can still be changed: changed postings are kept in memory as
+  usual, and the forward rows are read in the first time a document is
+  added. Changes are not written back unless the index is saved again.
+  """
+  MAGIC = "QBINV001"
+  HEADER = struct.Struct("=8s40sqqqqqq")
+
+  def __init__(self, filename):
+    """
+    Constructor
+
+    :param filename: Path to an index file.
+    :raises ValueError: If the file is not a complete index file.
+    """
+    InvertedIndex.__init__(self)
+    self.filename = filename
+    if os.path.getsize(filename) < self.HEADER.size:
+      raise ValueError("%s is not an inverted index file." % filename)
+    self.file = open(filename, "rb")
+    self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.HEADER.unpack_from(self.buf, 0)[0] != self.MAGIC:
+      self.close()
+      raise ValueError("%s is not an inverted index file." % filename)
+    (magic, self.fingerprint, self.num_docs, self.num_live_docs,
+      self.vocab_length, numPostings, numRemoved, vocabBytes) = \
+      self.HEADER.unpack_from(self.buf, 0)
+    offset = self.HEADER.size
+    arrays = []
+    for length, typecode in [(self.num_docs + 1, 'q'), (numPostings, 'i'),
+        (numPostings, 'f'), (self.vocab_length + 1, 'q'), (numPostings, 'i'),
+        (numPostings, 'f'), (numRemoved, 'i'), (self.vocab_length + 1, 'q'),
+        (self.vocab_length, 'B')]:
+      arrays.append(MappedArray(self.buf, offset, length, typecode))
+      offset += arrays[-1].nbytes()
+    if len(self.buf) != offset + vocabBytes:
+      self.close()
+      raise ValueError("Inverted index file %s is the wrong size." % filename)
+    (self.docIndptr, self.docTerms, self.docFreqs, self.termIndptr,
+      self.postingDocs, self.postingFreqs, removed, vocabOffsets,
+      unicodeFlags) = arrays
+    self.removedDocs = set(removed)
+    termBytes = self.buf[offset:offset + vocabBytes]
+    vocabOffsets = list(vocabOffsets)
+    for termid, flag in enumerate(unicodeFlags):
+      term = termBytes[vocabOffsets[termid]:vocabOffsets[termid + 1]]
+      if flag:
+        term = term.decode("utf-8")
+      self.vocab[term] = termid
+    logger.info("Mapped inverted index with %d documents and %d terms from %s." % \
+      (self.num_live_docs, self.vocab_length, filename))
+
+  def _readForwardRows(self):
+    """
+    Reads the forward rows into memory, so documents can be added to them.
+    """
+    if not isinstance(self.docTerms, array):
+      self.docIndptr = array('l', self.docIndptr)
+      self.docTerms = array('i', self.docTerms)
+      self.docFreqs = array('f', self.docFreqs)
+
+  def addDocument(self, document):
+    self._readForwardRows()
+    return InvertedIndex.addDocument(self, document)
+
+  def __getstate__(self):
+    if self._changedPostings or isinstance(self.docTerms, array) or \
+        isinstance(self.postingDocs, array):
+      raise ValueError("Save changes to a mapped inverted index before pickling it.")
+    return {"filename": self.filename}
+
+  def __setstate__(self, state):
+    self.__init__(state["filename"])
+
+  def close(self):
+    """Unmaps the file."""
+    self.buf.close()
+    self.file.close()
@@ -3,7 +3,6 @@
 # Implementation of Lego blocking meta-algorithm
 
 from qbcommon import expand_frequencies
-from nltk.probability import FreqDist
 from collections import defaultdict
 import logging
 logger = logging.getLogger("Lego")
@@ -3,6 +3,9 @@
 #
 # Author: Tim Destan
 
+import time
+startTime = time.time()
+
 from settings import *
 from evaluation import *
 from minhash import *
@@ -13,9 +16,14 @@ from cluster import *
 from chunker import *
 from qbcommon import *
 from featurespace import *
+from similaritymatrix import *
 
 from math import log, sqrt
 from collections import defaultdict
+import logging
+logger = logging.getLogger("Main")
+
+importTime = time.time() - startTime
 
 # Main entry point to application
 #
@@ -25,6 +33,7 @@ if __name__ == "__main__":
     write_csv_column_names()
     exit()
   configureLogger(options.debug_level, options.log_filename)
+  logger.info("Imported modules in %.3f seconds." % importTime)
   disambigutions = loadDisambiguations(options.disambiguations_file)
 
   questions = None
@@ -55,8 +64,14 @@ if __name__ == "__main__":
   # Build inverted index, labeled feature sets,
   # and reference clusters.
   #
-  index = buildInvertedIndex(questions)
-  namedEntityIndex = buildInvertedIndex(questions, useNamedEntities=True)
+  if options.index_cache:
+    index = cachedInvertedIndex(options.index_cache + ".features", questions,
+      questionsFile=options.stored_questions)
+    namedEntityIndex = cachedInvertedIndex(options.index_cache + ".entities",
+      questions, useNamedEntities=True, questionsFile=options.stored_questions)
+  else:
+    index = buildInvertedIndex(questions)
+    namedEntityIndex = buildInvertedIndex(questions, useNamedEntities=True)
   labeledFeaturesets = make_featuresets(questions,index, \
     options, disambiguations=disambigutions)
   golden_clusters = cluster_by_label(labeledFeaturesets)
@@ -66,33 +81,139 @@ if __name__ == "__main__":
   featureSets = [x[0] for x in labeledFeaturesets]
   clustererConstructor = CLUSTER_FUNCTIONS_BY_NAME[options.algorithm]
   featureComparer = FeatureComparer(options)
+  featureComparer.setTfIdfMatrix(TfIdfMatrix(featureSets))
+  featureComparer.setNamedEntityTable(NamedEntityTable(featureSets))
+  synsetSimilarityCache = None
+  if options.referers_weight == 0.0 and not options.weight_grid and \
+      not options.similarity_cache:
+    # Referers can't change any score, and no unweighted similarities are
+    # kept, so don't load WordNet at all.
+    #
+    featureComparer.skipReferers = True
+  else:
+    if options.synset_cache:
+      synsetSimilarityCache = SynsetSimilarityCache(options.synset_cache,
+        featureComparer.information_content_filename)
+      featureComparer.setSynsetSimilarityCache(synsetSimilarityCache)
+    # Referers are compared through the referer table, which looks up each
+    # distinct referer's synsets once.
+    #
+    if options.referer_table:
+      refererTable = loadRefererTable(options.referer_table,
+        featureComparer.information_content_filename)
+    else:
+      refererTable = RefererSimilarityTable(featureComparer.information_content_filename)
+    refererTable.build(featureSets, featureComparer)
+    featureComparer.setRefererTable(refererTable)
+    if options.referer_table:
+      refererTable.save(options.referer_table)
+    if synsetSimilarityCache is not None:
+      synsetSimilarityCache.flush()
+  logger.info("Ready to compare clues after %.3f seconds." % (time.time() - startTime))
 
   informative_features = defaultdict(float)
 
-  baseDistanceCache = {}
+  if options.similarity_cache:
+    # Comparisons made here are kept for later runs. Only the unweighted
+    # components are stored, so later runs may use different weights.
+    #
+    baseDistanceCache = MappedSimilarityMatrix(options.similarity_cache,
+      len(questions), similarityFingerprint(questions, featureSets,
+      featureComparer), featureComparer, featureSets)
+  else:
+    baseDistanceCache = makePairwiseStore(options.pairwise_store, len(questions))
+
+  if options.output_format == "MERGE-CSV":
+    options.feature_distance_threshold = -1.0
+    print "threshold,precision,recall,f1"
+
+  candidateNeighbors = None
+  if options.sparse_candidates:
+    candidateNeighbors = sharedTermNeighbors([index, namedEntityIndex], questionRange)
+    # Clues with related referers can score above nonOverlappingResult
+    # without sharing a term, so they are candidates too, but only if their
+    # referers are related enough to reach the threshold.
+    #
+    floor = featureComparer.relatedRefererFloor(options.feature_distance_threshold)
+    if featureComparer.refererTable is not None and floor is not None:
+      related = featureComparer.refererTable.relatedNeighbors(featureSets,
+        questionRange, floor)
+      for docId in questionRange:
+        candidateNeighbors[docId] |= related[docId]
 
   def feature_distance(fr1,fr2):
     return featureComparer.compare(fr1,fr2)
 
+  def feature_distances(fr, others):
+    return featureComparer.weighMany(*featureComparer.compareMany(fr, others))
+
+  # Single and complete linkage never merge two clusters through a pair of
+  # clues below the threshold, so the clusterer only needs a bound for
+  # those pairs. Not when the similarities are kept unweighted, though.
+  #
+  boundComparisons = options.algorithm in ["MINCLUSTER", "MAXCLUSTER"] and \
+    not options.similarity_cache
+
+  def cluster_distance(fr1,fr2):
+    if boundComparisons:
+      return featureComparer.compareWithThreshold(fr1, fr2,
+        options.feature_distance_threshold)
+    return featureComparer.compare(fr1,fr2)
+
+  # Otherwise the clusterer scores all its pairs in batches up front. The
+  # unweighted similarity cache compares missing pairs itself.
+  #
+  cluster_distances = None
+  if not boundComparisons and not options.similarity_cache:
+    cluster_distances = feature_distances
+
+  mergeAccuracy = IncrementalPairwiseF1(golden_clusters)
+
   def report_current_accuracy(clusterer, threshold):
-    experimental = clusterer.c2b.values()
-    f1, precision, recall = pairwise_f1(questionRange, experimental, golden_clusters)
+    mergeAccuracy.merge(*clusterer.lastMerge)
+    f1, precision, recall = mergeAccuracy.scores()
     print "%f,%f,%f,%f" % (threshold.total(), precision, recall, f1)
 
-  if options.output_format == "MERGE-CSV":
-    options.feature_distance_threshold = -1.0
-    print "threshold,precision,recall,f1"
-
   if options.write_thresholds:
-    report_feature_distances(questionRange, golden_clusters, labeledFeaturesets, feature_distance)
+    report_feature_distances(questionRange, golden_clusters, labeledFeaturesets,
+      feature_distance, feature_distances)
+    exit()
+
+  # Compare all the pairs in each block up front in worker processes, unless
+  # we only want the candidate pairs.
+  #
+  parallelComparer = None
+  if options.workers > 1 and not options.sparse_candidates:
+    parallelComparer = ParallelComparer(featureSets, featureComparer, options.workers)
+
+  if options.weight_grid:
+    # Compare every pair once, then only reweigh the stored components.
+    #
+    matrix = baseDistanceCache
+    if not options.similarity_cache:
+      matrix = CondensedSimilarityMatrix(len(questions), featureComparer, featureSets)
+    if parallelComparer is not None:
+      parallelComparer.fill(matrix, questionRange)
+      parallelComparer.close()
+    matrix.compareAll()
+    report_weight_grid(matrix, golden_clusters, options.weight_grid)
+    if options.similarity_cache:
+      matrix.close()
     exit()
   
   def ermethod(rs):
+    if parallelComparer is not None:
+      parallelComparer.fill(baseDistanceCache, set().union(*rs))
     clusterer = clustererConstructor(rs, featureSets,
-      feature_distance, threshold=options.feature_distance_threshold,
+      cluster_distance, threshold=options.feature_distance_threshold,
       scoreType=ScoreTypes.SIMILARITY, baseDistanceCache=baseDistanceCache,
-      guidGenerator=guidGenerator)
+      guidGenerator=guidGenerator, engine=options.cluster_engine,
+      linkageUpdates=options.linkage_updates,
+      candidateNeighbors=candidateNeighbors,
+      nonCandidateScore=featureComparer.nonOverlappingResult(),
+      batchScoreFunction=cluster_distances)
     if options.output_format == "MERGE-CSV":
+      mergeAccuracy.reset(clusterer.c2b)
       clusterer.onMerge = report_current_accuracy
     result = clusterer.cluster()
     feats = clusterer.informative_features
@@ -113,23 +234,13 @@ if __name__ == "__main__":
     elif options.tight_threshold == "INVERSELOG":
       t2 = 1.0 / log(len(questions))
 
-    neScoresHash = {}
-
-    def cheapDistanceFunction(x,y):
-      # Retrieve a hash for the distances from x to all other
-      # points. Those points not in the hash are considered
-      # infinitely distant.
-      #
-      if x not in neScoresHash:
-        neScoresHash[x] = namedEntityIndex.scores(x)
-      neScores = neScoresHash[x]
-      # Look up similarity to y in the hash.
-      # (return zero if it's not in there)
-      #
-      return neScores.get(y,0.0)
-    
-    canopiesBlocker = CanopiesBlocker(questionRange, \
-      cheapDistanceFunction, ermethod, t1, t2, ScoreTypes.SIMILARITY)
+    # Score every pair of questions by named entities in one pass. Only
+    # scores clearing t1 matter to the blocker, so the rest are pruned.
+    #
+    neNeighbors = scoredNeighbors(namedEntityIndex, t1)
+
+    canopiesBlocker = CanopiesBlocker(questionRange, None, ermethod, t1, t2,
+      ScoreTypes.SIMILARITY, neighbors=neNeighbors)
     clusters = canopiesBlocker.cluster()
   else:
     assert options.blocking_method == "LEGO"
@@ -150,4 +261,12 @@ if __name__ == "__main__":
     legoBlocker = LegoBlocker(questionRange, criteria, ermethod)
     clusters = legoBlocker.cluster()
   assert(clusters is not None)
+  if parallelComparer is not None:
+    parallelComparer.close()
+  if options.similarity_cache:
+    baseDistanceCache.close()
+  index.close()
+  namedEntityIndex.close()
+  if synsetSimilarityCache is not None:
+    synsetSimilarityCache.close()
   report_accuracy(questionRange, clusters, golden_clusters, options)
@@ -59,4 +59,22 @@ class CanopiesTests(unittest.TestCase):
           first = baserecord
         else:
           self.assertEquals(first%12, baserecord%12)
-    #print clustering
\ No newline at end of file
+    #print clustering
+
+  def test_neighbors(self):
+    """
+    Precomputed neighbors should give the same canopies as the cheap metric
+    """
+    records = range(30)
+    similarity = lambda r1, r2: 1.0 / (1 + abs(r1 - r2)) if abs(r1 - r2) < 4 else 0.0
+    neighbors = dict((r1, dict((r2, similarity(r2, r1)) for r2 in records
+      if r2 != r1 and similarity(r2, r1) > 0.2)) for r1 in records)
+    blockers = [
+      CanopiesBlocker(records, similarity, mod12_er, 0.2, 0.4,
+        ScoreTypes.SIMILARITY, randomize=False),
+      CanopiesBlocker(records, None, mod12_er, 0.2, 0.4,
+        ScoreTypes.SIMILARITY, randomize=False, neighbors=neighbors)]
+    for blocker in blockers:
+      blocker._form_canopies()
+    self.assertEquals([c.records for c in blockers[0].canopies],
+      [c.records for c in blockers[1].canopies])
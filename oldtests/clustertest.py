@@ -72,3 +72,157 @@ class FeatureBasedClustererTests(unittest.TestCase):
         self.assertTrue(13 in realCluster)
       if 34 in realCluster:
         self.assertEquals(1, len(realCluster))
+
+def similarity(x,y):
+  result = FeatureComparisonResult()
+  result.tfidf_comparison = 1.0 / (1.0 + abs(x - y))
+  result.computeTotal()
+  return result
+
+CLUSTERERS = [MinDistanceAgglomerativeCluster, MaxDistanceAgglomerativeCluster,
+  AverageDistanceAgglomerativeCluster]
+
+class ClusterEngineTests(unittest.TestCase):
+  """
+  All engines should merge the same clusters in the same order.
+  """
+  def trace(self, constructor, engine, threshold=None, linkageUpdates=False,
+      points=base):
+    c = constructor([set([x]) for x in xrange(len(points))], points, similarity,
+      threshold=threshold, scoreType=ScoreTypes.SIMILARITY,
+      baseDistanceCache={}, guidGenerator=GuidGenerator(), engine=engine,
+      linkageUpdates=linkageUpdates)
+    merges = []
+    c.onMerge = lambda slf, score: merges.append(
+      (score.total(), sorted(sorted(x) for x in slf.c2b.values())))
+    clusters = sorted(sorted(x) for x in c.cluster())
+    return clusters, merges
+
+  def test_heap_matches_scan(self):
+    for constructor in CLUSTERERS:
+      for threshold in [None, 0.2]:
+        self.assertEquals(self.trace(constructor, ClusterEngines.SCAN, threshold),
+          self.trace(constructor, ClusterEngines.HEAP, threshold))
+
+  def test_ties_go_to_lowest_cluster_ids(self):
+    # Cluster ids 7, 8 and 9. The pairs (7, 8) and (8, 9) tie, and a dict
+    # of these ids iterates 8, 9, 7.
+    guidGenerator = GuidGenerator()
+    guidGenerator.next = 6
+    for engine in [ClusterEngines.SCAN, ClusterEngines.HEAP]:
+      for constructor in CLUSTERERS:
+        guidGenerator.next = 6
+        c = constructor([set([x]) for x in xrange(3)], [0.0, 1.0, 2.0], similarity,
+          threshold=0.5, scoreType=ScoreTypes.SIMILARITY, baseDistanceCache={},
+          guidGenerator=guidGenerator, engine=engine)
+        self.assertEquals([7, 8, 9], sorted(c.c2b))
+        c.mergeNearestClusters()
+        self.assertEquals((7, 8, 10), c.lastMerge)
+
+  def test_linkage_updates_match_recompute(self):
+    for constructor in CLUSTERERS:
+      for threshold in [None, 0.2]:
+        updated = self.trace(constructor, ClusterEngines.HEAP, threshold,
+          linkageUpdates=True)
+        recomputed = self.trace(constructor, ClusterEngines.HEAP, threshold)
+        self.assertEquals(recomputed[0], updated[0])
+        self.assertEquals([m[1] for m in recomputed[1]], [m[1] for m in updated[1]])
+        for (expected, _), (actual, _) in zip(recomputed[1], updated[1]):
+          self.assertAlmostEqual(expected, actual)
+
+  def test_nearest_neighbor_chain_matches_heap(self):
+    # No tied distances, so the hierarchy is unique.
+    points = [0.0, 1.3, 10.1, 12.7, 13.2, 34.9, 20.4, 2.2]
+    for constructor in CLUSTERERS:
+      for threshold in [None, 0.2]:
+        self.assertEquals(
+          self.trace(constructor, ClusterEngines.HEAP, threshold, points=points),
+          self.trace(constructor, ClusterEngines.NNCHAIN, threshold, points=points))
+
+  def test_spanning_tree_matches_heap(self):
+    # Keeping the most similar pair is single linkage.
+    for threshold in [None, 0.2, 0.4]:
+      self.assertEquals(
+        self.trace(MaxDistanceAgglomerativeCluster, ClusterEngines.HEAP, threshold),
+        self.trace(MaxDistanceAgglomerativeCluster, ClusterEngines.MST, threshold))
+
+  def test_spanning_tree_needs_single_linkage(self):
+    self.assertRaises(ValueError, self.trace,
+      MinDistanceAgglomerativeCluster, ClusterEngines.MST)
+
+class CandidateNeighborTests(unittest.TestCase):
+
+  def create(self, neighbors):
+    calls = []
+    def counting_similarity(x,y):
+      calls.append((x,y))
+      return similarity(x,y)
+    c = MaxDistanceAgglomerativeCluster([set([x]) for x in records], base,
+      counting_similarity, threshold=0.2, scoreType=ScoreTypes.SIMILARITY,
+      baseDistanceCache={}, candidateNeighbors=neighbors)
+    return sorted(sorted(x) for x in c.cluster()), calls
+
+  def test_only_candidates_scored(self):
+    near = lambda x: set(y for y in records if y != x and abs(base[x] - base[y]) < 5)
+    sparse, sparseCalls = self.create(dict((x, near(x)) for x in records))
+    dense, denseCalls = self.create(None)
+    self.assertEquals(dense, sparse)
+    self.assertEquals(4, len(sparseCalls))
+    self.assertEquals(len(records) * (len(records) - 1) / 2, len(denseCalls))
+
+class BatchScoreTests(unittest.TestCase):
+
+  def test_batches_match_single_pairs(self):
+    """Scoring pairs in batches up front should give the same clusters"""
+    batches = []
+    def batch_similarity(x, others):
+      batches.append(len(others))
+      return [similarity(x, y) for y in others]
+    for constructor in CLUSTERERS:
+      del batches[:]
+      single = constructor([set([x]) for x in records], base, similarity,
+        threshold=0.2, scoreType=ScoreTypes.SIMILARITY, baseDistanceCache={})
+      def no_single_pairs(x, y):
+        self.fail("Pair scored outside of a batch")
+      batched = constructor([set([x]) for x in records], base, no_single_pairs,
+        threshold=0.2, scoreType=ScoreTypes.SIMILARITY, baseDistanceCache={},
+        batchScoreFunction=batch_similarity)
+      self.assertEquals(sorted(sorted(x) for x in single.cluster()),
+        sorted(sorted(x) for x in batched.cluster()))
+      self.assertEquals(len(records) * (len(records) - 1) / 2, sum(batches))
+
+class ClusterDistanceCacheTests(unittest.TestCase):
+
+  def test_evicts_merged_clusters(self):
+    for constructor in CLUSTERERS:
+      c = constructor([set([x]) for x in records], base, similarity,
+        threshold=0.2, scoreType=ScoreTypes.SIMILARITY, baseDistanceCache={})
+      clusters = c.cluster()
+      live = len(clusters)
+      stats = c.cacheStats()
+      self.assertTrue(stats["size"] <= live * (live - 1) / 2)
+      self.assertGreater(stats["evictions"], 0)
+      self.assertGreater(stats["hits"], 0)
+
+  def test_evict(self):
+    cache = ClusterDistanceCache()
+    cache[(1,2)] = 0.5
+    cache[(1,3)] = 0.25
+    cache[(2,3)] = 0.75
+    cache.evict(1)
+    self.assertEquals(1, len(cache))
+    self.assertIsNone(cache.get((1,2)))
+    self.assertEquals(0.75, cache.get((2,3)))
+
+  def test_nearest_neighbor_chain_evicts_retired_chains(self):
+    """Every cluster should leave the cache, by merging or retiring"""
+    points = [0.0, 0.5, 100.0, 100.5]
+    c = MaxDistanceAgglomerativeCluster([set([x]) for x in xrange(len(points))],
+      points, similarity, threshold=0.5, scoreType=ScoreTypes.SIMILARITY,
+      baseDistanceCache={}, engine=ClusterEngines.NNCHAIN)
+    evicted = []
+    c.clusterDistanceCache.evict = evicted.append
+    c.cluster()
+    self.assertEquals(2, len(c.c2b))
+    # Four initial clusters and the two made by merging them.
+    self.assertEquals(6, len(set(evicted)))
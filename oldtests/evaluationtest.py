@@ -0,0 +1,53 @@
+# Author : Tim Destan
+#
+# Basic unit tests for the evaluation code.
+
+from evaluation import *
+from cluster import *
+import unittest
+
+base = [1,2,10,12,13,34,35,3]
+records = range(len(base))
+golden = [set([0,1,7]), set([2,3]), set([4]), set([5,6])]
+
+def similarity(x,y):
+  result = FeatureComparisonResult()
+  result.tfidf_comparison = 1.0 / (1.0 + abs(x - y))
+  result.computeTotal()
+  return result
+
+class IncrementalPairwiseF1Tests(unittest.TestCase):
+
+  def test_matches_pairwise_f1(self):
+    """Tracked scores should match recomputing from scratch after every merge"""
+    tracker = IncrementalPairwiseF1(golden)
+    c = AverageDistanceAgglomerativeCluster([set([x]) for x in records], base,
+      similarity, threshold=-1.0, scoreType=ScoreTypes.SIMILARITY)
+    tracker.reset(c.c2b)
+    self.assertEquals(pairwise_f1(records, c.c2b.values(), golden), tracker.scores())
+    merges = []
+    def check(clusterer, score):
+      tracker.merge(*clusterer.lastMerge)
+      merges.append(score)
+      self.assertEquals(pairwise_f1(records, clusterer.c2b.values(), golden),
+        tracker.scores())
+    c.onMerge = check
+    c.cluster()
+    self.assertEquals(len(records) - 1, len(merges))
+
+class BestThresholdTests(unittest.TestCase):
+
+  def test_best_threshold(self):
+    """The best cut should be found, and never between tied pairs"""
+    totals = [0.9, 0.2, 0.7, 0.7, 0.1]
+    sameCluster = [1, 0, 1, 0, 1]
+    threshold, precision, recall, f1 = best_threshold(totals, sameCluster, 3.0)
+    self.assertEquals(0.1, threshold)
+    self.assertEquals((0.6, 1.0), (precision, recall))
+    # Without the last pair, cutting at 0.7 keeps both tied pairs.
+    #
+    self.assertEquals((0.7, 2.0 / 3), best_threshold(totals[:4], sameCluster[:4], 2.0)[:2])
+
+  def test_no_golden_pairs(self):
+    """With no pair sharing a golden cluster, nothing should be found"""
+    self.assertEquals((0.0, 0.0, 0.0, 0.0), best_threshold([0.9, 0.2], [0, 0], 0.0))
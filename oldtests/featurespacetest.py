@@ -0,0 +1,456 @@
+# Author : Tim Destan
+#
+# Basic unit tests for the tf-idf matrix, the synset, referer and named
+# entity tables and the JCN engine.
+
+from featurespace import *
+import os
+import shutil
+import tempfile
+from math import log
+import unittest
+
+def featureRep(tfidf):
+  rep = FeatureRepresentation()
+  rep.tfidf_features = tfidf
+  return rep
+
+class TfIdfMatrixTests(unittest.TestCase):
+
+  def setUp(self):
+    self.featureSets = [featureRep({"a": 1.0, "b": 2.0}),
+      featureRep({"b": 3.0, "c": 0.5}),
+      featureRep({}),
+      featureRep({"c": 4.0, "a": 0.25, "d": 1.0})]
+    self.matrix = TfIdfMatrix(self.featureSets)
+
+  def expected(self, b1, b2):
+    features1 = self.featureSets[b1].tfidf_features
+    features2 = self.featureSets[b2].tfidf_features
+    return sum(features1[key] * features2[key]
+      for key in features1 if key in features2)
+
+  def test_rows(self):
+    """Each clue should get its own row"""
+    self.assertEquals([0, 1, 2, 3], [f.tfidf_row for f in self.featureSets])
+    self.assertEquals(4, len(self.matrix.termIds))
+    self.assertEquals(7, len(self.matrix.data))
+
+  def test_dot(self):
+    """Dot products should match comparing the dictionaries"""
+    for b1 in xrange(4):
+      for b2 in xrange(4):
+        self.assertEquals(self.expected(b1, b2), self.matrix.dot(b1, b2))
+
+  def test_dot_block(self):
+    """A block of dot products should match the single ones"""
+    rows = [3, 0, 2]
+    columns = [1, 3, 0]
+    block = self.matrix.dotBlock(rows, columns)
+    self.assertEquals(len(rows), len(block))
+    for ii, b1 in enumerate(rows):
+      self.assertEquals([self.matrix.dot(b1, b2) for b2 in columns], list(block[ii]))
+
+class FakeSynset(object):
+  """A synset whose similarity to another is the product of their values"""
+  def __init__(self, name, value):
+    self.name = name
+    self.value = value
+
+  def jcn_similarity(self, other, ic):
+    return self.value * other.value
+
+class FakeWordNet(object):
+  NOUN = 'n'
+
+  def __init__(self):
+    self.lookups = 0
+    self.byName = {}
+    self.byWord = {}
+    for word, values in [("man", [1.0, 0.5]), ("poet", [2.0]), ("novel", [0.5, 3.0])]:
+      self.byWord[word] = []
+      for ii, value in enumerate(values):
+        synset = FakeSynset("%s.n.%02d" % (word, ii + 1), value)
+        self.byWord[word].append(synset)
+        self.byName[synset.name] = synset
+
+  def synsets(self, word, pos=None):
+    self.lookups += 1
+    return self.byWord.get(word, [])
+
+  def synset(self, name):
+    return self.byName[name]
+
+class Options(object):
+  tf_idf_weight = 1.0
+  category_weight = 1.0
+  referers_weight = 1.0
+  named_entities_weight = 1.0
+  jcn_engine = "NLTK"
+
+def fakeComparer():
+  """A comparer whose information content never has to be loaded"""
+  comparer = FeatureComparer(Options())
+  comparer._ic = {}
+  return comparer
+
+class RefererSimilarityTableTests(unittest.TestCase):
+
+  def setUp(self):
+    import featurespace
+    self.module = featurespace
+    self.realWordNet = featurespace.wn
+    featurespace.wn = self.fakeWordNet = FakeWordNet()
+    self.comparer = fakeComparer()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.module.wn = self.realWordNet
+    shutil.rmtree(self.directory)
+
+  def referers(self, referers):
+    rep = FeatureRepresentation()
+    rep.referers = referers
+    return rep
+
+  def check(self, table, featureSets):
+    for f1 in featureSets:
+      for f2 in featureSets:
+        self.assertEquals(self.comparer.compareReferers(f1.referers, f2.referers),
+          table.compare(f1.referer_ids, f2.referer_ids))
+
+  def test_same_similarities(self):
+    """Table lookups should match comparing referer strings"""
+    featureSets = [self.referers(r) for r in
+      [["man", "poet"], ["poet", "poet"], [], ["novel", "unknown"]]]
+    table = RefererSimilarityTable("ic-test.dat")
+    table.build(featureSets, self.comparer)
+    self.assertEquals(4, len(table))
+    self.check(table, featureSets)
+
+  def test_looked_up_once(self):
+    """Each new referer should be looked up in WordNet once"""
+    featureSets = [self.referers(r) for r in
+      [["man", "poet"], ["poet"], ["novel", "unknown"]]]
+    table = RefererSimilarityTable("ic-test.dat")
+    table.build(featureSets, self.comparer)
+    self.assertEquals(4, self.fakeWordNet.lookups)
+    table.build(featureSets, self.comparer)
+    self.assertEquals(4, self.fakeWordNet.lookups)
+    self.check(table, featureSets)
+
+  def test_grow_and_reload(self):
+    """Saved tables should load again and take in new referers"""
+    filename = os.path.join(self.directory, "referers.pickle")
+    table = loadRefererTable(filename, "ic-test.dat")
+    self.assertEquals(0, len(table))
+    table.build([self.referers(["man", "poet"])], self.comparer)
+    table.save(filename)
+    table = loadRefererTable(filename, "ic-test.dat")
+    self.assertEquals(["man", "poet"], table.referers)
+    featureSets = [self.referers(r) for r in [["novel"], ["poet"], ["man", "novel"]]]
+    table.build(featureSets, self.comparer)
+    self.assertEquals(3, len(table))
+    self.check(table, featureSets)
+    self.assertEquals(0, len(loadRefererTable(filename, "ic-other.dat")))
+
+  def test_related_neighbors(self):
+    """Clues should neighbor those whose referers score above unrelated ones"""
+    featureSets = [self.referers(r) for r in
+      [["man"], ["poet", "unknown"], [], ["unknown"], ["novel"]]]
+    table = RefererSimilarityTable("ic-test.dat")
+    table.build(featureSets, self.comparer)
+    neighbors = table.relatedNeighbors(featureSets, range(len(featureSets)))
+    for ii, f1 in enumerate(featureSets):
+      for jj, f2 in enumerate(featureSets):
+        if ii != jj:
+          self.assertEquals(table.compare(f1.referer_ids, f2.referer_ids) > sigmoid(0.0),
+            jj in neighbors[ii])
+    self.assertEquals(set([0, 4]), neighbors[1])
+    self.assertEquals(set(), neighbors[3])
+    floor = max(table.values)
+    neighbors = table.relatedNeighbors(featureSets, range(len(featureSets)), floor)
+    for ii, f1 in enumerate(featureSets):
+      for jj, f2 in enumerate(featureSets):
+        if ii != jj:
+          self.assertEquals(table.compare(f1.referer_ids, f2.referer_ids) >= floor,
+            jj in neighbors[ii])
+
+  def test_related_referer_floor(self):
+    """Only referers that can lift a pair to the threshold should count"""
+    comparer = self.comparer
+    self.assertIsNone(comparer.relatedRefererFloor(2.5))
+    floor = comparer.relatedRefererFloor(1.75)
+    result = comparer.nonOverlappingResult()
+    result.referers_comparison = floor * comparer.referers_weight * NORM_BOUND_SLACK
+    result.computeTotal()
+    self.assertAlmostEquals(1.75, result.total())
+    comparer.referers_weight = 0.0
+    self.assertIsNone(comparer.relatedRefererFloor(0.5))
+
+class SynsetSimilarityCacheTests(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, "jcn.dat")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_persisted(self):
+    """Similarities should survive a flush and a reload, in either order"""
+    cache = SynsetSimilarityCache(self.filename, "ic-test.dat")
+    self.assertIsNone(cache.get("man.n.01", "poet.n.01"))
+    cache[("man.n.01", "poet.n.01")] = 0.25
+    cache[("novel.n.01", "man.n.01")] = 1e300
+    self.assertEquals(0.25, cache.get("poet.n.01", "man.n.01"))
+    cache.close()
+    cache = SynsetSimilarityCache(self.filename, "ic-test.dat")
+    self.assertEquals(2, len(cache))
+    self.assertEquals(0.25, cache.get("poet.n.01", "man.n.01"))
+    self.assertEquals(1e300, cache.get("man.n.01", "novel.n.01"))
+    cache[("poet.n.01", "poet.n.01")] = 1.0
+    cache.flush()
+    self.assertEquals(3, len(cache))
+    self.assertEquals(1.0, cache.get("poet.n.01", "poet.n.01"))
+    stats = cache.stats()
+    self.assertEquals((3, 0), (stats["hits"], stats["misses"]))
+    cache.close()
+
+  def test_concurrent_writers(self):
+    """Flushing should keep what other caches saved since opening the file"""
+    first = SynsetSimilarityCache(self.filename, "ic-test.dat")
+    second = SynsetSimilarityCache(self.filename, "ic-test.dat")
+    first[("man.n.01", "poet.n.01")] = 0.25
+    second[("novel.n.01", "man.n.01")] = 0.5
+    first.flush()
+    second.flush()
+    self.assertEquals(0.25, second.get("man.n.01", "poet.n.01"))
+    first.close()
+    second.close()
+    cache = SynsetSimilarityCache(self.filename, "ic-test.dat")
+    self.assertEquals(2, len(cache))
+    self.assertEquals(0.5, cache.get("man.n.01", "novel.n.01"))
+    cache.close()
+
+  def test_other_information_content(self):
+    """Similarities from another information content file should be ignored"""
+    cache = SynsetSimilarityCache(self.filename, "ic-test.dat")
+    cache[("man.n.01", "poet.n.01")] = 0.25
+    cache.close()
+    cache = SynsetSimilarityCache(self.filename, "ic-other.dat")
+    self.assertEquals(0, len(cache))
+    self.assertIsNone(cache.get("man.n.01", "poet.n.01"))
+    cache.close()
+
+  def test_comparer_uses_cache(self):
+    """The comparer should only compute similarities the cache lacks"""
+    synsets = FakeWordNet().byName
+    cache = SynsetSimilarityCache(self.filename, "ic-test.dat")
+    cache[("man.n.01", "poet.n.01")] = 7.0
+    comparer = fakeComparer()
+    comparer.setSynsetSimilarityCache(cache)
+    self.assertEquals(7.0, comparer.jcnSimilarity(synsets["poet.n.01"], synsets["man.n.01"]))
+    self.assertEquals(1.5, comparer.jcnSimilarity(synsets["novel.n.02"], synsets["man.n.02"]))
+    self.assertEquals(1.5, cache.get("man.n.02", "novel.n.02"))
+    cache.close()
+
+class HierarchySynset(object):
+  """A noun synset in a small hand-built hierarchy"""
+  def __init__(self, name, offset, hypernyms=()):
+    self.name = name
+    self.pos = self._pos = 'n'
+    self.offset = self._offset = offset
+    self.parents = list(hypernyms)
+
+  def common_hypernyms(self, other):
+    def ancestors(synset):
+      found = set([synset])
+      for parent in synset.parents:
+        found.update(ancestors(parent))
+      return found
+    return list(ancestors(self).intersection(ancestors(other)))
+
+def informationContent(synset, ic):
+  """NLTK's information_content for the hand-built hierarchy"""
+  counts = ic[synset.pos][synset.offset]
+  if counts == 0:
+    return JCN_INFINITY
+  return -log(counts / ic[synset.pos][0])
+
+class JcnEngineTests(unittest.TestCase):
+
+  def setUp(self):
+    self.entity = HierarchySynset("entity.n.01", 0)
+    self.animal = HierarchySynset("animal.n.01", 1, [self.entity])
+    self.dog = HierarchySynset("dog.n.01", 2, [self.animal])
+    self.cat = HierarchySynset("cat.n.01", 3, [self.animal])
+    self.unseen = HierarchySynset("unseen.n.01", 4, [self.entity])
+    self.engine = JcnEngine({'n': {0: 100.0, 1: 10.0, 2: 2.0, 3: 5.0, 4: 0.0}},
+      informationContent)
+
+  def test_similarity(self):
+    """Similarities should follow the JCN definition"""
+    dog = -log(2.0 / 100.0)
+    cat = -log(5.0 / 100.0)
+    animal = -log(10.0 / 100.0)
+    self.assertEquals(1 / (dog + cat - 2 * animal), self.engine.similarity(self.dog, self.cat))
+    self.assertEquals(1 / (cat + dog - 2 * animal), self.engine.similarity(self.cat, self.dog))
+    self.assertEquals(1 / (dog + JCN_INFINITY - 2 * 0.0),
+      self.engine.similarity(self.dog, self.unseen))
+
+  def test_special_cases(self):
+    """Identical synsets and the root should get NLTK's special values"""
+    self.assertEquals(JCN_INFINITY, self.engine.similarity(self.dog, self.dog))
+    self.assertEquals(0, self.engine.similarity(self.entity, self.dog))
+    self.assertEquals(self.engine.similarities(self.dog, [self.cat, self.dog, self.entity]),
+      [self.engine.similarity(self.dog, s) for s in [self.cat, self.dog, self.entity]])
+
+  def test_best_similarity(self):
+    """The best similarity should be the highest of all the pairs"""
+    ss1 = [self.cat, self.unseen]
+    ss2 = [self.entity, self.dog]
+    self.assertEquals(max(self.engine.similarity(s1, s2) for s1 in ss1 for s2 in ss2),
+      self.engine.bestSimilarity(ss1, ss2))
+    self.assertEquals(0.0, self.engine.bestSimilarity([], ss2))
+
+  def test_best_similarities(self):
+    """Comparing with many lists at once should match comparing with each"""
+    synsets = [self.entity, self.animal, self.dog, self.cat, self.unseen]
+    lists = [[self.dog, self.cat], [], [self.entity], synsets, [self.cat, self.cat]]
+    for ss1 in [[], [self.dog], [self.entity, self.cat], synsets]:
+      self.assertEquals([self.engine.bestSimilarity(ss1, ss2) for ss2 in lists],
+        self.engine.bestSimilarities(ss1, lists))
+    for s1 in synsets:
+      self.assertEquals([self.engine.similarity(s1, s2) for s2 in synsets + synsets],
+        self.engine.similarities(s1, synsets + synsets))
+
+def entities(counts):
+  rep = FeatureRepresentation()
+  rep.named_entities.update(counts)
+  return rep
+
+class NamedEntityTableTests(unittest.TestCase):
+
+  def setUp(self):
+    self.featureSets = [entities({"Paris": 2, "France": 1}),
+      entities({"France": 3, "Lyon": 0}),
+      entities({}),
+      entities({"Lyon": 1, "Paris": 1, "Seine": 4})]
+    self.table = NamedEntityTable(self.featureSets)
+
+  def test_interned(self):
+    """Entities with counts should be interned once each"""
+    self.assertEquals(4, len(self.table))
+    france = self.table.ids["France"]
+    self.assertEquals([france], list(self.featureSets[1].entity_ids))
+    self.assertEquals([3], list(self.featureSets[1].entity_counts))
+    ids = self.featureSets[3].entity_ids
+    self.assertEquals(sorted(ids), list(ids))
+
+  def test_same_similarities(self):
+    """Merging id arrays should match comparing dictionaries, without changing them"""
+    comparer = fakeComparer()
+    before = [dict(f.named_entities) for f in self.featureSets]
+    for f1 in self.featureSets:
+      for f2 in self.featureSets:
+        self.assertEquals(comparer.compareNamedEntities(f1.named_entities, f2.named_entities),
+          mergeDot(f1.entity_ids, f1.entity_counts, f2.entity_ids, f2.entity_counts))
+    self.assertEquals(before, [dict(f.named_entities) for f in self.featureSets])
+
+class CompareWithThresholdTests(unittest.TestCase):
+
+  def setUp(self):
+    import featurespace
+    self.module = featurespace
+    self.realWordNet = featurespace.wn
+    featurespace.wn = FakeWordNet()
+    self.featureSets = []
+    for tfidf, named, referers in [({"a": 1.0}, {"Paris": 1}, ["man"]),
+        ({"a": 2.0, "b": 1.0}, {"Paris": 2}, ["poet"]),
+        ({"c": 0.1}, {}, ["novel"])]:
+      rep = featureRep(tfidf)
+      rep.named_entities.update(named)
+      rep.referers = referers
+      self.featureSets.append(rep)
+    self.comparer = fakeComparer()
+    self.comparer.setTfIdfMatrix(TfIdfMatrix(self.featureSets))
+    self.comparer.setNamedEntityTable(NamedEntityTable(self.featureSets))
+
+  def tearDown(self):
+    self.module.wn = self.realWordNet
+
+  def test_exact_above_threshold(self):
+    """Pairs that may reach the threshold should be compared exactly"""
+    fr1, fr2 = self.featureSets[:2]
+    result = self.comparer.compareWithThreshold(fr1, fr2, 5.0)
+    self.assertFalse(result.isBound)
+    self.assertEquals(self.comparer.compare(fr1, fr2).feature_contributions(),
+      result.feature_contributions())
+
+  def test_bounded_below_threshold(self):
+    """Pairs that can't reach the threshold should get an upper bound"""
+    fr1, fr3 = self.featureSets[0], self.featureSets[2]
+    result = self.comparer.compareWithThreshold(fr1, fr3, 2.5)
+    self.assertTrue(result.isBound)
+    self.assertEquals(1.0, result.referers_comparison)
+    self.assertTrue(self.comparer.compare(fr1, fr3).total() <= result.total() < 2.5)
+
+  def test_bounded_above_threshold(self):
+    """Pairs sure to reach the threshold may get a lower bound"""
+    fr1, fr2 = self.featureSets[:2]
+    result = self.comparer.compareWithThreshold(fr1, fr2, 2.0, exactAbove=False)
+    self.assertTrue(result.isBound)
+    self.assertEquals(sigmoid(0.0), result.referers_comparison)
+    self.assertTrue(self.comparer.compare(fr1, fr2).total() >= result.total() >= 2.0)
+
+class CompareManyTests(unittest.TestCase):
+
+  def setUp(self):
+    import featurespace
+    self.module = featurespace
+    self.realWordNet = featurespace.wn
+    featurespace.wn = FakeWordNet()
+    self.featureSets = []
+    for tfidf, named, referers in [({"a": 1.0}, {"Paris": 1}, ["man"]),
+        ({"a": 2.0, "b": 1.0}, {"Paris": 2}, ["poet"]),
+        ({"c": 0.1}, {}, ["novel"]),
+        ({"b": 0.5, "c": 3.0}, {"Paris": 1, "Lyon": 2}, [])]:
+      rep = featureRep(tfidf)
+      rep.named_entities.update(named)
+      rep.referers = referers
+      self.featureSets.append(rep)
+    self.comparer = fakeComparer()
+
+  def tearDown(self):
+    self.module.wn = self.realWordNet
+
+  def check(self):
+    rows = self.featureSets[:2]
+    columns = self.featureSets[1:]
+    block = self.comparer.compareBlock(rows, columns)
+    for ii, fr1 in enumerate(rows):
+      many = self.comparer.compareMany(fr1, columns)
+      self.assertEquals([list(channel) for channel in many],
+        [list(channel) for channel in block[ii]])
+      for jj, fr2 in enumerate(columns):
+        self.assertEquals(self.comparer.compareComponents(fr1, fr2),
+          tuple(channel[jj] for channel in many))
+      results = self.comparer.weighMany(*many)
+      self.assertEquals([self.comparer.compare(fr1, fr2).total() for fr2 in columns],
+        [result.total() for result in results])
+    block = self.comparer.compareBlock(self.featureSets, self.featureSets, diagonal=True)
+    for ii, fr1 in enumerate(self.featureSets):
+      many = self.comparer.compareMany(fr1, self.featureSets[ii + 1:])
+      self.assertEquals([list(channel) for channel in many],
+        [list(channel) for channel in block[ii]])
+
+  def test_dictionaries(self):
+    """Batches should match single comparisons of the dictionaries"""
+    self.check()
+
+  def test_tables(self):
+    """Batches should match single comparisons through the tables"""
+    self.comparer.setTfIdfMatrix(TfIdfMatrix(self.featureSets))
+    self.comparer.setNamedEntityTable(NamedEntityTable(self.featureSets))
+    self.check()
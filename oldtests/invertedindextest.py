@@ -4,6 +4,10 @@
 # Inverted index.
 
 from invertedindex import *
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
 
 sent1 = ["colorless","green","ideas","sleep","furiously"]
@@ -64,3 +68,241 @@ class InvertedIndexTests(unittest.TestCase):
 
     # The third doc should have a better score than the first.
     self.assertGreater(docsAndScores[docids[2]], docsAndScores[docids[0]])
+
+  def test_neighbors(self):
+    """Neighbors should be the documents sharing a term"""
+    index,docids = self.create()
+    self.assertEquals(set([docids[0], docids[2]]), index.neighbors(docids[1]))
+    self.assertEquals(set([docids[1]]), index.neighbors(docids[2]))
+    neighbors = sharedTermNeighbors([index], docids)
+    self.assertEquals(set([docids[1]]), neighbors[docids[0]])
+
+  def test_scores_after_adding(self):
+    """Adding a document after a query should be reflected in later queries"""
+    index,docids = self.create()
+    self.assertEquals(2, index.documentFrequency("green"))
+    newId = index.addDocument(["green", "levee"])
+    self.assertEquals(3, index.documentFrequency("green"))
+    self.assertTrue(newId in index.scores(docids[0]))
+    self.assertEquals(set([docids[0], docids[1], docids[3], docids[4]]),
+      index.neighbors(newId))
+
+  def test_unknown(self):
+    """Unknown terms and documents should have nothing in them"""
+    index,docids = self.create()
+    self.assertEquals(0, index.termFrequency("brownstone", docids[0]))
+    self.assertEquals(0.0, index.inverseDocumentFrequency("brownstone"))
+    self.assertEquals(0, index.termFrequency("green", 99))
+    self.assertEquals({}, index.scores(99))
+    self.assertFalse("brownstone" in index.vocab)
+
+  def test_memory_usage(self):
+    """The arrays should hold one entry per posting"""
+    index,docids = self.create()
+    postings = sum(len(set(s)) for s in [sent1, sent2, sent3, sent4, sent5])
+    self.assertGreater(index.memoryUsage(), 0)
+    self.assertEquals(postings, len(index.docTerms))
+    self.assertEquals(postings, len(index.postingDocs))
+
+  def test_scores_above(self):
+    """Thresholded scores should match the full scores above the threshold"""
+    index,docids = self.create()
+    for docid in docids:
+      docsAndScores = index.scores(docid)
+      for threshold in [-1.0, 0.0] + docsAndScores.values():
+        expected = dict((d, s) for (d, s) in docsAndScores.items() if s > threshold)
+        self.assertEquals(expected, index.scores_above(docid, threshold))
+
+  def test_top_k(self):
+    """Top k should return the best scores, best first"""
+    index,docids = self.create()
+    docsAndScores = index.scores(docids[1])
+    best = index.top_k(docids[1], 1)
+    self.assertEquals([(docids[2], docsAndScores[docids[2]])], best)
+    self.assertEquals(2, len(index.top_k(docids[1], 5)))
+    self.assertEquals([], index.top_k(docids[1], 0))
+    self.assertEquals([], index.top_k(docids[1], 5, docsAndScores[docids[2]]))
+
+  def test_score_rows(self):
+    """The self-join should give the same scores as scoring each document"""
+    index,docids = self.create()
+    for threshold in [None, 0.0, 0.05]:
+      rows = {}
+      for first, indptr, columns, values in index.scoreRows(threshold, 2):
+        for ii in xrange(len(indptr) - 1):
+          rows[first + ii] = dict(zip(columns[indptr[ii]:indptr[ii + 1]],
+            values[indptr[ii]:indptr[ii + 1]]))
+      for docid in docids:
+        if threshold is None:
+          self.assertEquals(index.scores(docid), rows[docid])
+        else:
+          self.assertEquals(index.scores_above(docid, threshold), rows[docid])
+
+  def test_scored_neighbors(self):
+    """Neighbors should hold the scores other documents give each one"""
+    index,docids = self.create()
+    neighbors = scoredNeighbors(index, 0.0)
+    self.assertEquals({docids[1]: index.scores(docids[1])[docids[2]]},
+      neighbors[docids[2]])
+    for docid in docids:
+      for otherDocid, score in index.scores_above(docid, 0.0).items():
+        self.assertEquals(score, neighbors[otherDocid][docid])
+
+  def test_remove(self):
+    """Removing a document should update frequencies and scores"""
+    index,docids = self.create()
+    idf = index.inverseDocumentFrequency("green")
+    index.removeDocument(docids[0])
+    self.assertEquals(1, index.documentFrequency("green"))
+    self.assertEquals(0, index.documentFrequency("colorless"))
+    self.assertEquals(4, index.num_live_docs)
+    self.assertEquals(0, index.termFrequency("green", docids[0]))
+    self.assertEquals(set([docids[2]]), index.neighbors(docids[1]))
+    self.assertFalse(docids[0] in index.scores(docids[1]))
+    self.assertEquals({}, index.scores(docids[0]))
+    self.assertEquals(math.log(4 / 1), index.inverseDocumentFrequency("green"))
+    self.assertNotEqual(idf, index.inverseDocumentFrequency("green"))
+    self.assertRaises(ValueError, index.removeDocument, docids[0])
+    self.assertRaises(ValueError, index.removeDocument, 99)
+
+  def test_add_batch(self):
+    """Adding a batch should give the same index as adding up front"""
+    index,docids = self.create()
+    index.scores(docids[0])
+    index.removeDocument(docids[3])
+    newIds = index.addDocuments([sent4, sent1])
+    self.assertEquals([5, 6], newIds)
+    self.assertEquals(1, index.documentFrequency("chevy"))
+    self.assertEquals(2, index.documentFrequency("levee"))
+    self.assertEquals(3, index.documentFrequency("green"))
+    scores = dict((docid, index.scores(docid)) for docid in docids + newIds
+      if docid != docids[3])
+    index.compact()
+    for docid, docScores in scores.items():
+      self.assertEquals(docScores, index.scores(docid))
+
+class FakeQuestion(object):
+  """Just enough of a question to index."""
+  def __init__(self, id, sentence):
+    self.id = id
+    self.sentence = sentence
+    self.named_entities = {}
+
+  def features(self):
+    return list(enumerate(self.sentence))
+
+class MappedInvertedIndexTests(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, "index.dat")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def create(self):
+    index = InvertedIndex()
+    for sent in [sent1, sent2, sent3, sent4, sent5, [u"na\xefve", "green"]]:
+      index.addDocument(sent)
+    index.removeDocument(4)
+    return index
+
+  def test_round_trip(self):
+    """A saved index should answer queries the same when mapped"""
+    index = self.create()
+    index.save(self.filename, "a" * 40)
+    mapped = MappedInvertedIndex(self.filename)
+    self.assertEquals("a" * 40, mapped.fingerprint)
+    self.assertEquals(index.vocab, mapped.vocab)
+    self.assertEquals(set([4]), mapped.removedDocs)
+    for term in index.vocab:
+      self.assertEquals(index.documentFrequency(term), mapped.documentFrequency(term))
+      self.assertEquals(index.inverseDocumentFrequency(term),
+        mapped.inverseDocumentFrequency(term))
+    for docid in xrange(index.num_docs):
+      self.assertEquals(index.scores(docid), mapped.scores(docid))
+      self.assertEquals(index.neighbors(docid), mapped.neighbors(docid))
+      self.assertEquals(index.top_k(docid, 2), mapped.top_k(docid, 2))
+    self.assertEquals(0, mapped.memoryUsage())
+    mapped.close()
+
+  def test_changes(self):
+    """A mapped index should still take changes"""
+    index = self.create()
+    index.save(self.filename)
+    mapped = MappedInvertedIndex(self.filename)
+    for changed in [index, mapped]:
+      changed.removeDocument(0)
+      changed.addDocument(sent5)
+    for docid in xrange(index.num_docs):
+      self.assertEquals(index.scores(docid), mapped.scores(docid))
+    self.assertRaises(ValueError, pickle.dumps, mapped)
+    mapped.close()
+
+  def test_pickle(self):
+    """Pickling a mapped index should only send the file name"""
+    self.create().save(self.filename)
+    mapped = MappedInvertedIndex(self.filename)
+    data = pickle.dumps(mapped, 2)
+    self.assertLess(len(data), 200)
+    unpickled = pickle.loads(data)
+    self.assertEquals(mapped.scores(1), unpickled.scores(1))
+    mapped.close()
+    unpickled.close()
+
+  def test_not_an_index(self):
+    """Other files should be refused"""
+    with open(self.filename, "wb") as f:
+      f.write("x" * 200)
+    self.assertRaises(ValueError, MappedInvertedIndex, self.filename)
+
+  def test_cached(self):
+    """The cached index should be rebuilt only when the questions change"""
+    questions = [FakeQuestion(ii, sentence) for (ii, sentence) in
+      enumerate([sent1, sent2, sent3])]
+    built = cachedInvertedIndex(self.filename, questions)
+    self.assertFalse(isinstance(built, MappedInvertedIndex))
+    mapped = cachedInvertedIndex(self.filename, questions)
+    self.assertTrue(isinstance(mapped, MappedInvertedIndex))
+    self.assertEquals(built.scores(1), mapped.scores(1))
+    mapped.close()
+    rebuilt = cachedInvertedIndex(self.filename, questions[:2])
+    self.assertFalse(isinstance(rebuilt, MappedInvertedIndex))
+    self.assertEquals(2, rebuilt.num_docs)
+    questions[1] = FakeQuestion(1, sent3)
+    changed = cachedInvertedIndex(self.filename, questions[:2])
+    self.assertFalse(isinstance(changed, MappedInvertedIndex))
+    self.assertEquals(changed.scores(0), buildInvertedIndex(questions[:2]).scores(0))
+
+  def test_cached_by_file(self):
+    """With a questions file, the cached index should follow the file and the question ids"""
+    questionsFile = os.path.join(self.directory, "questions.pickle")
+    with open(questionsFile, "wb") as f:
+      f.write("questions")
+    questions = [FakeQuestion(ii, sentence) for (ii, sentence) in
+      enumerate([sent1, sent2, sent3])]
+    built = cachedInvertedIndex(self.filename, questions, questionsFile=questionsFile)
+    self.assertFalse(isinstance(built, MappedInvertedIndex))
+    mapped = cachedInvertedIndex(self.filename, questions, questionsFile=questionsFile)
+    self.assertTrue(isinstance(mapped, MappedInvertedIndex))
+    self.assertEquals(built.scores(1), mapped.scores(1))
+    mapped.close()
+    rebuilt = cachedInvertedIndex(self.filename, questions[:2], questionsFile=questionsFile)
+    self.assertFalse(isinstance(rebuilt, MappedInvertedIndex))
+    with open(questionsFile, "ab") as f:
+      f.write(" changed")
+    changed = cachedInvertedIndex(self.filename, questions[:2], questionsFile=questionsFile)
+    self.assertFalse(isinstance(changed, MappedInvertedIndex))
+    import invertedindex
+    fingerprint = questionsFileFingerprint(questions, questionsFile)
+    invertedindex.DOCUMENT_VERSION += 1
+    try:
+      self.assertNotEquals(fingerprint, questionsFileFingerprint(questions, questionsFile))
+    finally:
+      invertedindex.DOCUMENT_VERSION -= 1
+    missing = os.path.join(self.directory, "missing.pickle")
+    self.assertEquals(None, questionsFileFingerprint(questions, missing))
+    cachedInvertedIndex(self.filename, questions, questionsFile=missing)
+    fallback = cachedInvertedIndex(self.filename, questions)
+    self.assertTrue(isinstance(fallback, MappedInvertedIndex))
+    fallback.close()
@@ -0,0 +1,252 @@
+# Author : Tim Destan
+#
+# Basic unit tests for the condensed and memory mapped similarity matrices,
+# and for filling them in worker processes.
+
+from similaritymatrix import *
+from featurespace import TfIdfMatrix, NamedEntityTable, RefererSimilarityTable
+from featurespacetest import FakeWordNet, Options, featureRep
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+def result(tfidf, category, referers, named):
+  r = FeatureComparisonResult()
+  r.tfidf_comparison = tfidf
+  r.category_comparison = category
+  r.referers_comparison = referers
+  r.named_entities_comparison = named
+  r.computeTotal()
+  return r
+
+class CondensedSimilarityMatrixTests(unittest.TestCase):
+
+  def create(self):
+    return CondensedSimilarityMatrix(5)
+
+  def test_empty(self):
+    """Nothing should be stored at first"""
+    matrix = self.create()
+    self.assertEquals(0, len(matrix))
+    self.assertIsNone(matrix.get((0,1)))
+    self.assertFalse((3,4) in matrix)
+
+  def test_round_trip(self):
+    """Stored results should come back with the same components"""
+    matrix = self.create()
+    stored = result(0.25, 1.0, 0.6, 3.0)
+    matrix[(3,1)] = stored
+    for key in [(1,3), (3,1)]:
+      retrieved = matrix.get(key)
+      self.assertEquals(stored.feature_contributions(), retrieved.feature_contributions())
+      self.assertEquals(stored.total(), retrieved.total())
+    self.assertEquals(1, len(matrix))
+
+  def test_all_pairs_distinct(self):
+    """Every pair should have its own slot"""
+    matrix = self.create()
+    for b1 in xrange(5):
+      for b2 in xrange(b1 + 1, 5):
+        matrix[(b1,b2)] = result(b1, b2, 0.0, 0.0)
+    self.assertEquals(10, len(matrix))
+    for b1 in xrange(5):
+      for b2 in xrange(b1 + 1, 5):
+        self.assertEquals(b1 + b2, matrix[(b2,b1)].total())
+
+  def test_bounds_kept(self):
+    """Bounds should not come back as exact scores"""
+    matrix = self.create()
+    bound = result(0.25, 1.0, 0.6, 3.0)
+    bound.isBound = True
+    matrix[(0,1)] = bound
+    matrix[(0,2)] = result(0.25, 1.0, 0.6, 3.0)
+    self.assertTrue(matrix[(1,0)].isBound)
+    self.assertFalse(matrix[(0,2)].isBound)
+    matrix[(0,1)] = result(0.25, 1.0, 0.6, 3.0)
+    self.assertFalse(matrix[(0,1)].isBound)
+    self.assertEquals(2, len(matrix))
+
+  def test_bad_keys(self):
+    """Pairs outside the matrix should be rejected"""
+    matrix = self.create()
+    self.assertRaises(KeyError, matrix.get, (2,2))
+    self.assertRaises(KeyError, matrix.get, (0,5))
+
+class DoublingComparer(object):
+  """Stands in for a FeatureComparer whose weights are all 2."""
+  information_content_filename = 'ic-test.dat'
+
+  def __init__(self):
+    self.comparisons = 0
+
+  def compareComponents(self, fr1, fr2):
+    self.comparisons += 1
+    return (float(fr1 + fr2), 1.0, 0.5, 0.0)
+
+  def compareMany(self, query, candidates):
+    return zip(*[self.compareComponents(query, fr) for fr in candidates])
+
+  def weighComponents(self, tfidf, category, referers, named_entities):
+    return result(2 * tfidf, 2 * category, 2 * referers, 2 * named_entities)
+
+class UnweightedMatrixTests(unittest.TestCase):
+
+  def test_weights_applied_on_read(self):
+    """Unweighted components should come back weighted"""
+    matrix = CondensedSimilarityMatrix(4, DoublingComparer())
+    matrix.setComponents((0,2), 0.25, 1.0, 0.5, 3.0)
+    self.assertEquals(result(0.5, 2.0, 1.0, 6.0).feature_contributions(),
+      matrix[(2,0)].feature_contributions())
+    self.assertRaises(ValueError, matrix.__setitem__, (0,1), result(1.0, 0.0, 0.0, 0.0))
+
+  def test_compare_on_demand(self):
+    """Missing pairs should be compared once when the features are known"""
+    comparer = DoublingComparer()
+    matrix = CondensedSimilarityMatrix(4, comparer, [0, 1, 2, 3])
+    self.assertEquals(10.0, matrix.get((3,2)).tfidf_comparison)
+    self.assertEquals(10.0, matrix.get((2,3)).tfidf_comparison)
+    self.assertEquals(1, comparer.comparisons)
+    self.assertEquals(1, len(matrix))
+
+class MappedSimilarityMatrixTests(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, "similarities.dat")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_reused_across_runs(self):
+    """A matching fingerprint should reuse the stored comparisons"""
+    matrix = MappedSimilarityMatrix(self.filename, 4, "a" * 40, DoublingComparer())
+    matrix.setComponents((1,3), 0.25, 1.0, 0.5, 3.0)
+    matrix.close()
+    matrix = MappedSimilarityMatrix(self.filename, 4, "a" * 40, DoublingComparer())
+    self.assertEquals(1, len(matrix))
+    self.assertTrue((3,1) in matrix)
+    self.assertEquals(result(0.5, 2.0, 1.0, 6.0).feature_contributions(),
+      matrix[(1,3)].feature_contributions())
+    matrix.close()
+
+  def test_invalidated(self):
+    """A different fingerprint or size should start the file over"""
+    matrix = MappedSimilarityMatrix(self.filename, 4, "a" * 40, DoublingComparer())
+    matrix.setComponents((1,3), 0.25, 1.0, 0.5, 3.0)
+    matrix.close()
+    matrix = MappedSimilarityMatrix(self.filename, 4, "b" * 40, DoublingComparer())
+    self.assertEquals(0, len(matrix))
+    self.assertFalse((1,3) in matrix)
+    matrix.close()
+    matrix = MappedSimilarityMatrix(self.filename, 5, "b" * 40, DoublingComparer())
+    self.assertEquals(0, len(matrix))
+    matrix.close()
+
+  def test_count_after_crash(self):
+    """Comparisons should be counted even if the header was never updated"""
+    matrix = MappedSimilarityMatrix(self.filename, 4, "a" * 40, DoublingComparer())
+    matrix.setComponents((1,3), 0.25, 1.0, 0.5, 3.0)
+    matrix.setComponents((0,2), 0.5, 0.0, 0.0, 1.0)
+    matrix.buf.flush()
+    other = MappedSimilarityMatrix(self.filename, 4, "a" * 40, DoublingComparer())
+    self.assertEquals(2, len(other))
+    other.close()
+    matrix.close()
+
+  def test_restart_leaves_open_file(self):
+    """Starting the file over should not touch a matrix still using it"""
+    matrix = MappedSimilarityMatrix(self.filename, 4, "a" * 40, DoublingComparer())
+    matrix.setComponents((1,3), 0.25, 1.0, 0.5, 3.0)
+    other = MappedSimilarityMatrix(self.filename, 4, "b" * 40, DoublingComparer())
+    self.assertEquals(0, len(other))
+    self.assertEquals(0.5, matrix[(1,3)].tfidf_comparison)
+    other.close()
+    matrix.close()
+
+class TotalsTests(unittest.TestCase):
+
+  def test_totals_match_results(self):
+    """Totals under any weights should match the weighted results"""
+    comparer = DoublingComparer()
+    matrix = CondensedSimilarityMatrix(4, comparer, [0.5, 1, 2, 3])
+    matrix.compareAll()
+    self.assertEquals(6, len(matrix))
+    totals = matrix.totals((2.0, 2.0, 2.0, 2.0))
+    for offset, key in enumerate(matrix.pairs()):
+      self.assertEquals(matrix[key].total(), totals[offset])
+    self.assertEquals(list(matrix.tfidf), list(matrix.totals((1.0, 0.0, 0.0, 0.0))))
+
+class ParallelComparerTests(unittest.TestCase):
+
+  def setUp(self):
+    import featurespace
+    generator = random.Random(7)
+    terms = ["t%d" % ii for ii in xrange(12)]
+    entities = ["Paris", "Lyon", "Nice"]
+    referers = ["man", "poet", "novel", "unknown"]
+    self.featureSets = []
+    for _ in xrange(37):
+      rep = featureRep(dict((term, generator.random())
+        for term in generator.sample(terms, 3)))
+      rep.category = generator.choice(["Lit", "Sci"])
+      for entity in generator.sample(entities, 2):
+        rep.named_entities[entity] = generator.randint(0, 2)
+      rep.referers = generator.sample(referers, 2)
+      self.featureSets.append(rep)
+    self.comparer = FeatureComparer(Options())
+    self.comparer._ic = {}
+    self.comparer.setTfIdfMatrix(TfIdfMatrix(self.featureSets))
+    self.comparer.setNamedEntityTable(NamedEntityTable(self.featureSets))
+    # Workers only look referers up in the table, so WordNet is only
+    # needed to build it.
+    #
+    realWordNet = featurespace.wn
+    featurespace.wn = FakeWordNet()
+    try:
+      refererTable = RefererSimilarityTable("ic-test.dat")
+      refererTable.build(self.featureSets, self.comparer)
+    finally:
+      featurespace.wn = realWordNet
+    self.comparer.setRefererTable(refererTable)
+    self.parallel = ParallelComparer(self.featureSets, self.comparer, 3, tileSize=5)
+
+  def tearDown(self):
+    self.parallel.close()
+
+  def check(self, store, skipped=()):
+    records = range(len(self.featureSets))
+    for b1 in records:
+      for b2 in records[b1 + 1:]:
+        if (b1, b2) in skipped:
+          continue
+        expected = self.comparer.compare(self.featureSets[b1], self.featureSets[b2])
+        self.assertEquals(expected.feature_contributions(),
+          store[(b1, b2)].feature_contributions())
+        self.assertEquals(expected.total(), store[(b1, b2)].total())
+
+  def test_same_as_serial(self):
+    """Results from the workers should be identical to comparing here"""
+    size = len(self.featureSets)
+    for store in [{}, CondensedSimilarityMatrix(size),
+        CondensedSimilarityMatrix(size, self.comparer)]:
+      self.parallel.fill(store, range(size))
+      self.assertEquals(size * (size - 1) / 2, len(store))
+      self.check(store)
+
+  def test_filled_pairs_skipped(self):
+    """Pairs already in the store should not be compared again"""
+    size = len(self.featureSets)
+    store = CondensedSimilarityMatrix(size)
+    marker = result(-1.0, 0.0, 0.0, 0.0)
+    # All of the first tile, and some pairs of the tile after it.
+    #
+    filled = [(b1, b2) for b1 in xrange(5) for b2 in xrange(b1 + 1, 5)] + \
+      [(0, 5), (2, 7), (2, 8), (4, 9)]
+    for key in filled:
+      store[key] = marker
+    self.parallel.fill(store, range(size))
+    for key in filled:
+      self.assertEquals(-1.0, store[key].total())
+    self.check(store, skipped=filled)
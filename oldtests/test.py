@@ -12,6 +12,9 @@ from canopiestest import *
 from invertedindextest import *
 from clustertest import *
 from minhashtest import *
+from similaritymatrixtest import *
+from evaluationtest import *
+from featurespacetest import *
 
 # Run all the tests.
 if __name__ == "__main__":
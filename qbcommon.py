@@ -5,8 +5,9 @@
 #
 
 from collections import defaultdict
-from nltk.util import ngrams
-from nltk.tokenize import wordpunct_tokenize
+from contextlib import contextmanager
+import os
+import struct
 
 def expand_frequencies(dictionary):
   """
@@ -59,6 +60,8 @@ def ngrams_in_question(question,ngram_size=3):
   """
   Returns set of ngrams from question, joined by ~'s.
   """
+  from nltk.util import ngrams
+  from nltk.tokenize import wordpunct_tokenize
   words1 = wordpunct_tokenize(question.text.decode('utf8'))
   return set(["~".join(x) for x in ngrams(words1, ngram_size)])
 
@@ -72,3 +75,96 @@ def all_pairs_symmetric(records):
   for x in xrange(0, size):
     for y in xrange(x+1, size):
       yield records[x],records[y]
+
+
+class MappedArray(object):
+  """
+  A fixed length array of numbers stored in place in a buffer such as a
+  memory mapped file, so it can be shared without copying. Supports
+  indexing and len, with the same typecodes as the array module.
+  """
+  def __init__(self, buf, offset, length, typecode):
+    """
+    Constructor
+
+    :param buf: A writeable buffer, e.g. an mmap.
+    :param offset: Byte offset of the first element in the buffer.
+    :param length: Number of elements.
+    :param typecode: Type of the elements, as for the array module.
+    """
+    self.buf = buf
+    self.offset = offset
+    self.length = length
+    self.typecode = typecode
+    self.struct = struct.Struct("=" + typecode)
+    self.itemsize = self.struct.size
+
+  def nbytes(self):
+    """Returns the number of bytes the elements take up in the buffer."""
+    return self.length * self.itemsize
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, ii):
+    if isinstance(ii, slice):
+      # Contiguous slices are unpacked in one go, as a tuple.
+      #
+      start, stop, step = ii.indices(self.length)
+      if step != 1:
+        return tuple(self[jj] for jj in xrange(start, stop, step))
+      return struct.unpack_from("=%d%s" % (max(0, stop - start), self.typecode),
+        self.buf, self.offset + start * self.itemsize)
+    if ii < 0 or ii >= self.length:
+      raise IndexError(ii)
+    return self.struct.unpack_from(self.buf, self.offset + ii * self.itemsize)[0]
+
+  def __setitem__(self, ii, value):
+    if ii < 0 or ii >= self.length:
+      raise IndexError(ii)
+    self.struct.pack_into(self.buf, self.offset + ii * self.itemsize, value)
+
+  def __iter__(self):
+    # Unpack a block of elements at a time rather than one by one.
+    #
+    blockSize = 4096
+    for start in xrange(0, self.length, blockSize):
+      count = min(blockSize, self.length - start)
+      block = struct.unpack_from("=%d%s" % (count, self.typecode), self.buf,
+        self.offset + start * self.itemsize)
+      for value in block:
+        yield value
+
+def writeMappedArray(f, values, typecode):
+  """
+  Writes numbers to a file in the layout MappedArray reads them in.
+
+  :param f: A file open for writing.
+  :param values: A sequence of numbers.
+  :param typecode: Type of the elements, as for the array module.
+  :returns: The number of bytes written.
+  """
+  blockSize = 4096
+  for start in xrange(0, len(values), blockSize):
+    block = values[start:start + blockSize]
+    f.write(struct.pack("=%d%s" % (len(block), typecode), *block))
+  return len(values) * struct.calcsize("=" + typecode)
+
+@contextmanager
+def replacingFile(filename):
+  """
+  Opens a file to write in place of the given one. It is written under a
+  temporary name and only moved into place once the block finishes, so
+  that other processes still using the old file are not disturbed.
+
+  :param filename: Path of the file to replace. Need not exist yet.
+  :returns: A context manager giving a file open for writing.
+  """
+  temporary = "%s.%d" % (filename, os.getpid())
+  try:
+    with open(temporary, "wb") as f:
+      yield f
+  except:
+    os.remove(temporary)
+    raise
+  os.rename(temporary, filename)
@@ -11,6 +11,7 @@ logger = logging.getLogger('settings')
 import json                         
 from extract_db import QuestionDatabase
 from cluster import *
+from similaritymatrix import PAIRWISE_STORES
 import pickle
 import os
 
@@ -22,12 +23,19 @@ CLUSTER_FUNCTIONS_BY_NAME = { \
 
 ALGORITHMS = CLUSTER_FUNCTIONS_BY_NAME.keys()
 
+# Names for the engines that pick the next pair of clusters to merge.
+CLUSTER_ENGINES = [ClusterEngines.HEAP, ClusterEngines.SCAN, ClusterEngines.NNCHAIN,
+  ClusterEngines.MST]
+
 # Names for available blocking methods.
 BLOCKING_METHODS = ["LEGO","CANOPIES","NONE"]
 OUTPUT_FORMATS = ["CSV","VERBOSE","MERGE-CSV","NONE"]
 
 TIGHT_THRESHOLDS = ["INVERSE", "INVERSELOG", "INVERSESQRT"]
 
+# Ways of computing JCN similarities: our own engine or NLTK's.
+JCN_ENGINES = ["FAST", "NLTK"]
+
 DEFAULT_QUESTION_DUMPSITE = 'Data/questions.pickle'
 
 DEFAULT_QUESTION_ID_FILE = "Data/question-ids.csv"
@@ -88,10 +96,24 @@ def parseOptions():
     help="Output format. Choices are: " + ", ".join(OUTPUT_FORMATS))
   opt_parser.add_option("--algorithm", action="store",
     help="Base clustering algorithm. Choices are: " + ", ".join(ALGORITHMS))
+  opt_parser.add_option("--cluster-engine", action="store",
+    help="Engine used to find the nearest clusters. Choices are: " + ", ".join(CLUSTER_ENGINES) + ". HEAP and SCAN give the same clusters. NNCHAIN is faster but still keeps O(n^2) cluster distances, and with tied scores it may merge differently from HEAP. MST only works for MAXCLUSTER.")
+  opt_parser.add_option("--linkage-updates", action="store_true",
+    help="Update cluster distances from the merged clusters' distances after every merge instead of recomputing them from base records. Faster, but with tied scores MEANCLUSTER may merge differently.")
+  opt_parser.add_option("--pairwise-store", action="store",
+    help="Storage for similarities between clues. Choices are: " + ", ".join(PAIRWISE_STORES) + ". Defaults to CONDENSED without blocking and DICT with it, since blocks only compare pairs within them.")
+  opt_parser.add_option("--sparse-candidates", action="store_true",
+    help="Only compare clues that share a feature or named entity in the inverted indexes, or have referers related enough to reach the threshold. Other pairs get the score of clues with nothing in common.")
+  opt_parser.add_option("--workers", action="store", type="int",
+    help="Number of processes used to compare clues before clustering (1 compares them during clustering).")
+  opt_parser.add_option("--similarity-cache", action="store",
+    help="File to keep unweighted similarities between clues in across runs. Started over if the clues or their features change.")
   opt_parser.add_option("--write-csv-column-names", action="store_true",
     help="Does no computation -- Just writes CSV column names to standard output.")
   opt_parser.add_option("--stored-questions", action="store",
     help="Path to serialized questions objects.")
+  opt_parser.add_option("--index-cache", action="store",
+    help="Prefix of files to keep the inverted indexes in across runs. Rebuilt if the questions change.")
 
   # This is by default now.
   #
@@ -101,6 +123,14 @@ def parseOptions():
     help="Set to preserve log contents across multiple runs.")
   opt_parser.add_option("--write-thresholds", action="store_true",
     help="Set to write all possible distance thresholds and associated F1's.")
+  opt_parser.add_option("--referer-table", action="store",
+    help="File to keep the similarities between distinct referers in across runs.")
+  opt_parser.add_option("--jcn-engine", action="store",
+    help="How to compute JCN similarities between synsets. Choices are: " + ", ".join(JCN_ENGINES))
+  opt_parser.add_option("--synset-cache", action="store",
+    help="File to keep JCN similarities between synsets in across runs and worker processes.")
+  opt_parser.add_option("--weight-grid", action="store",
+    help="Comma separated values to try for each feature weight. Writes the best threshold and F1 for every combination instead of clustering.")
   
   # Feature representation weights.
   #
@@ -136,8 +166,12 @@ def parseOptions():
     disambiguations_file="Data/disambiguations.data",
     blocking_method="NONE", limit=-1, feature_distance_threshold=2.0,
     output_format="VERBOSE", algorithm="MEANCLUSTER",
+    cluster_engine=ClusterEngines.HEAP, linkage_updates=False,
+    pairwise_store=None, sparse_candidates=False, workers=1,
+    similarity_cache=None, weight_grid=None, referer_table=None,
+    synset_cache=None, jcn_engine="FAST",
     write_csv_column_names=False, blocking_mask=0b111, category_mask = 0b11,
-    stored_questions=None, restrict_to_dupes=True,
+    stored_questions=None, index_cache=None, restrict_to_dupes=True,
     preserve_old_logs=False, write_thresholds=False,
     tf_idf_weight=1.0, category_weight=0.0,
     referers_weight=1.0, named_entities_weight=1.0,
@@ -150,6 +184,17 @@ def parseOptions():
   options.blocking_method = options.blocking_method.upper()
   options.output_format = options.output_format.upper()
   options.algorithm = options.algorithm.upper()
+  options.cluster_engine = options.cluster_engine.upper()
+  if options.pairwise_store is None:
+    # The condensed matrix has room for every pair from the start, which
+    # is wasted when blocking only compares pairs within blocks.
+    #
+    if options.blocking_method == "NONE":
+      options.pairwise_store = "CONDENSED"
+    else:
+      options.pairwise_store = "DICT"
+  options.pairwise_store = options.pairwise_store.upper()
+  options.jcn_engine = options.jcn_engine.upper()
   options.tight_threshold = options.tight_threshold.upper()
 
   # Validate that what they asked for made sense
@@ -166,6 +211,30 @@ def parseOptions():
     print options.algorithm, "is not a valid algorithm."
     print "Choices are ", ", ".join(ALGORITHMS)
     exit()
+  if options.cluster_engine not in CLUSTER_ENGINES:
+    print options.cluster_engine, "is not a valid cluster engine."
+    print "Choices are ", ", ".join(CLUSTER_ENGINES)
+    exit()
+  if options.pairwise_store not in PAIRWISE_STORES:
+    print options.pairwise_store, "is not a valid pairwise store."
+    print "Choices are ", ", ".join(PAIRWISE_STORES)
+    exit()
+  if options.jcn_engine not in JCN_ENGINES:
+    print options.jcn_engine, "is not a valid JCN engine."
+    print "Choices are ", ", ".join(JCN_ENGINES)
+    exit()
+  # Clustering always runs on similarities, where the clusterer keeping
+  # the best pair between two clusters is MAXCLUSTER.
+  #
+  if options.cluster_engine == ClusterEngines.MST and options.algorithm != "MAXCLUSTER":
+    print options.cluster_engine, "engine only works with single linkage (MAXCLUSTER on similarities)."
+    exit()
+  if options.weight_grid:
+    try:
+      options.weight_grid = [float(x) for x in options.weight_grid.split(",")]
+    except ValueError:
+      print options.weight_grid, "is not a comma separated list of weights."
+      exit()
   if options.tight_threshold not in TIGHT_THRESHOLDS:
     print options.tight_threshold, "is not a valid tight threshold type."
     print "Choices are ", ", ".join(TIGHT_THRESHOLDS)
@@ -0,0 +1,489 @@
+# Author: Tim Destan
+#
+# Compact storage for the similarities between pairs of base records.
+#
+# A dictionary from (b1,b2) tuples to FeatureComparisonResult objects costs
+# several hundred bytes per pair, which is far too much once every pair of a
+# few thousand clues has been compared. Here each pair b1 < b2 instead gets a
+# fixed slot in a condensed upper triangular array, with one array of doubles
+# per component of the comparison result. The arrays can also live in a
+# memory mapped file so that comparisons are reused across runs.
+
+from array import array
+from itertools import groupby, izip
+from multiprocessing import Pool
+import hashlib
+import mmap
+import os
+import struct
+from featurespace import FeatureComparisonResult, FeatureComparer, \
+  SynsetSimilarityCache, informationContentFingerprint
+from qbcommon import MappedArray, replacingFile
+
+import logging
+logger = logging.getLogger("SimilarityMatrix")
+
+# Names for the available pairwise stores.
+PAIRWISE_STORES = ["CONDENSED", "DICT"]
+
+# Values of the record of filled slots: an exact comparison result, or a
+# bound from FeatureComparer.compareWithThreshold.
+EMPTY, EXACT, BOUND = 0, 1, 2
+
+# Number of records along each side of a tile of the pair space handed to
+# a worker process.
+DEFAULT_TILE_SIZE = 64
+
+def makePairwiseStore(name, size):
+  """
+  Makes an empty store for the similarities between base records.
+
+  :param name: One of PAIRWISE_STORES.
+  :param size: Number of base records, which are numbered from 0.
+  :returns: An object with the dictionary interface used by the clusterers
+    for their base distance caches.
+  """
+  if name == "CONDENSED":
+    return CondensedSimilarityMatrix(size)
+  elif name == "DICT":
+    return {}
+  else:
+    raise ValueError("Unknown pairwise store: %s" % repr(name))
+
+class CondensedSimilarityMatrix(object):
+  """
+  Pairwise store for comparison results between base records 0..size-1.
+
+  Supports the parts of the dictionary interface that the clusterers use
+  (get, item access, membership and len) with (b1,b2) tuples as keys. The
+  order of the two records in a key does not matter. Stored results are
+  returned as new FeatureComparisonResult objects with the same component
+  values and total. Whether a stored result was only a bound (see
+  FeatureComparer.compareWithThreshold) is kept too, so it can be told
+  apart from an exact score.
+
+  If a comparer is given, the channels instead hold the unweighted
+  components from FeatureComparer.compareComponents and the comparer's
+  weights are applied as results are read. Such a matrix is filled with
+  setComponents, or compares missing pairs itself when it is also given
+  the feature representations.
+  """
+  def __init__(self, size, comparer=None, featureSets=None):
+    """
+    Constructor
+
+    :param size: Number of base records.
+    :param comparer: Optional FeatureComparer whose weights to apply to
+      unweighted components.
+    :param featureSets: Optional feature representations of the base
+      records, used with the comparer to fill in missing pairs on demand.
+    """
+    self.size = size
+    self.length = size * (size - 1) // 2
+    self.comparer = comparer
+    self.featureSets = featureSets
+    self.count = 0
+    self._allocate()
+
+  def _allocate(self):
+    """Allocates the channels and the record of filled slots."""
+    self.tfidf = array('d', [0.0]) * self.length
+    self.category = array('d', [0.0]) * self.length
+    self.referers = array('d', [0.0]) * self.length
+    self.named_entities = array('d', [0.0]) * self.length
+    self.filled = bytearray(self.length)
+    logger.info("Allocated pairwise similarity matrix for %d records (%d bytes)." % \
+      (self.size, self.memoryUsage()))
+
+  def _offset(self, key):
+    """
+    Finds the slot for a pair of base records.
+
+    :param key: A pair of distinct base records.
+    :returns: The index of the pair in the channel arrays.
+    """
+    b1, b2 = key
+    if b1 > b2:
+      b1, b2 = b2, b1
+    if b1 == b2 or b1 < 0 or b2 >= self.size:
+      raise KeyError(key)
+    return b1 * (2 * self.size - b1 - 1) // 2 + (b2 - b1 - 1)
+
+  def _result(self, offset):
+    """Rebuilds the comparison result stored in a slot."""
+    if self.comparer is not None:
+      return self.comparer.weighComponents(self.tfidf[offset],
+        self.category[offset], self.referers[offset], self.named_entities[offset])
+    result = FeatureComparisonResult()
+    result.tfidf_comparison = self.tfidf[offset]
+    result.category_comparison = self.category[offset]
+    result.referers_comparison = self.referers[offset]
+    result.named_entities_comparison = self.named_entities[offset]
+    result.computeTotal()
+    result.isBound = (self.filled[offset] == BOUND)
+    return result
+
+  def get(self, key, default=None):
+    offset = self._offset(key)
+    if not self.filled[offset]:
+      if self.featureSets is None:
+        return default
+      b1, b2 = key
+      self._store(offset, *self.comparer.compareComponents(
+        self.featureSets[b1], self.featureSets[b2]))
+    return self._result(offset)
+
+  def __getitem__(self, key):
+    result = self.get(key)
+    if result is None:
+      raise KeyError(key)
+    return result
+
+  def __setitem__(self, key, result):
+    if self.comparer is not None:
+      raise ValueError("Matrix holds unweighted components, use setComponents.")
+    self._store(self._offset(key), result.tfidf_comparison,
+      result.category_comparison, result.referers_comparison,
+      result.named_entities_comparison, result.isBound)
+
+  def setComponents(self, key, tfidf, category, referers, named_entities):
+    """
+    Stores a comparison result given as its component values (unweighted
+    if the matrix has a comparer).
+    """
+    self._store(self._offset(key), tfidf, category, referers, named_entities)
+
+  def _store(self, offset, tfidf, category, referers, named_entities,
+      isBound=False):
+    """Writes component values into a slot."""
+    self.tfidf[offset] = tfidf
+    self.category[offset] = category
+    self.referers[offset] = referers
+    self.named_entities[offset] = named_entities
+    if not self.filled[offset]:
+      self.count += 1
+    self.filled[offset] = BOUND if isBound else EXACT
+
+  def __contains__(self, key):
+    return bool(self.filled[self._offset(key)])
+
+  def __len__(self):
+    return self.count
+
+  def pairs(self):
+    """
+    Generates the pairs of base records in the order of their slots.
+    """
+    for b1 in xrange(self.size):
+      for b2 in xrange(b1 + 1, self.size):
+        yield (b1, b2)
+
+  def compareAll(self):
+    """
+    Compares every pair that is not stored yet. Needs the comparer and the
+    feature representations.
+    """
+    for b1 in xrange(self.size):
+      others = [b2 for b2 in xrange(b1 + 1, self.size) if (b1, b2) not in self]
+      if not others:
+        continue
+      channels = self.comparer.compareMany(self.featureSets[b1],
+        [self.featureSets[b2] for b2 in others])
+      for b2, components in zip(others, izip(*channels)):
+        self._store(self._offset((b1, b2)), *components)
+
+  def totals(self, weights):
+    """
+    Computes the total similarity of every pair under a weight vector,
+    without building any comparison results. Totals match those of
+    FeatureComparer.weighComponents with the same weights.
+
+    :param weights: Tuple of tf-idf, category, referers and named entities
+      weights.
+    :returns: An array with one total per slot (0.0 where nothing is stored).
+    """
+    tfidfWeight, categoryWeight, referersWeight, namedEntitiesWeight = weights
+    return array('d', (tfidf * tfidfWeight + category * categoryWeight +
+      referers * referersWeight + named_entities * namedEntitiesWeight
+      for tfidf, category, referers, named_entities in izip(self.tfidf,
+        self.category, self.referers, self.named_entities)))
+
+  def memoryUsage(self):
+    """
+    Returns the approximate number of bytes used by the stored channels.
+    """
+    channels = [self.tfidf, self.category, self.referers, self.named_entities]
+    return sum(len(c) * c.itemsize for c in channels) + len(self.filled)
+
+def similarityFingerprint(questions, featureSets, comparer):
+  """
+  Computes a fingerprint of everything the unweighted similarities between
+  the given clues depend on: which questions they are, their feature
+  representations and the information content file used for referers.
+
+  :param questions: The questions, in order.
+  :param featureSets: Their feature representations.
+  :param comparer: The FeatureComparer.
+  :returns: A hex digest.
+  """
+  digest = hashlib.sha1()
+  digest.update(informationContentFingerprint(comparer.information_content_filename))
+  for question, featureRep in zip(questions, featureSets):
+    digest.update(repr((question.id, featureRep.category,
+      sorted(featureRep.tfidf_features.items()),
+      sorted(featureRep.referers),
+      sorted((k, v) for (k, v) in featureRep.named_entities.items() if v != 0))))
+  return digest.hexdigest()
+
+class MappedSimilarityMatrix(CondensedSimilarityMatrix):
+  """
+  A matrix of unweighted similarities kept in a memory mapped file, so that
+  later runs on the same clues can reuse the comparisons and apply their own
+  weights.
+
+  The file starts with a header recording a fingerprint of the clues and
+  their features (see similarityFingerprint). If the fingerprint or the
+  number of records does not match, the file is started over. Pages of the
+  file are only read in as pairs are looked up.
+  """
+  MAGIC = "QBSIM001"
+  HEADER = struct.Struct("=8s40sqq")
+
+  def __init__(self, filename, size, fingerprint, comparer, featureSets=None):
+    """
+    Constructor
+
+    :param filename: Path to the cache file, created if necessary.
+    :param size: Number of base records.
+    :param fingerprint: Fingerprint of the clues and features.
+    :param comparer: FeatureComparer whose weights to apply.
+    :param featureSets: Optional feature representations, to compare
+      missing pairs on demand.
+    """
+    self.filename = filename
+    self.fingerprint = fingerprint
+    CondensedSimilarityMatrix.__init__(self, size, comparer, featureSets)
+
+  def _allocate(self):
+    """Opens or creates the cache file and maps the channels onto it."""
+    fileSize = self.HEADER.size + self.length * (4 * 8 + 1)
+    header = None
+    if os.path.exists(self.filename) and os.path.getsize(self.filename) == fileSize:
+      with open(self.filename, "rb") as f:
+        header = self.HEADER.unpack(f.read(self.HEADER.size))
+    reused = header is not None and \
+      header[:3] == (self.MAGIC, self.fingerprint, self.size)
+    if reused:
+      logger.info("Reusing similarity cache %s." % self.filename)
+    else:
+      logger.info("Starting new similarity cache %s." % self.filename)
+      with replacingFile(self.filename) as f:
+        f.write(self.HEADER.pack(self.MAGIC, self.fingerprint, self.size, 0))
+        f.truncate(fileSize)
+    self.file = open(self.filename, "r+b")
+    self.buf = mmap.mmap(self.file.fileno(), fileSize)
+    offset = self.HEADER.size
+    channels = []
+    for _ in xrange(4):
+      channels.append(MappedArray(self.buf, offset, self.length, 'd'))
+      offset += channels[-1].nbytes()
+    self.tfidf, self.category, self.referers, self.named_entities = channels
+    self.filled = MappedArray(self.buf, offset, self.length, 'B')
+    logger.info("Mapped pairwise similarity matrix for %d records from %s (%d bytes)." % \
+      (self.size, self.filename, fileSize))
+    if reused:
+      # The count in the header is only written on close, so it is stale
+      # if a run died. Count the filled slots instead.
+      #
+      self.count = self._countFilled(offset)
+      self._writeHeader()
+
+  def _countFilled(self, offset, chunk=1 << 24):
+    """Counts the non-empty slots of the filled channel at the offset."""
+    empty = 0
+    for start in xrange(offset, offset + self.length, chunk):
+      end = min(start + chunk, offset + self.length)
+      empty += self.buf[start:end].count(chr(EMPTY))
+    return self.length - empty
+
+  def _writeHeader(self):
+    self.HEADER.pack_into(self.buf, 0, self.MAGIC, self.fingerprint,
+      self.size, self.count)
+
+  def memoryUsage(self):
+    """The channels live in the page cache, so they are not counted."""
+    return 0
+
+  def close(self):
+    """Writes everything back to the file and closes it."""
+    self._writeHeader()
+    self.buf.flush()
+    self.buf.close()
+    self.file.close()
+
+def _tilePairs(rows, columns):
+  """
+  Generates the pairs of records in a tile of the pair space, in a fixed
+  order. A tile on the diagonal (rows and columns the same) only yields
+  each pair once.
+
+  :param rows: A sorted list of base records.
+  :param columns: A sorted list of base records, either equal to rows or
+    entirely after them.
+  """
+  diagonal = (rows == columns)
+  for ii in xrange(len(rows)):
+    start = ii + 1 if diagonal else 0
+    for jj in xrange(start, len(columns)):
+      yield rows[ii], columns[jj]
+
+# State of a worker process, set up once by _initWorker.
+_workerState = {}
+
+def _comparerTables(comparer):
+  """
+  Collects what a comparer in a worker process needs to compare the same
+  way as the given one, besides its options. The synset similarity cache
+  is passed by file name, so that workers map the same file.
+  """
+  cacheFilename = None
+  if comparer.synsetSimilarityCache is not None:
+    cacheFilename = comparer.synsetSimilarityCache.filename
+  return (comparer.tfidfMatrix, comparer.refererTable,
+    cacheFilename, comparer.skipReferers, comparer.namedEntityTable)
+
+def _initWorker(featureSets, options, tables):
+  """
+  Sets up a worker process with its own feature comparer.
+
+  The arguments are the parent's full feature sets and tables, not slices
+  of them. That is only cheap because the pool forks its workers (the only
+  way multiprocessing starts them on Unix in this Python), so they are
+  inherited rather than pickled. Where workers are spawned instead, every
+  worker would be sent a copy of all of them.
+  """
+  tfidfMatrix, refererTable, cacheFilename, skipReferers, \
+    namedEntityTable = tables
+  comparer = FeatureComparer(options)
+  comparer.skipReferers = skipReferers
+  if tfidfMatrix is not None:
+    comparer.setTfIdfMatrix(tfidfMatrix)
+  if namedEntityTable is not None:
+    comparer.setNamedEntityTable(namedEntityTable)
+  if refererTable is not None:
+    comparer.setRefererTable(refererTable)
+  if cacheFilename is not None:
+    comparer.setSynsetSimilarityCache(SynsetSimilarityCache(cacheFilename,
+      comparer.information_content_filename))
+  _workerState["featureSets"] = featureSets
+  _workerState["comparer"] = comparer
+
+def _compareTile(args):
+  """
+  Compares the pairs of a tile. Runs in a worker process.
+
+  :param args: A tile, as a tuple (rows, columns, pairs) where rows and
+    columns are lists of records and pairs is None to compare every pair
+    of the tile, or else the list of pairs to compare, in the order they
+    are generated by _tilePairs.
+  :returns: The tile and one array of unweighted values per result
+    component, in the order of the pairs compared.
+  """
+  rows, columns, pairs = args
+  featureSets = _workerState["featureSets"]
+  comparer = _workerState["comparer"]
+  channels = [array('d') for _ in xrange(4)]
+  if pairs is None:
+    block = comparer.compareBlock([featureSets[b] for b in rows],
+      [featureSets[b] for b in columns], diagonal=(rows == columns))
+  else:
+    block = [comparer.compareMany(featureSets[b1],
+        [featureSets[b2] for _, b2 in rowPairs])
+      for b1, rowPairs in groupby(pairs, lambda pair: pair[0])]
+  for components in block:
+    for channel, values in zip(channels, components):
+      channel.extend(values)
+  # Save new synset similarities for the other workers and later runs.
+  #
+  cache = comparer.synsetSimilarityCache
+  if cache is not None and cache.added:
+    cache.flush()
+  return args, channels
+
+class ParallelComparer(object):
+  """
+  Fills pairwise stores by comparing records in a pool of worker processes.
+
+  The pair space is cut into square tiles which the workers compare
+  independently, and the parent copies the results into the store. Each
+  worker runs its own FeatureComparer with the same options as the given
+  one and returns unweighted components, which the parent weighs unless the
+  store keeps them unweighted. The results are identical to comparing the
+  pairs in this process.
+
+  Workers get all the feature sets and tables when they start (see
+  _initWorker), which relies on them being forked from this process; tiles
+  only carry record numbers. Any new synset similarities are flushed to
+  the synset similarity cache after each tile, for the other workers.
+  """
+  def __init__(self, featureSets, comparer, workers, tileSize=DEFAULT_TILE_SIZE):
+    """
+    Constructor
+
+    :param featureSets: Feature representations of the base records.
+    :param comparer: FeatureComparer to copy the options of.
+    :param workers: Number of worker processes.
+    :param tileSize: Number of records along each side of a tile.
+    """
+    self.comparer = comparer
+    self.tileSize = tileSize
+    self.workers = workers
+    self.pool = Pool(workers, _initWorker,
+      (featureSets, comparer.options, _comparerTables(comparer)))
+
+  def fill(self, store, records):
+    """
+    Compares every pair of the given records and stores the results.
+
+    :param store: A pairwise store, e.g. a CondensedSimilarityMatrix.
+    :param records: The base records whose pairs to compare.
+    """
+    records = sorted(records)
+    size = len(records)
+    tiles = [(records[rowStart:rowStart + self.tileSize],
+        records[columnStart:columnStart + self.tileSize])
+      for rowStart in xrange(0, size, self.tileSize)
+      for columnStart in xrange(rowStart, size, self.tileSize)]
+    # Leave out pairs that were already compared, e.g. by an earlier block.
+    # Tiles with nothing left are skipped, and tiles with only some pairs
+    # left only send those.
+    #
+    jobs = []
+    numPairs = 0
+    for rows, columns in tiles:
+      pairs = [key for key in _tilePairs(rows, columns) if key not in store]
+      if not pairs:
+        continue
+      numPairs += len(pairs)
+      tilePairs = len(rows) * (len(rows) - 1) / 2 if rows == columns else \
+        len(rows) * len(columns)
+      jobs.append((rows, columns, None if len(pairs) == tilePairs else pairs))
+    logger.info("Comparing %d pairs of records in %d tiles with %d workers." % \
+      (numPairs, len(jobs), self.workers))
+    keepsComponents = isinstance(store, CondensedSimilarityMatrix) and \
+      store.comparer is not None
+    for tile, channels in self.pool.imap_unordered(_compareTile, jobs):
+      rows, columns, pairs = tile
+      if pairs is None:
+        pairs = _tilePairs(rows, columns)
+      for ii, key in enumerate(pairs):
+        components = [channel[ii] for channel in channels]
+        if keepsComponents:
+          store.setComponents(key, *components)
+        else:
+          store[key] = self.comparer.weighComponents(*components)
+
+  def close(self):
+    """Shuts down the worker processes."""
+    self.pool.close()
+    self.pool.join()